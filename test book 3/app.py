@@ -2,36 +2,77 @@ from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from services.cache import Cache
+from services.profiling import QueryCounter
+from services.metrics import Metrics
+from services.covers import CoverProcessor
+from services.assets import StaticAssets
+from services.async_db import AsyncDatabase
+from services.passwords import PasswordHasher
 import os
 
 # Initialize Flask extensions
 db = SQLAlchemy()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
+cache = Cache()
+query_counter = QueryCounter()
+metrics = Metrics()
+covers = CoverProcessor()
+assets = StaticAssets()
+async_db = AsyncDatabase()
+passwords = PasswordHasher()
 
 def create_app(config_class=Config):
     # Create and configure the app
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Pick pool settings for the database backend before the engine exists
+    from services.database import configure_database, install_sqlite_pragmas
+    configure_database(app)
+
     # Initialize extensions with the app
     db.init_app(app)
     login_manager.init_app(app)
+    cache.init_app(app)
+    query_counter.init_app(app)
+    metrics.init_app(app)
+    covers.init_app(app)
+    assets.init_app(app)
+    async_db.init_app(app)
+    passwords.init_app(app)
 
-    # Create database tables
     with app.app_context():
+        # Tune every new SQLite connection (WAL, busy timeout, cache sizes)
+        install_sqlite_pragmas(app, db.engine)
+
+        # Create database tables (models must be imported first so they are registered)
+        import models
         db.create_all()
 
+        # Create and backfill the full-text search index on first start
+        from services.search import create_search_index
+        create_search_index()
+
     # Import and register blueprints
     from routes.main import main_bp
     from routes.auth import auth_bp
     from routes.books import books_bp
     from routes.users import users_bp
+    from routes.exports import exports_bp
+    from routes.api import api_bp
     
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(books_bp)
     app.register_blueprint(users_bp)
+    app.register_blueprint(exports_bp)
+    app.register_blueprint(api_bp)
+
+    # Register admin CLI commands
+    from commands import register_commands
+    register_commands(app)
 
     return app
 
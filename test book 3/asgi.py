@@ -0,0 +1,16 @@
+"""ASGI entry point: uvicorn asgi:app --workers 4
+
+Needs uvicorn, asgiref and the async database driver (aiosqlite for SQLite,
+asyncpg for PostgreSQL); see requirements-optional.txt. The read-heavy pages and API endpoints run as
+coroutines on the event loop; everything else is served by the regular
+Flask views on a thread pool. The WSGI entry point in app.py is unchanged.
+"""
+from app import create_app, async_db
+from services.asgi import AsgiApp
+
+flask_app = create_app()
+
+# Registers the async views with the dispatcher
+import routes.async_views  # noqa: E402,F401
+
+app = AsgiApp(flask_app, async_db)
@@ -0,0 +1 @@
+# Benchmarks: synthetic catalog generation and load drivers for the hot paths
@@ -0,0 +1,175 @@
+"""Compare throughput of the threaded WSGI server and the ASGI mode under load
+
+Usage: python -m benchmarks.asgi_load bench.db --concurrency 1,8,32,128 --requests 2000
+
+Serves the same database twice on localhost, once with Werkzeug's threaded
+WSGI server (--threads worker threads, as a sync worker would be sized) and
+once with uvicorn running asgi.AsgiApp, then drives each at every concurrency
+level with httpx (pip install -r requirements-optional.txt). Each level
+reports requests per second and p50/p95 latency over a mix of the async
+pages and API endpoints. --db-latency adds a fixed delay to every statement
+to stand in for a networked database, which is where the async views pay off.
+"""
+from benchmarks.common import bench_config, environment, save_results, summarize, print_table
+from benchmarks.datagen import generate
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import time
+
+PATHS = [
+    '/',
+    '/books',
+    '/books?sort=newest',
+    '/search?query=the',
+    '/api/v1/books?limit=20',
+    '/api/v1/genres',
+    '/api/v1/search?q=the',
+]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _add_latency(engine, delay, asyncio_engine=False):
+    from sqlalchemy import event
+    if asyncio_engine:
+        # Statements of an asyncio engine are issued from the event loop, so wait without blocking it
+        from sqlalchemy.util import await_only
+        event.listen(engine, 'before_cursor_execute', lambda *args: await_only(asyncio.sleep(delay)))
+    else:
+        event.listen(engine, 'before_cursor_execute', lambda *args: time.sleep(delay))
+
+
+def _serve(mode, database, port, threads, delay):
+    """Server process body; runs until terminated"""
+    from app import create_app, db, async_db
+    app = create_app(bench_config(database, BOOKS_PER_PAGE=20))
+    if mode == 'wsgi':
+        from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+        from concurrent.futures import ThreadPoolExecutor
+
+        class PooledServer(ThreadedWSGIServer):
+            """Bounded pool instead of a thread per request, like a sync worker"""
+            pool = ThreadPoolExecutor(threads)
+
+            def process_request(self, request, client_address):
+                self.pool.submit(self.process_request_thread, request, client_address)
+
+        if delay:
+            with app.app_context():
+                _add_latency(db.engine, delay)
+        WSGIRequestHandler.log_request = lambda *args, **kwargs: None
+        PooledServer('127.0.0.1', port, app).serve_forever()
+    else:
+        import uvicorn
+        import routes.async_views  # noqa: F401
+        from services.asgi import AsgiApp
+        if delay:
+            _add_latency(async_db.engine.sync_engine, delay, asyncio_engine=True)
+            with app.app_context():
+                _add_latency(db.engine, delay)
+        uvicorn.run(AsgiApp(app, async_db), host='127.0.0.1', port=port, log_level='warning')
+
+
+async def _drive(base_url, concurrency, requests, seed):
+    import httpx
+    rng = random.Random(seed)
+    paths = [rng.choice(PATHS) for _ in range(requests)]
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while paths:
+                path = paths.pop()
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    failed = response.status_code >= 500
+                except httpx.HTTPError:
+                    failed = True
+                latencies.append(time.perf_counter() - start)
+                errors += failed
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        wall = time.perf_counter() - started
+
+    return {'requests_per_second': round(len(latencies) / wall, 1), **summarize(latencies, errors=errors)}
+
+
+def _wait_for(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise SystemExit(f'server on port {port} exited with {process.exitcode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f'server on port {port} did not start')
+
+
+def run(database, concurrency=(1, 8, 32, 128), requests=2000, threads=8, delay=0.0, seed=1):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for mode in ('wsgi', 'asgi'):
+        port = _free_port()
+        server = context.Process(target=_serve, args=(mode, database, port, threads, delay), daemon=True)
+        server.start()
+        try:
+            _wait_for(port, server)
+            base_url = f'http://127.0.0.1:{port}'
+            # Warm the caches and connection pools before timing
+            asyncio.run(_drive(base_url, 4, len(PATHS) * 4, seed))
+            for level in concurrency:
+                results[f'{mode}@{level}'] = {'mode': mode, 'concurrency': level,
+                                              **asyncio.run(_drive(base_url, level, requests, seed))}
+        finally:
+            server.terminate()
+            server.join()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite benchmark database (generated if missing)')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--concurrency', default='1,8,32,128')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8, help='WSGI worker threads')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='seconds added to every statement')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        from app import create_app
+        generate(create_app(bench_config(args.database)), books=args.books, users=args.users, loans=args.loans)
+
+    results = run(args.database, concurrency=[int(level) for level in args.concurrency.split(',')],
+                  requests=args.requests, threads=args.threads, delay=args.db_latency)
+    print_table(list(results.values()), ['mode', 'concurrency', 'requests_per_second', 'errors',
+                                         'p50_ms', 'p95_ms', 'p99_ms'])
+
+    if args.output:
+        save_results(args.output, {
+            'environment': environment(),
+            'settings': {'database': args.database, 'requests': args.requests, 'threads': args.threads,
+                         'db_latency': args.db_latency},
+            'results': results,
+        })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+# Make the application modules importable when run as ``python -m benchmarks.<name>``
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from config import Config
+
+
+def bench_config(database, **overrides):
+    """Build a config class pointing the app at a benchmark database (path or URL)"""
+    uri = database if '://' in database else f'sqlite:///{os.path.abspath(database)}'
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'WTF_CSRF_ENABLED': False,
+        'CACHE_TYPE': 'null',
+        'SQL_QUERY_WARN_THRESHOLD': 10 ** 6,
+    }
+    settings.update(overrides)
+    return type('BenchConfig', (Config,), settings)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values)))) - 1
+    return sorted_values[index]
+
+
+def summarize(latencies, statements=None, errors=0):
+    """Latency percentiles in milliseconds plus statement counts for one scenario"""
+    ordered = sorted(latencies)
+    summary = {
+        'count': len(ordered),
+        'errors': errors,
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+    }
+    if statements:
+        summary['statements_mean'] = round(sum(statements) / len(statements), 2)
+        summary['statements_max'] = max(statements)
+    return summary
+
+
+def environment():
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def print_table(rows, columns):
+    """Print dict rows as an aligned text table"""
+    widths = [max(len(str(column)), *(len(str(row.get(column, ''))) for row in rows)) for column in columns]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
@@ -0,0 +1,203 @@
+"""Generate a synthetic library catalog for benchmarking
+
+Usage: python -m benchmarks.datagen bench.db --books 100000 --loans 500000
+
+Rows are written with executemany in fixed-size chunks, so memory stays flat
+even for millions of loans. Popularity is Zipf-skewed: a small share of the
+books, genres and patrons accounts for most of the loans, as in a real
+library.
+"""
+from benchmarks.common import bench_config
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import bindparam
+import argparse
+import os
+import random
+import time
+
+CHUNK_SIZE = 10000
+
+GENRE_NAMES = [
+    'Fiction', 'Mystery', 'Thriller', 'Romance', 'Science Fiction', 'Fantasy',
+    'Horror', 'Historical Fiction', 'Biography', 'History', 'Science', 'Travel',
+    'Poetry', 'Drama', 'Children', 'Young Adult', 'Graphic Novels', 'Cooking',
+    'Art', 'Music', 'Philosophy', 'Religion', 'Psychology', 'Business',
+    'Economics', 'Politics', 'Law', 'Medicine', 'Technology', 'Mathematics',
+    'Nature', 'Sports', 'Self-Help', 'Health', 'Education', 'Reference',
+    'Classics', 'Humor', 'Crime', 'Adventure'
+]
+
+WORDS = (
+    'shadow light river city night garden winter summer house stone glass '
+    'silver golden broken hidden silent last first lost secret dark bright '
+    'empire kingdom journey return song letter map island mountain ocean '
+    'storm fire ice star moon sun forest road bridge tower door key heart '
+    'memory dream truth war peace history science art life death time'
+).split()
+
+FIRST_NAMES = 'Ada Alan Grace Linus Mary James Anna John Maria David Laura Peter Sara Omar Lena'.split()
+LAST_NAMES = 'Smith Jones Taylor Brown Williams Wilson Johnson Davies Robinson Wright Thompson Evans'.split()
+
+
+def zipf_weights(n, s=1.1):
+    """Cumulative Zipf weights for ranks 1..n, for random.choices(cum_weights=...)"""
+    return list(accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def _chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(connection, table, rows):
+    count = 0
+    for chunk in _chunks(rows):
+        connection.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+def generate(app, books=10000, users=1000, loans=50000, seed=42, verbose=True):
+    """Fill the app's (empty) database with a skewed synthetic catalog"""
+    from app import db
+    from models import Book, Genre, User, Loan
+    from models.book import book_genre
+    from services.search import rebuild_search_index
+    from services.stats import rebuild_stats
+    from services.rollups import rebuild_rollups
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+
+    def log(message):
+        if verbose:
+            print(f'[{time.perf_counter() - started:7.1f}s] {message}')
+
+    with app.app_context():
+        engine = db.engine
+        with engine.begin() as connection:
+            genre_names = GENRE_NAMES[:max(1, min(len(GENRE_NAMES), books // 50 or 1))]
+            _insert(connection, Genre.__table__, ({'id': i + 1, 'name': name} for i, name in enumerate(genre_names)))
+            log(f'{len(genre_names)} genres')
+
+            copies = {}
+
+            def book_rows():
+                for book_id in range(1, books + 1):
+                    total = rng.choice((1, 1, 1, 2, 2, 3, 5))
+                    copies[book_id] = total
+                    yield {
+                        'id': book_id,
+                        'title': ' '.join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 4))) + f' {book_id}',
+                        'author': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {book_id % 5000}',
+                        'isbn': f'978{book_id:010d}',
+                        'publisher': f'{rng.choice(LAST_NAMES)} Press',
+                        'publication_year': rng.randint(1900, now.year),
+                        'description': ' '.join(rng.choice(WORDS) for _ in range(30)),
+                        'cover_image': 'default_cover.jpg',
+                        'total_copies': total,
+                        'available_copies': total,
+                        'added_date': now - timedelta(minutes=rng.randint(0, 5 * 365 * 24 * 60)),
+                    }
+            log(f'{_insert(connection, Book.__table__, book_rows())} books')
+
+            genre_weights = zipf_weights(len(genre_names), s=0.8)
+
+            def genre_rows():
+                for book_id in range(1, books + 1):
+                    picked = set(rng.choices(range(1, len(genre_names) + 1), cum_weights=genre_weights, k=rng.randint(1, 3)))
+                    for genre_id in picked:
+                        yield {'book_id': book_id, 'genre_id': genre_id}
+            log(f'{_insert(connection, book_genre, genre_rows())} book/genre links')
+
+            password_hash = generate_password_hash('benchmark-password')
+
+            def user_rows():
+                for user_id in range(1, users + 1):
+                    yield {
+                        'id': user_id,
+                        'username': f'user{user_id}',
+                        'email': f'user{user_id}@example.org',
+                        'password_hash': password_hash,
+                        'is_admin': user_id == 1,
+                        'first_name': rng.choice(FIRST_NAMES),
+                        'last_name': rng.choice(LAST_NAMES),
+                        'created_at': now - timedelta(days=rng.randint(0, 5 * 365)),
+                    }
+            log(f'{_insert(connection, User.__table__, user_rows())} users')
+
+            book_weights = zipf_weights(books)
+            user_weights = zipf_weights(users, s=0.9)
+            active = set()
+            on_loan = {}
+
+            def loan_rows():
+                remaining = loans
+                while remaining:
+                    batch = min(remaining, CHUNK_SIZE)
+                    remaining -= batch
+                    book_ids = rng.choices(range(1, books + 1), cum_weights=book_weights, k=batch)
+                    user_ids = rng.choices(range(1, users + 1), cum_weights=user_weights, k=batch)
+                    for book_id, user_id in zip(book_ids, user_ids):
+                        checkout = now - timedelta(minutes=rng.randint(0, 2 * 365 * 24 * 60))
+                        # Loans from the last month may still be out, if a copy is free
+                        returned = True
+                        if (now - checkout).days < 30 and (user_id, book_id) not in active \
+                                and on_loan.get(book_id, 0) < copies[book_id] and rng.random() < 0.5:
+                            returned = False
+                            active.add((user_id, book_id))
+                            on_loan[book_id] = on_loan.get(book_id, 0) + 1
+                        yield {
+                            'user_id': user_id,
+                            'book_id': book_id,
+                            'checkout_date': checkout,
+                            'due_date': checkout + timedelta(days=14),
+                            'return_date': checkout + timedelta(days=rng.randint(1, 20)) if returned else None,
+                            'returned': returned,
+                            'renewed_count': rng.choice((0, 0, 0, 1, 2)),
+                        }
+            log(f'{_insert(connection, Loan.__table__, loan_rows())} loans ({len(active)} active)')
+
+            book_table = Book.__table__
+            for chunk in _chunks(on_loan.items()):
+                connection.execute(
+                    book_table.update().where(book_table.c.id == bindparam('book_id'))
+                    .values(available_copies=book_table.c.total_copies - bindparam('out')),
+                    [{'book_id': book_id, 'out': out} for book_id, out in chunk]
+                )
+            log(f'availability updated for {len(on_loan)} books')
+
+        rebuild_search_index()
+        rebuild_stats()
+        rebuild_rollups(retention_days=app.config['ROLLUP_RETENTION_DAYS'])
+        db.session.commit()
+        log('search index, dashboard stats and loan rollups rebuilt')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite file to create (must not exist yet)')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+
+    from app import create_app
+    app = create_app(bench_config(args.database))
+    generate(app, books=args.books, users=args.users, loans=args.loans, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Compare throughput with and without the tuned database profile
+
+Usage: python -m benchmarks.db_profiles bench.db --threads 16 --seconds 20
+       python -m benchmarks.db_profiles postgresql://localhost/library_bench
+
+For SQLite the catalog is generated once (if missing) and copied twice:
+one copy runs with DATABASE_PROFILE='none' in rollback-journal mode (the old
+behaviour), the other with the 'auto' profile (WAL, pragmas and a pooled
+engine). For a PostgreSQL URL both profiles run against the same database,
+which must already hold a generated catalog. Every thread is a logged-in
+patron running a read-heavy mix with occasional checkout/return, for a fixed
+time.
+"""
+from benchmarks.common import bench_config, summarize, print_table
+from benchmarks.datagen import WORDS, generate
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+
+BENCH_PASSWORD = 'benchmark-password'
+
+
+def _prepare_sqlite(path, args):
+    if not os.path.exists(path):
+        from app import create_app
+        generate(create_app(bench_config(path)), books=args.books, users=args.users, loans=args.loans)
+
+    copies = {}
+    for profile, journal_mode in (('none', 'DELETE'), ('auto', 'WAL')):
+        copy = f'{path}.{profile}'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(copy + suffix):
+                os.remove(copy + suffix)
+        shutil.copyfile(path, copy)
+        connection = sqlite3.connect(copy)
+        connection.execute(f'PRAGMA journal_mode = {journal_mode}')
+        connection.close()
+        copies[profile] = copy
+    return copies
+
+
+def run_profile(database, profile, threads, seconds, write_ratio, seed=1):
+    from app import create_app, db
+    from models import Book, User
+    app = create_app(bench_config(database, DATABASE_PROFILE=profile))
+    with app.app_context():
+        book_count = db.session.query(db.func.max(Book.id)).scalar()
+        user_count = db.session.query(db.func.max(User.id)).scalar()
+
+    lock = threading.Lock()
+    reads, writes, errors, busy = [], [], [0], [0]
+    deadline = [0.0]
+    barrier = threading.Barrier(threads + 1)
+
+    def patron(index):
+        rng = random.Random(seed + index)
+        client = app.test_client()
+        client.post('/login', data={'username': f'user{2 + index % max(1, user_count - 1)}',
+                                    'password': BENCH_PASSWORD})
+        barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            book_id = rng.randint(1, book_count)
+            start = time.perf_counter()
+            contended = False
+            if rng.random() < write_ratio:
+                response = client.post(f'/books/{book_id}/checkout')
+                if response.location and response.location.endswith('/profile'):
+                    client.post(f'/books/{book_id}/return')
+                # Requests that hit lock contention say so in a flash message
+                with client.session_transaction() as session:
+                    contended = any('busy' in message for category, message in session.pop('_flashes', []))
+                samples = writes
+            else:
+                url = rng.choice((f'/books/{book_id}', '/books',
+                                  f'/search?query={rng.choice(WORDS)}'))
+                response = client.get(url)
+                response.get_data()
+                samples = reads
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.append(elapsed)
+                if response.status_code >= 500:
+                    errors[0] += 1
+                elif contended:
+                    busy[0] += 1
+
+    workers = [threading.Thread(target=patron, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    deadline[0] = time.perf_counter() + seconds
+    barrier.wait()
+    for worker in workers:
+        worker.join()
+    with app.app_context():
+        db.engine.dispose()
+
+    read_summary, write_summary = summarize(reads), summarize(writes)
+    return {
+        'profile': profile,
+        'reads/s': round(len(reads) / seconds, 1),
+        'writes/s': round(len(writes) / seconds, 1),
+        'read p95 ms': read_summary['p95_ms'],
+        'write p95 ms': write_summary['p95_ms'],
+        'errors': errors[0],
+        'busy': busy[0],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite file (generated if missing) or a PostgreSQL URL')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if '://' in args.database:
+        targets = {'none': args.database, 'auto': args.database}
+    else:
+        targets = _prepare_sqlite(args.database, args)
+
+    rows = [run_profile(database, profile, args.threads, args.seconds, args.write_ratio)
+            for profile, database in targets.items()]
+    print_table(rows, ['profile', 'reads/s', 'writes/s', 'read p95 ms', 'write p95 ms', 'errors', 'busy'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Check that the hot loan queries are planned onto their indexes
+
+Usage: python -m benchmarks.explain_plans bench.db
+       python -m benchmarks.explain_plans postgresql://localhost/library_bench
+
+Each query below is built the same way the routes build it and run through
+EXPLAIN (EXPLAIN QUERY PLAN on SQLite). The check fails, with a non-zero
+exit, when a plan does not mention one of the indexes expected for it,
+which catches both a missing index (run 'flask upgrade-db') and a query
+that no longer matches the partial index predicate.
+"""
+from benchmarks.common import bench_config
+from datetime import datetime
+import argparse
+import os
+
+
+def hot_queries(user_id=1, book_id=1):
+    """(description, query, acceptable index names) for each hot path"""
+    from models import Loan
+    now = datetime.utcnow()
+    return [
+        ('active loan of a user for a book (show, checkout, return, renew)',
+         Loan.query.filter_by(user_id=user_id, book_id=book_id, returned=False),
+         {'uq_loan_active_user_book'}),
+        ('active loans of a user (dashboard, profile, user deletion)',
+         Loan.query.filter_by(user_id=user_id, returned=False),
+         {'ix_loan_user_returned', 'uq_loan_active_user_book'}),
+        ('loan history of a user',
+         Loan.query.filter_by(user_id=user_id).order_by(Loan.checkout_date.desc()),
+         {'ix_loan_user_returned'}),
+        ('overdue loans (reports, notification worker)',
+         Loan.query.filter(Loan.returned == False, Loan.due_date < now).order_by(Loan.due_date),
+         {'ix_loan_active_due_date'}),
+        ('loans of a book',
+         Loan.query.filter_by(book_id=book_id),
+         {'ix_loan_book_id'}),
+    ]
+
+
+def explain(connection, query):
+    """The plan of an ORM query as one string, with its real bound parameters"""
+    compiled = query.statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == 'sqlite':
+        sql, params = 'EXPLAIN QUERY PLAN ' + str(compiled), tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        sql, params = 'EXPLAIN ' + str(compiled), compiled.params
+    return '\n'.join(str(row[-1] if connection.dialect.name == 'sqlite' else row[0])
+                     for row in connection.exec_driver_sql(sql, params))
+
+
+def check(app):
+    """Return [(description, ok, plan)] for every hot query"""
+    from app import db
+    results = []
+    with app.app_context():
+        connection = db.session.connection()
+        if connection.dialect.name == 'postgresql':
+            # Small tables are cheaper to scan; only ask whether the index is usable
+            connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        for description, query, indexes in hot_queries():
+            plan = explain(connection, query)
+            results.append((description, any(index in plan for index in indexes), plan))
+        db.session.rollback()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite file or database URL (an existing one is checked as-is)')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    if '://' not in args.database and not os.path.exists(args.database):
+        parser.error(f'{args.database} does not exist')
+    app = create_app(bench_config(args.database))
+
+    failed = 0
+    for description, ok, plan in check(app):
+        print(f"{'ok  ' if ok else 'FAIL'} {description}")
+        for line in plan.splitlines():
+            print(f'       {line}')
+        failed += not ok
+    if failed:
+        raise SystemExit(f'{failed} hot queries are not using their indexes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Measure password checks per second per core for each hashing setting
+
+Usage: python -m benchmarks.password_hashing --seconds 3 --workers 1,2,4
+       python -m benchmarks.password_hashing --login bench.db
+
+Each setting (PBKDF2 at several iteration counts, scrypt at several costs)
+hashes one password and then verifies it through PasswordHasher as fast as
+the pool allows, once per --workers value. Per-core throughput is the rate
+divided by the busy workers (capped at the CPU count). --login also drives
+POST /login through the test client with the default setting, rehashes
+included.
+"""
+from benchmarks.common import bench_config, environment, save_results, print_table
+import argparse
+import os
+import threading
+import time
+
+SETTINGS = {
+    'pbkdf2-100k': {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256', 'PASSWORD_PBKDF2_ITERATIONS': 100000},
+    'pbkdf2-260k': {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256', 'PASSWORD_PBKDF2_ITERATIONS': 260000},
+    'pbkdf2-600k': {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256', 'PASSWORD_PBKDF2_ITERATIONS': 600000},
+    'scrypt-16k': {'PASSWORD_HASH_METHOD': 'scrypt', 'PASSWORD_SCRYPT_N': 16384},
+    'scrypt-32k': {'PASSWORD_HASH_METHOD': 'scrypt', 'PASSWORD_SCRYPT_N': 32768},
+}
+
+PASSWORD = 'benchmark-password'
+
+
+def _hammer(app, hasher, stored, threads, seconds):
+    """Verify from as many threads as the pool has workers; returns checks per second"""
+    deadline = time.perf_counter() + seconds
+    done = [0]
+    lock = threading.Lock()
+
+    def client():
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                assert hasher.verify(stored, PASSWORD)
+                with lock:
+                    done[0] += 1
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(threads)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return done[0] / (time.perf_counter() - started)
+
+
+def run_settings(settings, workers, seconds):
+    from app import create_app
+    from services.passwords import PasswordHasher
+    cores = os.cpu_count() or 1
+    results = {}
+    for name in settings:
+        for count in workers:
+            app = create_app(bench_config('sqlite://', PASSWORD_HASH_WORKERS=count,
+                                          PASSWORD_HASH_QUEUE=count, **SETTINGS[name]))
+            hasher = PasswordHasher(app)
+            with app.app_context():
+                stored = hasher.hash(PASSWORD)
+                started = time.perf_counter()
+                hasher.verify(stored, PASSWORD)
+                single_ms = (time.perf_counter() - started) * 1000
+            rate = _hammer(app, hasher, stored, count, seconds)
+            results[f'{name}x{count}'] = {
+                'setting': name,
+                'workers': count,
+                'check_ms': round(single_ms, 1),
+                'checks_per_second': round(rate, 1),
+                'per_core': round(rate / min(count, cores), 1),
+            }
+    return results
+
+
+def run_logins(database, seconds):
+    """Logins per second through the view with the default hashing settings"""
+    from app import create_app, db
+    from models import User
+    app = create_app(bench_config(database))
+    with app.app_context():
+        user = User.query.filter_by(username='hash-bench').first()
+        if user is None:
+            user = User(username='hash-bench', email='hash-bench@example.org')
+            db.session.add(user)
+        user.set_password(PASSWORD)
+        db.session.commit()
+
+    client = app.test_client()
+    count, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        response = client.post('/login', data={'username': 'hash-bench', 'password': PASSWORD})
+        assert response.status_code == 302 and not response.location.endswith('/login')
+        client.get('/logout')
+        count += 1
+    return round(count / (time.perf_counter() - started), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--settings', default=','.join(SETTINGS))
+    parser.add_argument('--workers', default='1,2')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--login', metavar='DATABASE', help='also time POST /login against this database')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_settings(args.settings.split(','), [int(count) for count in args.workers.split(',')],
+                           args.seconds)
+    print_table(list(results.values()), ['setting', 'workers', 'check_ms', 'checks_per_second', 'per_core'])
+    logins = None
+    if args.login:
+        logins = run_logins(args.login, args.seconds)
+        print(f'\nlogins per second      {logins}')
+
+    if args.output:
+        save_results(args.output, {
+            'environment': environment(),
+            'settings': {'seconds': args.seconds},
+            'results': results,
+            'logins_per_second': logins,
+        })
+
+
+if __name__ == '__main__':
+    main()
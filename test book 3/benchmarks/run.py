@@ -0,0 +1,220 @@
+"""Drive the hot paths through the Flask test client and report latencies
+
+Usage: python -m benchmarks.run bench.db --iterations 200 --output run.json
+       python -m benchmarks.run bench.db --compare baseline.json
+
+A missing database is generated first (see benchmarks.datagen for the
+sizing options). Each scenario reports p50/p95/p99 latency and the number of
+SQL statements per request. --output saves the results as a JSON baseline
+and --compare prints the change against an earlier one.
+"""
+from benchmarks.common import bench_config, environment, save_results, summarize, print_table
+from benchmarks.datagen import LAST_NAMES, WORDS, generate, zipf_weights
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import argparse
+import json
+import os
+import random
+import re
+import time
+
+BENCH_PASSWORD = 'benchmark-password'
+
+_CURSOR_RE = re.compile(r'href="([^"]*[?&]after=[^"]*)"')
+
+
+class StatementCounter:
+    """Counts every statement sent to the database"""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def _next_page(html):
+    match = _CURSOR_RE.search(html)
+    return match.group(1).replace('&amp;', '&') if match else None
+
+
+def _login(app, username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+    return client
+
+
+class Scenarios:
+    """The request mix; each method issues one timed request and returns the response"""
+
+    def __init__(self, app, rng, deep_pages=20):
+        from app import db
+        from models import Book, User
+        with app.app_context():
+            self.book_count = db.session.query(db.func.max(Book.id)).scalar() or 1
+            self.user_count = db.session.query(db.func.max(User.id)).scalar() or 1
+        self.rng = rng
+        self.deep_pages = deep_pages
+        self.book_weights = zipf_weights(self.book_count)
+        self.anonymous = app.test_client()
+        self.admin = _login(app, 'user1')
+        self.patron = _login(app, f'user{min(2, self.user_count)}')
+
+    def _popular_book(self):
+        return self.rng.choices(range(1, self.book_count + 1), cum_weights=self.book_weights)[0]
+
+    def home(self, timed):
+        return timed(self.anonymous.get, '/')
+
+    def books(self, timed):
+        params = {'sort': self.rng.choice(('title', 'author', 'newest'))}
+        if self.rng.random() < 0.5:
+            params['genre'] = self.rng.randint(1, 10)
+        if self.rng.random() < 0.3:
+            params['available'] = 'yes'
+        return timed(self.anonymous.get, '/books', query_string=params)
+
+    def books_faceted(self, timed):
+        # Several genres plus a decade, so every facet count runs filtered
+        decade = self.rng.randrange(1950, 2020, 10)
+        params = {'genre': self.rng.sample(range(1, 11), 2), 'year_from': decade, 'year_to': decade + 9,
+                  'sort': self.rng.choice(('title', 'newest'))}
+        if self.rng.random() < 0.3:
+            params['available'] = 'yes'
+        return timed(self.anonymous.get, '/books', query_string=params)
+
+    def books_deep(self, timed):
+        # Walk the cursor chain untimed, then time the deep page itself
+        url = f'/books?sort={self.rng.choice(("title", "author", "newest"))}'
+        for _ in range(self.deep_pages - 1):
+            next_url = _next_page(self.anonymous.get(url).get_data(as_text=True))
+            if next_url is None:
+                break
+            url = next_url
+        return timed(self.anonymous.get, url)
+
+    def search(self, timed):
+        query = ' '.join(self.rng.sample(WORDS, self.rng.choice((1, 1, 2))))
+        return timed(self.anonymous.get, '/search', query_string={'query': query})
+
+    def search_fuzzy(self, timed):
+        # A catalog word with two neighbouring letters swapped
+        word = self.rng.choice([word for word in WORDS if len(word) > 4])
+        index = self.rng.randrange(1, len(word) - 2)
+        typo = word[:index] + word[index + 1] + word[index] + word[index + 2:]
+        return timed(self.anonymous.get, '/search', query_string={'query': typo, 'mode': 'fuzzy'})
+
+    def suggest(self, timed):
+        word = self.rng.choice(WORDS)
+        return timed(self.anonymous.get, '/search/suggest', query_string={'q': word[:self.rng.randint(2, 5)]})
+
+    def book_detail(self, timed):
+        return timed(self.anonymous.get, f'/books/{self._popular_book()}')
+
+    def checkout_return(self, timed):
+        book_id = self.rng.randint(1, self.book_count)
+        response = timed(self.patron.post, f'/books/{book_id}/checkout')
+        self.patron.post(f'/books/{book_id}/return')
+        return response
+
+    def reports(self, timed):
+        return timed(self.admin.get, '/reports')
+
+    def users_directory(self, timed):
+        # A name prefix as typed into the admin search, or a plain sorted page
+        params = {'sort': self.rng.choice(('username', 'name', 'email', 'newest'))}
+        if self.rng.random() < 0.5:
+            params['query'] = self.rng.choice(LAST_NAMES)[:self.rng.randint(2, 5)]
+        return timed(self.admin.get, '/users', query_string=params)
+
+
+SCENARIOS = ['home', 'books', 'books_faceted', 'books_deep', 'search', 'search_fuzzy', 'suggest', 'book_detail',
+             'checkout_return', 'reports', 'users_directory']
+
+
+def run(app, iterations=100, scenarios=SCENARIOS, seed=1, deep_pages=20):
+    """Run every scenario and return {name: summary}"""
+    counter = StatementCounter()
+    driver = Scenarios(app, random.Random(seed), deep_pages=deep_pages)
+    results = {}
+
+    for name in scenarios:
+        latencies, statements, errors = [], [], 0
+
+        def timed(method, *args, **kwargs):
+            counter.count = 0
+            start = time.perf_counter()
+            response = method(*args, **kwargs)
+            response.get_data()  # drain streamed bodies
+            latencies.append(time.perf_counter() - start)
+            statements.append(counter.count)
+            return response
+
+        scenario = getattr(driver, name)
+        scenario(lambda method, *a, **kw: method(*a, **kw))  # warm up
+        for _ in range(iterations):
+            response = scenario(timed)
+            if response.status_code >= 500:
+                errors += 1
+        results[name] = summarize(latencies, statements, errors)
+    return results
+
+
+def compare(results, baseline):
+    """Rows showing each scenario's p50/p95 change against a baseline"""
+    rows = []
+    for name, summary in results.items():
+        row = {'scenario': name, 'p50_ms': summary['p50_ms'], 'p95_ms': summary['p95_ms']}
+        before = baseline.get('results', {}).get(name)
+        if before:
+            for key in ('p50_ms', 'p95_ms'):
+                if before[key]:
+                    row[f'{key} change'] = f'{(summary[key] - before[key]) / before[key] * 100:+.1f}%'
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite benchmark database (generated if missing)')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--deep-pages', type=int, default=20)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--cache', action='store_true', help='enable the in-memory fragment cache')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results from an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    generated = not os.path.exists(args.database)
+    app = create_app(bench_config(args.database, CACHE_TYPE='memory' if args.cache else 'null'))
+    if generated:
+        generate(app, books=args.books, users=args.users, loans=args.loans)
+
+    results = run(app, iterations=args.iterations, scenarios=args.scenarios.split(','),
+                  deep_pages=args.deep_pages)
+    rows = [{'scenario': name, **summary} for name, summary in results.items()]
+    print_table(rows, ['scenario', 'count', 'errors', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms',
+                       'statements_mean', 'statements_max'])
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        print_table(compare(results, baseline), ['scenario', 'p50_ms', 'p50_ms change', 'p95_ms', 'p95_ms change'])
+
+    if args.output:
+        save_results(args.output, {
+            'environment': environment(),
+            'settings': {'database': args.database, 'iterations': args.iterations, 'cache': args.cache},
+            'results': results,
+        })
+
+
+if __name__ == '__main__':
+    main()
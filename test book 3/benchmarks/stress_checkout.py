@@ -0,0 +1,123 @@
+"""Hammer one book with concurrent checkouts and check nothing is oversold
+
+Usage: python -m benchmarks.stress_checkout stress.db --threads 32 --copies 5
+
+Every thread is a separate logged-in patron. All of them are released at
+once to check out the same book, then each returns whatever it got and
+tries again until --rounds are done. Afterwards the loan table and
+available_copies must agree and never exceed the stock.
+"""
+from benchmarks.common import bench_config, summarize
+from werkzeug.security import generate_password_hash
+import argparse
+import os
+import threading
+import time
+
+PASSWORD = 'stress-password'
+
+
+def setup(app, threads, copies):
+    from app import db
+    from models import Book, User
+    with app.app_context():
+        # A cheap hash keeps the untimed logins fast
+        password_hash = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1000')
+        db.session.add(Book(title='Contended Book', author='Stress Test', isbn='9999999999999',
+                            total_copies=copies, available_copies=copies))
+        db.session.bulk_insert_mappings(User, [
+            {'username': f'patron{i}', 'email': f'patron{i}@example.org', 'password_hash': password_hash}
+            for i in range(threads)
+        ])
+        db.session.commit()
+        return Book.query.filter_by(isbn='9999999999999').one().id
+
+
+def run(app, threads=32, copies=5, rounds=5):
+    book_id = setup(app, threads, copies)
+    clients = []
+    for i in range(threads):
+        client = app.test_client()
+        client.post('/login', data={'username': f'patron{i}', 'password': PASSWORD})
+        clients.append(client)
+
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    latencies, outcomes = [], {'checked_out': 0, 'rejected': 0, 'errors': 0}
+    max_seen_out = [0]
+
+    def patron(client):
+        from models import Loan
+        for _ in range(rounds):
+            barrier.wait()
+            start = time.perf_counter()
+            response = client.post(f'/books/{book_id}/checkout')
+            elapsed = time.perf_counter() - start
+            got_it = response.status_code == 302 and response.location.endswith('/profile')
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 500:
+                    outcomes['errors'] += 1
+                elif got_it:
+                    outcomes['checked_out'] += 1
+                else:
+                    outcomes['rejected'] += 1
+            barrier.wait()
+            # Everyone has tried; count the active loans before anyone returns
+            if client is clients[0]:
+                with app.app_context():
+                    out = Loan.query.filter_by(book_id=book_id, returned=False).count()
+                max_seen_out[0] = max(max_seen_out[0], out)
+            barrier.wait()
+            if got_it:
+                client.post(f'/books/{book_id}/return')
+
+    workers = [threading.Thread(target=patron, args=(client,)) for client in clients]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - started
+
+    from models import Book, Loan
+    with app.app_context():
+        book = Book.query.get(book_id)
+        active = Loan.query.filter_by(book_id=book_id, returned=False).count()
+        consistent = book.available_copies == book.total_copies - active and 0 <= book.available_copies
+
+    return {
+        'threads': threads,
+        'copies': copies,
+        'rounds': rounds,
+        'attempts': len(latencies),
+        **outcomes,
+        'max_simultaneous_loans': max_seen_out[0],
+        'oversold': max_seen_out[0] > copies,
+        'consistent': consistent,
+        'checkouts_per_second': round(len(latencies) / wall, 1),
+        'latency': summarize(latencies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='SQLite file to create (must not exist yet)')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--copies', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+
+    from app import create_app
+    app = create_app(bench_config(args.database))
+    result = run(app, threads=args.threads, copies=args.copies, rounds=args.rounds)
+    for key, value in result.items():
+        print(f'{key:24} {value}')
+    if result['oversold'] or not result['consistent']:
+        raise SystemExit('FAILED: inventory oversold or inconsistent')
+
+
+if __name__ == '__main__':
+    main()
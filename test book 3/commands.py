@@ -0,0 +1,196 @@
+import click
+from flask.cli import with_appcontext
+from app import db
+
+
+@click.command('reindex-search')
+@with_appcontext
+def reindex_search_command():
+    """Rebuild the book and member search indexes from the book and user tables"""
+    from services.search import rebuild_search_index
+    count = rebuild_search_index()
+    db.session.commit()
+    click.echo(f'Indexed {count} books.')
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute the dashboard statistics from scratch"""
+    from services.stats import rebuild_stats
+    stats = rebuild_stats()
+    db.session.commit()
+    click.echo(f'{stats.total_books} books, {stats.total_genres} genres, '
+               f'{stats.books_on_loan} on loan.')
+
+
+@click.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format_', type=click.Choice(['csv', 'jsonl', 'marc']),
+              help='File format (guessed from the extension by default)')
+@click.option('--chunk-size', default=500, show_default=True, help='Rows written per transaction')
+@click.option('--create-genres/--no-create-genres', default=True, show_default=True,
+              help='Create genres that do not exist yet instead of rejecting the row')
+@with_appcontext
+def import_books_command(path, format_, chunk_size, create_genres):
+    """Bulk-load books from a CSV, JSON Lines or MARC 21 file"""
+    from services.importer import import_books, detect_format
+    format_ = format_ or detect_format(path)
+    if format_ is None:
+        raise click.UsageError('Cannot tell the format from the file name, pass --format.')
+
+    def progress(result):
+        click.echo(f'  {result.read} rows read, {result.imported} imported', err=True)
+
+    with open(path, 'rb') as stream:
+        result = import_books(stream, format_, chunk_size=chunk_size,
+                              create_genres=create_genres, progress=progress)
+    label = 'record' if format_ == 'marc' else 'line'
+    for line, reason in result.rejects:
+        click.echo(f'Rejected {label} {line}: {reason}')
+    if result.rejected > len(result.rejects):
+        click.echo(f'... and {result.rejected - len(result.rejects)} more rejected rows')
+    click.echo(result.summary() + (f', {result.genres_created} new genres' if result.genres_created else ''))
+
+
+@click.command('export')
+@click.argument('dataset', type=click.Choice(['books', 'loans', 'users']))
+@click.option('--format', 'format_', type=click.Choice(['csv', 'jsonl', 'parquet']), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='File to write (default: stdout)')
+@click.option('--since', help='Only rows added or changed after this ISO timestamp')
+@click.option('--state', type=click.Path(dir_okay=False),
+              help='JSON file holding the last watermark per dataset; read for --since and updated afterwards')
+@with_appcontext
+def export_command(dataset, format_, output, since, state):
+    """Stream books, loans or users to CSV, JSON Lines or Parquet"""
+    import json
+    import os
+    from services.export import check_format, export_rows, export_watermark, parse_watermark
+    try:
+        check_format(format_)
+        if since is None and state and os.path.exists(state):
+            with open(state) as f:
+                since = json.load(f).get(dataset)
+        since = parse_watermark(since)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    until = export_watermark(dataset, since)
+    stream = open(output, 'wb') if output else click.get_binary_stream('stdout')
+    try:
+        for chunk in export_rows(dataset, format_, since=since, until=until):
+            stream.write(chunk)
+    finally:
+        if output:
+            stream.close()
+
+    if until is not None:
+        click.echo(f'Exported {dataset} up to {until.isoformat()}', err=True)
+        if state:
+            watermarks = {}
+            if os.path.exists(state):
+                with open(state) as f:
+                    watermarks = json.load(f)
+            watermarks[dataset] = until.isoformat()
+            with open(state, 'w') as f:
+                json.dump(watermarks, f, indent=2)
+
+
+@click.command('notify')
+@click.option('--every', type=int, metavar='SECONDS',
+              help='Keep running, one pass every SECONDS (otherwise run once and exit)')
+@with_appcontext
+def notify_command(every):
+    """Expire uncollected holds, assess overdue fines and email notices"""
+    import time
+    from flask import current_app
+    from services.notifications import run_notifications
+    while True:
+        started = time.monotonic()
+        result = run_notifications(current_app.config)
+        click.echo(f"{result['holds_expired']} holds expired ({result['holds_promoted']} passed on), "
+                   f"{result['fines']} fines assessed, {result['sent']} notices sent, "
+                   f"{result['failed']} failed in {time.monotonic() - started:.1f}s")
+        if not every:
+            break
+        # Release the connection between passes
+        db.session.remove()
+        time.sleep(max(0, every - (time.monotonic() - started)))
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Recompute the daily loan rollups from the full loan history"""
+    from flask import current_app
+    from services.rollups import rebuild_rollups
+    rebuild_rollups(retention_days=current_app.config['ROLLUP_RETENTION_DAYS'])
+    db.session.commit()
+    click.echo('Loan rollups rebuilt.')
+
+
+@click.command('compact-rollups')
+@with_appcontext
+def compact_rollups_command():
+    """Fold daily loan rollups past the retention window into monthly rows"""
+    from flask import current_app
+    from services.rollups import compact_rollups
+    removed = compact_rollups(current_app.config['ROLLUP_RETENTION_DAYS'])
+    db.session.commit()
+    click.echo(f'Compacted {removed} daily rows.')
+
+
+@click.command('process-covers')
+@with_appcontext
+def process_covers_command():
+    """Render thumbnails and WebP variants for covers uploaded before the image pipeline"""
+    from flask import current_app
+    from app import covers
+    from services.covers import backfill_covers
+    updated, failures = backfill_covers(covers, current_app.config['UPLOAD_FOLDER'])
+    for name, error in failures:
+        click.echo(f'Could not process {name}: {error}')
+    click.echo(f'{updated} books now use processed covers, {len(failures)} files failed.')
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint the static files and write their compressed variants"""
+    from app import assets
+    written = assets.build()
+    for asset in assets.manifest.values():
+        encodings = ', '.join(sorted(asset.variants)) or 'uncompressed'
+        click.echo(f'{asset.name} -> {asset.fingerprinted} ({encodings})')
+    click.echo(f'{len(assets.manifest)} assets, {written} compressed files written.')
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Create the tables and indexes an existing database is missing"""
+    from sqlalchemy.exc import IntegrityError
+    from services.database import upgrade_schema
+    try:
+        created = upgrade_schema()
+    except IntegrityError as e:
+        raise click.ClickException(
+            f'Existing rows violate a new unique index, fix them and run again: {e.orig}')
+    for name in created:
+        click.echo(f'Created index {name}')
+    if not created:
+        click.echo('Database is up to date.')
+
+
+def register_commands(app):
+    """Attach the library admin commands to the flask CLI"""
+    app.cli.add_command(reindex_search_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(compact_rollups_command)
+    app.cli.add_command(process_covers_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(notify_command)
@@ -12,15 +12,113 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///library.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # 'auto' picks pool settings (and SQLite PRAGMAs) for the backend in
+    # DATABASE_URL; 'none' leaves the driver defaults alone
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or 'auto'
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT') or 10)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    
+    # Used by the async views under asgi.py; defaults to DATABASE_URL with
+    # the backend's asyncio driver (aiosqlite or asyncpg). The ASGI server,
+    # drivers and other optional packages are in requirements-optional.txt
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    
+    # Applied to every SQLite connection: WAL lets readers run while one
+    # writer commits, and busy_timeout (ms) bounds how long a writer waits
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 3000),
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    }
+    
     # Upload folder for book covers
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads')
     
+    # Static files are served under fingerprinted names with this max-age
+    # (seconds); gzip/brotli copies of text assets are built once into
+    # ASSETS_COMPRESSED_FOLDER (default: 'compressed' in the instance
+    # folder). ASSETS_SENDFILE = 'x-sendfile' (Apache, lighttpd) or
+    # 'x-accel-redirect' (nginx, with an internal location at
+    # ASSETS_ACCEL_PREFIX aliased to the static folder) leaves sending the
+    # file body to the front proxy; nginx only serves the compressed copies
+    # if ASSETS_COMPRESSED_FOLDER is inside the static folder
+    ASSETS_MAX_AGE = int(os.environ.get('ASSETS_MAX_AGE') or 365 * 24 * 3600)
+    ASSETS_COMPRESSED_FOLDER = os.environ.get('ASSETS_COMPRESSED_FOLDER')
+    ASSETS_SENDFILE = os.environ.get('ASSETS_SENDFILE') or ''
+    ASSETS_ACCEL_PREFIX = os.environ.get('ASSETS_ACCEL_PREFIX') or '/protected-static/'
+    
+    # Threads rendering cover thumbnails in the background (0 = inline)
+    COVER_WORKERS = int(os.environ.get('COVER_WORKERS') or 2)
+    
+    # Password hashing: 'pbkdf2:sha256' or 'scrypt' with its cost. Hashes made
+    # with other settings are upgraded on the user's next successful login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+    PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS') or 260000)
+    PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N') or 32768)
+    PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R') or 8)
+    PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P') or 1)
+    # Threads hashing passwords (0 = inline) and how many logins may wait
+    # for one before the rest are turned away
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    
     # Email configuration for notifications
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or 'library@localhost'
+    MAIL_TIMEOUT = int(os.environ.get('MAIL_TIMEOUT') or 10)
+    
+    # Notices go out in batches over one reused SMTP connection, reopened
+    # after MAIL_MESSAGES_PER_CONNECTION; failed sends are retried with backoff
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+    MAIL_MESSAGES_PER_CONNECTION = int(os.environ.get('MAIL_MESSAGES_PER_CONNECTION') or 100)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
+    
+    # Overdue notices and fines (run 'flask notify', e.g. hourly)
+    NOTICE_DUE_SOON_DAYS = int(os.environ.get('NOTICE_DUE_SOON_DAYS') or 2)
+    NOTICE_REMINDER_DAYS = int(os.environ.get('NOTICE_REMINDER_DAYS') or 7)
+    FINE_PER_DAY_CENTS = int(os.environ.get('FINE_PER_DAY_CENTS') or 25)
+    FINE_MAX_CENTS = int(os.environ.get('FINE_MAX_CENTS') or 1000)
+    
+    # Days a returned copy stays set aside for the next patron in the hold
+    # queue before the notification worker passes it on
+    HOLD_PICKUP_DAYS = int(os.environ.get('HOLD_PICKUP_DAYS') or 3)
     
     # Pagination
-    BOOKS_PER_PAGE = 12
\ No newline at end of file
+    BOOKS_PER_PAGE = 12
+    USERS_PER_PAGE = 50
+    
+    # Requests issuing more SQL statements than this are logged as warnings
+    SQL_QUERY_WARN_THRESHOLD = int(os.environ.get('SQL_QUERY_WARN_THRESHOLD') or 20)
+    
+    # Per-endpoint latency/SQL/template metrics served at /metrics, and an
+    # optional log of requests slower than SLOW_REQUEST_THRESHOLD seconds
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') is not None
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 0)
+    
+    # Daily loan rollups older than this are folded into monthly rows
+    # (keep it above 365 so the one-year report window stays exact)
+    ROLLUP_RETENTION_DAYS = int(os.environ.get('ROLLUP_RETENTION_DAYS') or 400)
+    
+    # Fragment cache: 'memory' (per process), 'filesystem' (shared by all
+    # workers on the host) or 'null' to disable
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'memory'
+    CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT') or 300)
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 1000)
+    
+    # How long the logged-in user's id, name and admin flag are reused from
+    # the cache before the users row is read again
+    USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT') or 60)
+    
+    # How long search box suggestions for a prefix are reused, by this
+    # process and by browsers (they are the same for every patron)
+    SUGGEST_CACHE_TIMEOUT = int(os.environ.get('SUGGEST_CACHE_TIMEOUT') or 60)
\ No newline at end of file
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed
-from wtforms import StringField, TextAreaField, IntegerField, SelectMultipleField, SubmitField
+from flask_wtf.file import FileField, FileAllowed, FileRequired
+from wtforms import StringField, TextAreaField, IntegerField, SelectField, SelectMultipleField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, NumberRange, Optional, ValidationError
 from models.book import Book
 import re
@@ -53,4 +53,18 @@ class BookForm(FlaskForm):
 
 class SearchForm(FlaskForm):
     query = StringField('Search', validators=[DataRequired()])
-    submit = SubmitField('Search')
\ No newline at end of file
+    submit = SubmitField('Search')
+
+class BookImportForm(FlaskForm):
+    file = FileField('Catalog File', validators=[
+        FileRequired(),
+        FileAllowed(['csv', 'jsonl', 'ndjson', 'json', 'mrc', 'marc'], 'CSV, JSON Lines or MARC files only!')
+    ])
+    format = SelectField('Format', choices=[
+        ('', 'Detect from file name'),
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+        ('marc', 'MARC 21')
+    ], default='')
+    create_genres = BooleanField('Create missing genres', default=True)
+    submit = SubmitField('Import Books')
\ No newline at end of file
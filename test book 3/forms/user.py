@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, TextAreaField, SubmitField
+from wtforms import StringField, PasswordField, BooleanField, TextAreaField, SubmitField, HiddenField, SelectField
 from wtforms.validators import DataRequired, Email, Length, EqualTo, Optional, ValidationError
 from models.user import User
 
@@ -43,4 +43,18 @@ class UserEditForm(FlaskForm):
 
 class UserSearchForm(FlaskForm):
     query = StringField('Search Users', validators=[DataRequired()])
-    submit = SubmitField('Search')
\ No newline at end of file
+    submit = SubmitField('Search')
+
+class UserBulkForm(FlaskForm):
+    """An action applied to every user the directory filters select"""
+    query = HiddenField()
+    role = HiddenField()
+    loans = HiddenField()
+    # The number of users the admin was shown; the change runs once it still matches
+    expected = HiddenField()
+    action = SelectField('Action', choices=[
+        ('', 'Choose an action...'),
+        ('grant_admin', 'Grant admin'),
+        ('revoke_admin', 'Revoke admin')
+    ], validators=[DataRequired(message='Choose an action to apply.')])
+    submit = SubmitField('Apply')
@@ -1,4 +1,7 @@
 # Import all models to make them available when importing from the models package
 from models.user import User
 from models.book import Book, Genre
-from models.loan import Loan
\ No newline at end of file
+from models.loan import Loan
+from models.stats import LibraryStats, GenreStats, BookDailyLoans, UserDailyLoans
+from models.notice import LoanNotice, Fine
+from models.hold import Hold
@@ -12,13 +12,13 @@ class Book(db.Model):
     title = db.Column(db.String(128), nullable=False, index=True)
     author = db.Column(db.String(128), nullable=False, index=True)
     isbn = db.Column(db.String(20), unique=True, index=True)
-    publisher = db.Column(db.String(128))
-    publication_year = db.Column(db.Integer)
+    publisher = db.Column(db.String(128), index=True)
+    publication_year = db.Column(db.Integer, index=True)
     description = db.Column(db.Text)
     cover_image = db.Column(db.String(128), default='default_cover.jpg')
     total_copies = db.Column(db.Integer, default=1)
     available_copies = db.Column(db.Integer, default=1)
-    added_date = db.Column(db.DateTime, default=datetime.utcnow)
+    added_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Relationships
     genres = db.relationship('Genre', secondary=book_genre, backref=db.backref('books', lazy='dynamic'))
@@ -42,6 +42,46 @@ class Book(db.Model):
             return True
         return False
     
+    @classmethod
+    def take_copy(cls, book_id):
+        """Atomically take one copy in the current transaction, if any is left
+        
+        A single conditional UPDATE, so concurrent checkouts can never drive
+        available_copies below zero.
+        """
+        result = db.session.execute(
+            cls.__table__.update()
+            .where(cls.id == book_id, cls.available_copies > 0)
+            .values(available_copies=cls.available_copies - 1)
+        )
+        return result.rowcount == 1
+    
+    @classmethod
+    def put_back_copy(cls, book_id):
+        """Atomically return one copy in the current transaction, up to total_copies"""
+        result = db.session.execute(
+            cls.__table__.update()
+            .where(cls.id == book_id, cls.available_copies < cls.total_copies)
+            .values(available_copies=cls.available_copies + 1)
+        )
+        return result.rowcount == 1
+    
+    @classmethod
+    def change_total_copies(cls, book_id, delta):
+        """Add copies, or remove copies that are on the shelf, with one relative UPDATE
+        
+        Added copies only raise total_copies; the caller puts them into
+        circulation (holds.add_copies). Returns False, changing nothing, if
+        fewer than the removed copies are on the shelf.
+        """
+        values = {'total_copies': cls.total_copies + delta}
+        conditions = [cls.id == book_id]
+        if delta < 0:
+            values['available_copies'] = cls.available_copies + delta
+            conditions.append(cls.available_copies >= -delta)
+        result = db.session.execute(cls.__table__.update().where(*conditions).values(**values))
+        return result.rowcount == 1
+    
     def __repr__(self):
         return f'<Book {self.title}>'
 
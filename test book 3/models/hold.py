@@ -0,0 +1,44 @@
+from app import db
+from datetime import datetime
+
+# Hold.status values. A waiting hold is in the queue; a ready one has a
+# copy set aside until expires_at; the rest are history.
+WAITING = 'waiting'
+READY = 'ready'
+FULFILLED = 'fulfilled'
+CANCELLED = 'cancelled'
+EXPIRED = 'expired'
+
+_ACTIVE_SQL = db.text("status IN ('waiting', 'ready')")
+
+class Hold(db.Model):
+    """A patron's place in the queue for a book that has no copy free"""
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), default=WAITING, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    ready_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime)
+    notified_at = db.Column(db.DateTime)
+
+    # - the queue of each book in FIFO order; unique, so two holds placed at
+    #   once cannot take the same place
+    # - at most one active hold per user and book
+    # - ready holds by pickup deadline (expiry sweeper) and not yet notified
+    __table_args__ = (
+        db.Index('uq_hold_book_position', 'book_id', 'position', unique=True),
+        db.Index('uq_hold_active_user_book', 'user_id', 'book_id', unique=True,
+                 sqlite_where=_ACTIVE_SQL, postgresql_where=_ACTIVE_SQL),
+        db.Index('ix_hold_ready_expires_at', 'expires_at',
+                 sqlite_where=db.text("status = 'ready'"), postgresql_where=db.text("status = 'ready'")),
+        db.Index('ix_hold_ready_unnotified', 'id',
+                 sqlite_where=db.text("status = 'ready' AND notified_at IS NULL"),
+                 postgresql_where=db.text("status = 'ready' AND notified_at IS NULL")),
+    )
+
+    book = db.relationship('Book')
+
+    def __repr__(self):
+        return f'<Hold {self.status} #{self.position} on book {self.book_id}>'
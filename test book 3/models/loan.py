@@ -1,16 +1,30 @@
 from app import db
+from sqlalchemy import case, func
 from datetime import datetime, timedelta
 
 class Loan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
     checkout_date = db.Column(db.DateTime, default=datetime.utcnow)
     due_date = db.Column(db.DateTime)
     return_date = db.Column(db.DateTime)
     returned = db.Column(db.Boolean, default=False)
     renewed_count = db.Column(db.Integer, default=0)
     
+    # Indexes for the hot paths. The partial ones only cover active loans,
+    # so they stay small however long the loan history grows:
+    # - a user's loans by status (profile, dashboard, user deletion)
+    # - at most one active loan per user and book (checkout, return, renew)
+    # - active loans by due date (overdue report, notification worker)
+    __table_args__ = (
+        db.Index('ix_loan_user_returned', 'user_id', 'returned'),
+        db.Index('uq_loan_active_user_book', 'user_id', 'book_id', unique=True,
+                 sqlite_where=db.text('returned = 0'), postgresql_where=db.text('NOT returned')),
+        db.Index('ix_loan_active_due_date', 'due_date',
+                 sqlite_where=db.text('returned = 0'), postgresql_where=db.text('NOT returned')),
+    )
+    
     def __init__(self, user_id, book_id, loan_duration=14):
         """Initialize a new loan with a default duration of 14 days"""
         self.user_id = user_id
@@ -36,6 +50,16 @@ class Loan(db.Model):
             return True
         return False
     
+    @classmethod
+    def close(cls, loan_id):
+        """Atomically mark an active loan returned; False if it already was"""
+        result = db.session.execute(
+            cls.__table__.update()
+            .where(cls.id == loan_id, cls.returned == False)
+            .values(returned=True, return_date=datetime.utcnow())
+        )
+        return result.rowcount == 1
+    
     def is_overdue(self):
         """Check if the loan is overdue"""
         return not self.returned and datetime.utcnow() > self.due_date
@@ -48,4 +72,78 @@ class Loan(db.Model):
         return 0
     
     def __repr__(self):
-        return f'<Loan {self.id}>'
\ No newline at end of file
+        return f'<Loan {self.id}>'
+
+class LoanStats:
+    """Counts of a user's active loans, computed in the database
+    
+    One aggregate statement (SUM(CASE ...) over the user's active loans)
+    answers every count at once, so no Loan objects are built just to be
+    counted.
+    """
+    
+    # Users per statement in for_users(), under SQLite's bound-parameter limit
+    CHUNK_SIZE = 500
+    
+    def __init__(self, user_id, active_loans=0, overdue_loans=0, due_soon_loans=0, renewals=0):
+        self.user_id = user_id
+        self.active_loans = active_loans
+        self.overdue_loans = overdue_loans
+        self.due_soon_loans = due_soon_loans
+        self.renewals = renewals
+    
+    @staticmethod
+    def _columns(now, due_soon_days):
+        due_soon_until = now + timedelta(days=due_soon_days)
+        return [
+            func.count(Loan.id).label('active_loans'),
+            func.coalesce(func.sum(case((Loan.due_date < now, 1), else_=0)), 0).label('overdue_loans'),
+            func.coalesce(func.sum(case(
+                (Loan.due_date.between(now, due_soon_until), 1), else_=0
+            )), 0).label('due_soon_loans'),
+            func.coalesce(func.sum(Loan.renewed_count), 0).label('renewals')
+        ]
+    
+    @classmethod
+    def statement(cls, user_id, now=None, due_soon_days=2):
+        """The one-row aggregate select behind for_user(), for callers with their own session"""
+        return db.select(cls._columns(now or datetime.utcnow(), due_soon_days)).where(
+            Loan.user_id == user_id, Loan.returned == False
+        )
+    
+    @classmethod
+    def from_row(cls, user_id, row):
+        return cls(user_id, row.active_loans, row.overdue_loans, row.due_soon_loans, row.renewals)
+    
+    @classmethod
+    def for_user(cls, user_id, now=None, due_soon_days=2):
+        """Stats for one user"""
+        return cls.from_row(user_id, db.session.execute(cls.statement(user_id, now, due_soon_days)).one())
+    
+    @classmethod
+    def for_users(cls, user_ids, now=None, due_soon_days=2):
+        """Stats for many users at once, as {user_id: LoanStats}
+        
+        One GROUP BY statement per chunk of users; users without active
+        loans get zero counts.
+        """
+        now = now or datetime.utcnow()
+        user_ids = list(dict.fromkeys(user_ids))
+        stats = {user_id: cls(user_id) for user_id in user_ids}
+        for start in range(0, len(user_ids), cls.CHUNK_SIZE):
+            rows = db.session.query(Loan.user_id, *cls._columns(now, due_soon_days)).filter(
+                Loan.user_id.in_(user_ids[start:start + cls.CHUNK_SIZE]), Loan.returned == False
+            ).group_by(Loan.user_id)
+            for row in rows:
+                stats[row.user_id] = cls.from_row(row.user_id, row)
+        return stats
+    
+    @staticmethod
+    def has_active(user_id):
+        """Check if the user has any active loan, with an EXISTS that stops at the first row"""
+        return db.session.query(
+            Loan.query.filter(Loan.user_id == user_id, Loan.returned == False).exists()
+        ).scalar()
+    
+    def __repr__(self):
+        return f'<LoanStats user {self.user_id}: {self.active_loans} active, {self.overdue_loans} overdue>'
\ No newline at end of file
@@ -0,0 +1,29 @@
+from app import db
+from datetime import datetime
+
+class LoanNotice(db.Model):
+    """An email sent (or refused for good) about a loan, so the same notice is not sent twice"""
+    id = db.Column(db.Integer, primary_key=True)
+    loan_id = db.Column(db.Integer, db.ForeignKey('loan.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_loan_notice_loan_kind_sent', 'loan_id', 'kind', 'sent_at'),
+    )
+    
+    def __repr__(self):
+        return f'<LoanNotice {self.kind} for loan {self.loan_id}>'
+
+class Fine(db.Model):
+    """Late fee accrued by an overdue loan, reassessed by the notification worker"""
+    loan_id = db.Column(db.Integer, db.ForeignKey('loan.id', ondelete='CASCADE'), primary_key=True)
+    days_overdue = db.Column(db.Integer, default=0, nullable=False)
+    amount_cents = db.Column(db.Integer, default=0, nullable=False)
+    paid = db.Column(db.Boolean, default=False, nullable=False)
+    assessed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    loan = db.relationship('Loan', backref=db.backref('fine', uselist=False))
+    
+    def __repr__(self):
+        return f'<Fine {self.amount_cents} for loan {self.loan_id}>'
\ No newline at end of file
@@ -0,0 +1,46 @@
+from app import db
+from datetime import datetime
+
+class LibraryStats(db.Model):
+    """Single-row summary of the catalog-wide counters shown on the home page"""
+    id = db.Column(db.Integer, primary_key=True)
+    total_books = db.Column(db.Integer, default=0, nullable=False)
+    total_genres = db.Column(db.Integer, default=0, nullable=False)
+    books_on_loan = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<LibraryStats {self.total_books} books>'
+
+class GenreStats(db.Model):
+    """Number of books filed under each genre, kept in step with book writes"""
+    genre_id = db.Column(db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True)
+    book_count = db.Column(db.Integer, default=0, nullable=False, index=True)
+    
+    genre = db.relationship('Genre')
+    
+    def __repr__(self):
+        return f'<GenreStats {self.genre_id}: {self.book_count}>'
+
+
+class BookDailyLoans(db.Model):
+    """Checkouts of a book per day, the rollup behind popularity reports
+    
+    Days older than the retention window are compacted into one row dated
+    the first of their month, which keeps all-time totals exact.
+    """
+    day = db.Column(db.Date, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True, index=True)
+    loan_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<BookDailyLoans {self.day} book {self.book_id}: {self.loan_count}>'
+
+class UserDailyLoans(db.Model):
+    """Checkouts by a user per day, the rollup behind the active users report"""
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True, index=True)
+    loan_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<UserDailyLoans {self.day} user {self.user_id}: {self.loan_count}>'
\ No newline at end of file
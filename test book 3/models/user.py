@@ -1,7 +1,10 @@
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from app import db, login_manager
+from sqlalchemy.orm import joinedload
+from app import db, login_manager, cache, passwords
+from services.cache import user_tag, USERS_TAG
+import hashlib
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,28 +18,112 @@ class User(UserMixin, db.Model):
     address = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # The admin directory's name order, NULL names sorting as ''
+    __table_args__ = (
+        db.Index('ix_user_name_sort', db.func.coalesce(last_name, ''), db.func.coalesce(first_name, ''), id),
+    )
+    
     # Relationship with loans
     loans = db.relationship('Loan', backref='borrower', lazy='dynamic')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check a password, rehashing it with the current settings if the stored hash is stale"""
+        if not passwords.verify(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
+    
+    @property
+    def session_version(self):
+        """Changes with every new password hash, ending sessions started before it"""
+        return hashlib.sha256((self.password_hash or '').encode()).hexdigest()[:12]
+    
+    def get_id(self):
+        # Stored in the session and remember-me cookie at login
+        return f'{self.id}:{self.session_version}'
     
     def get_active_loans(self):
-        """Get all active loans for this user"""
+        """Get all active loans for this user, with their books loaded"""
         from models.loan import Loan
-        return Loan.query.filter_by(user_id=self.id, returned=False).all()
+        return Loan.query.options(joinedload(Loan.book)).filter_by(
+            user_id=self.id, returned=False
+        ).all()
     
     def get_loan_history(self):
-        """Get loan history for this user"""
+        """Get loan history for this user, with their books loaded"""
         from models.loan import Loan
-        return Loan.query.filter_by(user_id=self.id).order_by(Loan.checkout_date.desc()).all()
+        return Loan.query.options(joinedload(Loan.book)).filter_by(
+            user_id=self.id
+        ).order_by(Loan.checkout_date.desc()).all()
+    
+    def loan_stats(self, due_soon_days=2):
+        """Active, overdue and due-soon loan counts from one aggregate query"""
+        from models.loan import LoanStats
+        return LoanStats.for_user(self.id, due_soon_days=due_soon_days)
+    
+    def has_active_loans(self):
+        """Check if the user has any book checked out"""
+        from models.loan import LoanStats
+        return LoanStats.has_active(self.id)
     
     def __repr__(self):
         return f'<User {self.username}>'
 
+class SessionUser(UserMixin):
+    """The logged-in user as current_user, built from a few cached columns
+    
+    Anything beyond those columns loads the full User row on first use.
+    """
+    FIELDS = ('id', 'username', 'is_admin', 'first_name', 'last_name')
+    
+    def __init__(self, fields, session_version, user=None):
+        self.__dict__.update(fields)
+        self.session_version = session_version
+        self._user = user
+    
+    def get_id(self):
+        return f'{self.id}:{self.session_version}'
+    
+    # These only need the id, so they run without loading the User
+    get_active_loans = User.get_active_loans
+    get_loan_history = User.get_loan_history
+    loan_stats = User.loan_stats
+    has_active_loans = User.has_active_loans
+    
+    @property
+    def user(self):
+        """The full User row, loaded on first access"""
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+    
+    def __getattr__(self, name):
+        # Only reached for attributes that are not cached
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+    
+    def __repr__(self):
+        return f'<SessionUser {self.username}>'
+
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
\ No newline at end of file
+    """Resolve the session's "<user id>:<session version>", caching the user's fields"""
+    user_id, _, version = id.partition(':')
+    if not user_id.isdigit():
+        return None
+    key = f'session-user:{user_id}:{version}'
+    fields = cache.get(key)
+    if fields is not None:
+        return SessionUser(fields, version)
+    
+    user = User.query.get(int(user_id))
+    if user is None or user.session_version != version:
+        return None
+    fields = {name: getattr(user, name) for name in SessionUser.FIELDS}
+    cache.set(key, fields, tags=[user_tag(user.id), USERS_TAG], timeout=current_app.config['USER_CACHE_TIMEOUT'])
+    return SessionUser(fields, version, user)
\ No newline at end of file
@@ -0,0 +1,408 @@
+from flask import Blueprint, jsonify, request, abort, current_app
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from app import db
+from models.book import Book, Genre, book_genre
+from models.loan import Loan, LoanStats
+from models.user import User
+from models.hold import Hold
+from models.stats import GenreStats
+from services.pagination import keyset_paginate
+from services.search import search_books
+from services.circulation import checkout_books, return_books, CirculationError
+from services.covers import cover_url
+from services import holds
+from datetime import datetime
+from functools import wraps
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Most ids one batch lookup may ask for, and the largest page size
+MAX_IDS = 100
+MAX_LIMIT = 100
+
+# Fields each resource can return (?fields=a,b) mapped to the column they
+# are read from; None marks fields computed after the query
+BOOK_FIELDS = {
+    'id': Book.id, 'title': Book.title, 'author': Book.author, 'isbn': Book.isbn,
+    'publisher': Book.publisher, 'publication_year': Book.publication_year,
+    'description': Book.description, 'total_copies': Book.total_copies,
+    'available_copies': Book.available_copies, 'added_date': Book.added_date,
+    'cover_url': Book.cover_image, 'genres': None
+}
+BOOK_DEFAULT_FIELDS = ('id', 'title', 'author', 'isbn', 'publication_year',
+                       'available_copies', 'total_copies', 'cover_url', 'genres')
+
+GENRE_FIELDS = {
+    'id': Genre.id, 'name': Genre.name,
+    'book_count': db.func.coalesce(GenreStats.book_count, 0).label('book_count')
+}
+
+LOAN_FIELDS = {
+    'id': Loan.id, 'book_id': Loan.book_id, 'title': Book.title, 'user_id': Loan.user_id,
+    'checkout_date': Loan.checkout_date, 'due_date': Loan.due_date,
+    'return_date': Loan.return_date, 'returned': Loan.returned, 'renewed_count': Loan.renewed_count
+}
+
+USER_FIELDS = {
+    'id': User.id, 'username': User.username, 'email': User.email,
+    'first_name': User.first_name, 'last_name': User.last_name, 'phone': User.phone,
+    'address': User.address, 'is_admin': User.is_admin, 'created_at': User.created_at,
+    'active_loans': None, 'overdue_loans': None
+}
+USER_DEFAULT_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_admin')
+
+# Keyset columns for each book sort order, as in the HTML listing
+BOOK_SORT_KEYS = {
+    'title': ((Book.title, Book.id), False),
+    'author': ((Book.author, Book.id), False),
+    'newest': ((Book.added_date, Book.id), True)
+}
+
+
+def api_login_required(view):
+    """Like login_required, but answers 401 instead of redirecting to the login page"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401, description='Log in to use this endpoint.')
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def _require_admin():
+    if not current_user.is_admin:
+        abort(403, description='Only administrators can do this.')
+
+
+@api_bp.errorhandler(HTTPException)
+def http_error(e):
+    return jsonify(error={'status': e.code, 'message': e.description}), e.code
+
+
+@api_bp.after_request
+def add_etag(response):
+    """Give successful GETs a strong ETag so polling clients can get a 304"""
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed:
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        response = response.make_conditional(request)
+    return response
+
+
+def _fields(available, default):
+    """The fields asked for with ?fields=, in order, or the default set"""
+    requested = request.args.get('fields')
+    if not requested:
+        return list(default)
+    names = list(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}")
+    return names
+
+
+def _columns(available, fields, *required):
+    """Columns to select for the fields; required ones (ids, sort keys) are always included"""
+    columns = list(required)
+    for name in fields:
+        column = available[name]
+        if column is not None and not any(column is c for c in columns):
+            columns.append(column)
+    return columns
+
+
+def _ids(value):
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        abort(400, description='ids must be a comma-separated list of integers.')
+    if len(ids) > MAX_IDS:
+        abort(400, description=f'At most {MAX_IDS} ids can be looked up at once.')
+    return ids
+
+
+def _limit():
+    limit = request.args.get('limit', current_app.config['BOOKS_PER_PAGE'], type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _page(page, serialize):
+    return jsonify(items=serialize(page.items), next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+
+def _genres_query(book_ids):
+    """(book_id, genre id, genre name) rows for a page of books, in one query"""
+    return db.session.query(book_genre.c.book_id, Genre.id, Genre.name).join(
+        Genre, Genre.id == book_genre.c.genre_id
+    ).filter(book_genre.c.book_id.in_(book_ids)).order_by(Genre.name)
+
+
+def _serialize_books(rows, fields, genre_rows=None):
+    """Book dicts for the fields; genre_rows are fetched here unless the caller already did"""
+    genres = {}
+    if 'genres' in fields:
+        genres = {row.id: [] for row in rows}
+        if genre_rows is None:
+            genre_rows = _genres_query(list(genres)) if genres else []
+        for book_id, genre_id, name in genre_rows:
+            genres[book_id].append({'id': genre_id, 'name': name})
+    items = []
+    for row in rows:
+        item = {}
+        for name in fields:
+            if name == 'genres':
+                item[name] = genres[row.id]
+            elif name == 'cover_url':
+                item[name] = cover_url(row.cover_image)
+            else:
+                item[name] = _value(getattr(row, name))
+        items.append(item)
+    return items
+
+
+def _serialize(rows, fields):
+    return [{name: _value(getattr(row, name)) for name in fields} for row in rows]
+
+
+def _book_rows(fields, *required):
+    """Query of plain rows (no Book objects) carrying the columns the fields need"""
+    return db.session.query(*_columns(BOOK_FIELDS, fields, Book.id, *required))
+
+
+@api_bp.route('/books')
+def books():
+    """List books with cursor pagination, or look up ?ids=1,2,3 in one query"""
+    fields = _fields(BOOK_FIELDS, BOOK_DEFAULT_FIELDS)
+
+    if request.args.get('ids'):
+        ids = _ids(request.args['ids'])
+        rows = {row.id: row for row in _book_rows(fields).filter(Book.id.in_(ids))} if ids else {}
+        found = [rows[book_id] for book_id in ids if book_id in rows]
+        return jsonify(items=_serialize_books(found, fields),
+                       missing=[book_id for book_id in ids if book_id not in rows])
+
+    query, columns, descending = _book_listing(fields)
+    page = keyset_paginate(query, columns, per_page=_limit(),
+                           after=request.args.get('after'), before=request.args.get('before'),
+                           descending=descending)
+    return _page(page, lambda rows: _serialize_books(rows, fields))
+
+
+def _book_listing(fields):
+    """(query, keyset columns, descending) for the sort and filters in the request"""
+    sort_by = request.args.get('sort', 'title')
+    if sort_by not in BOOK_SORT_KEYS:
+        abort(400, description=f"sort must be one of {', '.join(BOOK_SORT_KEYS)}.")
+    columns, descending = BOOK_SORT_KEYS[sort_by]
+    query = _book_rows(fields, *columns)
+
+    genre_id = request.args.get('genre', None, type=int)
+    if genre_id:
+        query = query.join(book_genre, book_genre.c.book_id == Book.id).filter(book_genre.c.genre_id == genre_id)
+    available = request.args.get('available')
+    if available == 'yes':
+        query = query.filter(Book.available_copies > 0)
+    elif available == 'no':
+        query = query.filter(Book.available_copies == 0)
+    return query, columns, descending
+
+
+@api_bp.route('/books/<int:id>')
+def book(id):
+    """One book"""
+    fields = _fields(BOOK_FIELDS, BOOK_FIELDS)
+    row = _book_rows(fields).filter(Book.id == id).first()
+    if row is None:
+        abort(404, description='Book not found.')
+    return jsonify(_serialize_books([row], fields)[0])
+
+
+@api_bp.route('/genres')
+def genres():
+    """Every genre with its book count"""
+    fields = _fields(GENRE_FIELDS, GENRE_FIELDS)
+    return jsonify(items=_serialize(_genre_rows(fields), fields))
+
+
+def _genre_rows(fields):
+    return db.session.query(*_columns(GENRE_FIELDS, fields, Genre.id)).outerjoin(
+        GenreStats, GenreStats.genre_id == Genre.id
+    ).order_by(Genre.name)
+
+
+@api_bp.route('/search')
+def search():
+    """Full-text search, best matches first, with cursor pagination
+
+    ?mode=fuzzy matches titles and authors by trigram similarity instead,
+    so misspelt words still find the book.
+    """
+    fields = _fields(BOOK_FIELDS, BOOK_DEFAULT_FIELDS)
+    query = _search_query()
+
+    def load(book_ids):
+        return {row.id: row for row in _book_rows(fields).filter(Book.id.in_(book_ids))}
+
+    page = search_books(query, per_page=_limit(), after=request.args.get('after'),
+                        before=request.args.get('before'), load=load, fuzzy=_fuzzy())
+    return _page(page, lambda rows: _serialize_books(rows, fields))
+
+
+def _search_query():
+    query = request.args.get('q', '')
+    if not query.strip():
+        abort(400, description='q is required.')
+    return query
+
+
+def _fuzzy():
+    mode = request.args.get('mode', 'exact')
+    if mode not in ('exact', 'fuzzy'):
+        abort(400, description='mode must be exact or fuzzy.')
+    return mode == 'fuzzy'
+
+
+@api_bp.route('/loans')
+@api_login_required
+def loans():
+    """The current user's loans (admins may pass ?user_id=), newest first
+
+    ?status= is active (default), overdue or all.
+    """
+    fields = _fields(LOAN_FIELDS, LOAN_FIELDS)
+    user_id = request.args.get('user_id', current_user.id, type=int)
+    if user_id != current_user.id:
+        _require_admin()
+
+    query = db.session.query(*_columns(LOAN_FIELDS, fields, Loan.id)).filter(Loan.user_id == user_id)
+    if 'title' in fields:
+        query = query.join(Book, Book.id == Loan.book_id)
+    status = request.args.get('status', 'active')
+    if status == 'active':
+        query = query.filter(Loan.returned == False)
+    elif status == 'overdue':
+        query = query.filter(Loan.returned == False, Loan.due_date < datetime.utcnow())
+    elif status != 'all':
+        abort(400, description='status must be active, overdue or all.')
+
+    page = keyset_paginate(query, (Loan.id,), per_page=_limit(),
+                           after=request.args.get('after'), before=request.args.get('before'),
+                           descending=True)
+    return _page(page, lambda rows: _serialize(rows, fields))
+
+
+def _book_ids_from_body():
+    data = request.get_json(silent=True)
+    if not request.is_json or not isinstance(data, dict):
+        abort(415, description='Send a JSON object such as {"book_ids": [1, 2, 3]}.')
+    book_ids = data.get('book_ids')
+    if not isinstance(book_ids, list) or not book_ids or not all(
+            isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in book_ids):
+        abort(400, description='book_ids must be a non-empty list of integers.')
+    return book_ids
+
+
+def _circulate(action):
+    try:
+        results = action(current_user.id, _book_ids_from_body())
+    except ValueError as e:
+        abort(400, description=str(e))
+    except CirculationError as e:
+        abort(503 if e.busy else 409, description=str(e))
+    for result in results:
+        if 'due_date' in result:
+            result['due_date'] = _value(result['due_date'])
+    return jsonify(results=results)
+
+
+@api_bp.route('/loans/checkout', methods=['POST'])
+@api_login_required
+def checkout():
+    """Check out several books for the current user in one transaction"""
+    return _circulate(checkout_books)
+
+
+@api_bp.route('/loans/return', methods=['POST'])
+@api_login_required
+def return_loans():
+    """Return several of the current user's books in one transaction"""
+    return _circulate(return_books)
+
+
+def _hold(book_id, title, user_id):
+    status = holds.hold_status(holds.book_queue(book_id), user_id)
+    if status is None:
+        return None
+    return dict(book_id=book_id, title=title, status=status['status'], position=status['position'],
+                queue_length=status['queue_length'], expires_at=_value(status['expires_at']))
+
+
+@api_bp.route('/holds')
+@api_login_required
+def hold_list():
+    """The current user's active holds with their place in each queue, oldest first"""
+    rows = db.session.query(Hold.book_id, Book.title).join(Book, Book.id == Hold.book_id).filter(
+        Hold.user_id == current_user.id, Hold.status.in_(holds.ACTIVE)
+    ).order_by(Hold.id).all()
+    items = [_hold(book_id, title, current_user.id) for book_id, title in rows]
+    return jsonify(items=[item for item in items if item is not None])
+
+
+@api_bp.route('/holds/<int:book_id>')
+@api_login_required
+def hold(book_id):
+    """The current user's place in one book's queue, served from the queue cache"""
+    title = db.session.query(Book.title).filter(Book.id == book_id).scalar()
+    if title is None:
+        abort(404, description='Book not found.')
+    item = _hold(book_id, title, current_user.id)
+    if item is None:
+        abort(404, description='You have no hold on this book.')
+    return jsonify(item)
+
+
+def _serialize_users(rows, fields):
+    stats = {}
+    if 'active_loans' in fields or 'overdue_loans' in fields:
+        stats = LoanStats.for_users([row.id for row in rows])
+    return [{name: getattr(stats[row.id], name) if name in ('active_loans', 'overdue_loans')
+             else _value(getattr(row, name)) for name in fields} for row in rows]
+
+
+@api_bp.route('/users')
+@api_login_required
+def users():
+    """Every user, by id, with cursor pagination (admin only)"""
+    _require_admin()
+    fields = _fields(USER_FIELDS, USER_DEFAULT_FIELDS)
+    query = db.session.query(*_columns(USER_FIELDS, fields, User.id))
+    page = keyset_paginate(query, (User.id,), per_page=_limit(),
+                           after=request.args.get('after'), before=request.args.get('before'))
+    return _page(page, lambda rows: _serialize_users(rows, fields))
+
+
+@api_bp.route('/users/me')
+@api_login_required
+def me():
+    """The current user"""
+    return user(current_user.id)
+
+
+@api_bp.route('/users/<int:id>')
+@api_login_required
+def user(id):
+    """One user (admin or self only)"""
+    if id != current_user.id:
+        _require_admin()
+    fields = _fields(USER_FIELDS, USER_DEFAULT_FIELDS)
+    row = db.session.query(*_columns(USER_FIELDS, fields, User.id)).filter(User.id == id).first()
+    if row is None:
+        abort(404, description='User not found.')
+    return jsonify(_serialize_users([row], fields)[0])
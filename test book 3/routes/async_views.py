@@ -0,0 +1,215 @@
+"""Async versions of the read-heavy views, used when serving through asgi.py
+
+Each coroutine mirrors the sync view registered under the same endpoint and
+renders the same template, but reads the database through async_db, so a
+request waiting on a query does not hold a thread. Fragments that are
+already cached are pinned first and their queries skipped, as the lazily
+evaluated queries of the sync views are.
+"""
+from flask import render_template, request, current_app, abort, jsonify
+from flask_login import current_user
+from sqlalchemy import select, func
+from sqlalchemy.orm import selectinload
+from app import async_db, cache
+from models.book import Book, Genre
+from models.loan import Loan, LoanStats
+from models.stats import LibraryStats
+from services.asgi import async_view, run_in_thread
+from services.facets import BookFilters, FacetCounts, facet_counts_statement, FACET_TAGS
+from services.pagination import keyset_paginate_async
+from services.search import search_books_async
+from services import holds
+from services.stats import STATS_ID, get_library_stats, get_popular_genres
+from services.rollups import trending_books
+from routes.books import SORT_KEYS
+from routes import api
+
+
+@async_view('main.index')
+async def index():
+    async with async_db.session() as session:
+        user_stats = None
+        if current_user.is_authenticated:
+            statement = LoanStats.statement(current_user.id, due_soon_days=current_app.config['NOTICE_DUE_SOON_DAYS'])
+            user_stats = LoanStats.from_row(current_user.id, (await session.execute(statement)).one())
+
+        stats = await session.get(LibraryStats, STATS_ID)
+        if stats is None:
+            # First request on a new database builds the summary row
+            await run_in_thread(get_library_stats)
+            stats = await session.get(LibraryStats, STATS_ID)
+
+        popular_genres = trending = recent_books = None
+        if not cache.pin_fragment('main.popular_genres'):
+            popular_genres = (await session.execute(get_popular_genres(limit=5).statement)).all()
+        if not cache.pin_fragment('main.trending'):
+            trending = (await session.execute(trending_books(limit=4).statement)).all()
+        if not cache.pin_fragment('main.recent_books'):
+            recent_books = (await session.execute(
+                select(Book).options(selectinload(Book.genres)).order_by(Book.added_date.desc()).limit(8)
+            )).scalars().all()
+
+    return render_template('index.html',
+                           recent_books=recent_books,
+                           user_stats=user_stats,
+                           total_books=stats.total_books,
+                           total_genres=stats.total_genres,
+                           books_on_loan=stats.books_on_loan,
+                           popular_genres=popular_genres,
+                           trending_books=trending)
+
+
+@async_view('books.index')
+async def books_index():
+    filters = BookFilters.from_args(request.args)
+    sort_by = request.args.get('sort', 'title', type=str)
+    if sort_by not in SORT_KEYS:
+        sort_by = 'title'
+    after, before = request.args.get('after'), request.args.get('before')
+
+    async with async_db.session() as session:
+        if filters.genres:
+            known = (await session.execute(
+                select(func.count(Genre.id)).where(Genre.id.in_(filters.genres)))).scalar()
+            if known < len(filters.genres):
+                abort(404)
+
+        facets = books = None
+        if not cache.pin_fragment('books.facets', filters=filters.key, sort=sort_by):
+            facets = FacetCounts(filters, (await session.execute(facet_counts_statement(filters))).all())
+        if not cache.pin_fragment('books.index', filters=filters.key, sort=sort_by, after=after, before=before):
+            statement = select(Book).options(selectinload(Book.genres)).where(*filters.conditions())
+            columns, descending = SORT_KEYS[sort_by]
+            books = await keyset_paginate_async(session, statement, columns,
+                                                per_page=current_app.config['BOOKS_PER_PAGE'],
+                                                after=after, before=before,
+                                                descending=descending, scalars=True)
+
+    return render_template('books/index.html',
+                           books=books,
+                           facets=facets,
+                           filters=filters,
+                           facet_tags=FACET_TAGS,
+                           cache_tags=filters.cache_tags(),
+                           sort_by=sort_by)
+
+
+@async_view('books.show')
+async def books_show(id):
+    async with async_db.session() as session:
+        book = (await session.execute(
+            select(Book).options(selectinload(Book.genres)).where(Book.id == id)
+        )).scalar_one_or_none()
+        if book is None:
+            abort(404)
+        user_has_book = False
+        hold = None
+        if current_user.is_authenticated:
+            user_has_book = (await session.execute(select(
+                select(Loan.id).where(Loan.user_id == current_user.id, Loan.book_id == id,
+                                      Loan.returned == False).exists()
+            ))).scalar()
+            if not user_has_book:
+                queue = holds.cached_queue(id)
+                if queue is None:
+                    queue = holds.store_queue(id, (await session.execute(holds.queue_statement(id))).all())
+                hold = holds.hold_status(queue, current_user.id)
+
+    return render_template('books/show.html', book=book, user_has_book=user_has_book, hold=hold)
+
+
+async def _load_books(session, book_ids):
+    books = (await session.execute(
+        select(Book).options(selectinload(Book.genres)).where(Book.id.in_(book_ids))
+    )).scalars()
+    return {book.id: book for book in books}
+
+
+@async_view('main.search')
+async def search():
+    query = request.args.get('query', '')
+    mode = 'fuzzy' if request.args.get('mode') == 'fuzzy' else None
+    if not query:
+        return render_template('search.html', books=[], query='', mode=mode)
+
+    per_page = current_app.config['BOOKS_PER_PAGE']
+    async with async_db.session() as session:
+        def load(book_ids):
+            return _load_books(session, book_ids)
+
+        books = await search_books_async(session, query, load, per_page=per_page,
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'),
+                                         fuzzy=mode == 'fuzzy')
+        close_matches = None
+        if not mode and not len(books) and not request.args.get('after') and not request.args.get('before'):
+            close_matches = await search_books_async(session, query, load, per_page=per_page, fuzzy=True)
+    return render_template('search.html', books=books, query=query, mode=mode, close_matches=close_matches)
+
+
+async def _book_items(session, rows, fields):
+    """Serialise API book rows, fetching their genres on the async session"""
+    genre_rows = None
+    if 'genres' in fields:
+        book_ids = [row.id for row in rows]
+        genre_rows = (await session.execute(api._genres_query(book_ids).statement)).all() if book_ids else []
+    return api._serialize_books(rows, fields, genre_rows)
+
+
+@async_view('api.books')
+async def api_books():
+    fields = api._fields(api.BOOK_FIELDS, api.BOOK_DEFAULT_FIELDS)
+    async with async_db.session() as session:
+        if request.args.get('ids'):
+            ids = api._ids(request.args['ids'])
+            rows = {}
+            if ids:
+                result = await session.execute(api._book_rows(fields).filter(Book.id.in_(ids)).statement)
+                rows = {row.id: row for row in result}
+            found = [rows[book_id] for book_id in ids if book_id in rows]
+            return jsonify(items=await _book_items(session, found, fields),
+                           missing=[book_id for book_id in ids if book_id not in rows])
+
+        query, columns, descending = api._book_listing(fields)
+        page = await keyset_paginate_async(session, query.statement, columns, per_page=api._limit(),
+                                           after=request.args.get('after'),
+                                           before=request.args.get('before'),
+                                           descending=descending)
+        items = await _book_items(session, page.items, fields)
+    return jsonify(items=items, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+
+@async_view('api.book')
+async def api_book(id):
+    fields = api._fields(api.BOOK_FIELDS, api.BOOK_FIELDS)
+    async with async_db.session() as session:
+        row = (await session.execute(api._book_rows(fields).filter(Book.id == id).statement)).first()
+        if row is None:
+            abort(404, description='Book not found.')
+        items = await _book_items(session, [row], fields)
+    return jsonify(items[0])
+
+
+@async_view('api.genres')
+async def api_genres():
+    fields = api._fields(api.GENRE_FIELDS, api.GENRE_FIELDS)
+    async with async_db.session() as session:
+        rows = (await session.execute(api._genre_rows(fields).statement)).all()
+    return jsonify(items=api._serialize(rows, fields))
+
+
+@async_view('api.search')
+async def api_search():
+    fields = api._fields(api.BOOK_FIELDS, api.BOOK_DEFAULT_FIELDS)
+    query = api._search_query()
+
+    async with async_db.session() as session:
+        async def load(book_ids):
+            result = await session.execute(api._book_rows(fields).filter(Book.id.in_(book_ids)).statement)
+            return {row.id: row for row in result}
+
+        page = await search_books_async(session, query, load, per_page=api._limit(),
+                                        after=request.args.get('after'), before=request.args.get('before'),
+                                        fuzzy=api._fuzzy())
+        items = await _book_items(session, page.items, fields)
+    return jsonify(items=items, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
@@ -4,6 +4,7 @@ from werkzeug.urls import url_parse
 from models.user import User
 from app import db
 from forms.auth import LoginForm, RegistrationForm
+from services.passwords import PasswordsBusy
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -16,10 +17,17 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except PasswordsBusy as e:
+            flash(str(e), 'warning')
+            return redirect(url_for('auth.login'))
+        if not valid:
             flash('Invalid username or password', 'danger')
             return redirect(url_for('auth.login'))
         
+        # Saves the upgraded hash if check_password rehashed it
+        db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
@@ -51,7 +59,11 @@ def register():
             first_name=form.first_name.data,
             last_name=form.last_name.data
         )
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except PasswordsBusy as e:
+            flash(str(e), 'warning')
+            return render_template('auth/register.html', form=form)
         
         # Make the first user an admin
         if User.query.count() == 0:
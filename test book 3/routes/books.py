@@ -1,59 +1,72 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, abort
 from flask_login import login_required, current_user
-from app import db
+from app import db, cache, covers
 from models.book import Book, Genre
 from models.loan import Loan
-from forms.book import BookForm, SearchForm
-from werkzeug.utils import secure_filename
-import os
-from datetime import datetime
+from models.hold import Hold, READY
+from forms.book import BookForm, BookImportForm, SearchForm
+from services.pagination import keyset_paginate
+from services.streaming import stream_template
+from services.stats import adjust_stats, adjust_genre_counts, book_on_loan
+from services.importer import import_books, detect_format
+from services.covers import stage_upload, release_cover
+from services.circulation import checkout_books, return_books, CirculationError
+from services.facets import BookFilters, FacetCounts, facet_counts_statement, FACET_TAGS
+from services import holds
+from services.cache import book_tag, genre_tag, BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
 
 books_bp = Blueprint('books', __name__)
 
+# Keyset columns for each sort order; the trailing id makes every key unique
+SORT_KEYS = {
+    'title': ((Book.title, Book.id), False),
+    'author': ((Book.author, Book.id), False),
+    'newest': ((Book.added_date, Book.id), True)
+}
+
 @books_bp.route('/books')
 def index():
-    """Display all books with pagination and filtering"""
-    page = request.args.get('page', 1, type=int)
-    genre_id = request.args.get('genre', None, type=int)
-    availability = request.args.get('available', None, type=str)
+    """Display books with faceted filtering and keyset pagination"""
+    filters = BookFilters.from_args(request.args)
     sort_by = request.args.get('sort', 'title', type=str)
+    if sort_by not in SORT_KEYS:
+        sort_by = 'title'
     
-    # Base query
-    query = Book.query
+    if filters.genres and Genre.query.filter(Genre.id.in_(filters.genres)).count() < len(filters.genres):
+        abort(404)
     
-    # Apply filters
-    if genre_id:
-        genre = Genre.query.get_or_404(genre_id)
-        query = genre.books
+    # Any of the selected genres, publishers and so on; a subquery keeps each book once
+    query = Book.query.filter(*filters.conditions())
     
-    if availability == 'yes':
-        query = query.filter(Book.available_copies > 0)
-    elif availability == 'no':
-        query = query.filter(Book.available_copies == 0)
+    # Load every card's genres in one extra query rather than one per book
+    query = query.options(selectinload(Book.genres))
     
-    # Apply sorting
-    if sort_by == 'title':
-        query = query.order_by(Book.title)
-    elif sort_by == 'author':
-        query = query.order_by(Book.author)
-    elif sort_by == 'newest':
-        query = query.order_by(Book.added_date.desc())
+    # Seek past the cursor instead of COUNT + OFFSET, so deep pages stay cheap
+    columns, descending = SORT_KEYS[sort_by]
+    books = keyset_paginate(query, columns,
+                            per_page=current_app.config['BOOKS_PER_PAGE'],
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            descending=descending)
     
-    # Paginate
-    books = query.paginate(page=page, per_page=current_app.config['BOOKS_PER_PAGE'])
-    genres = Genre.query.order_by(Genre.name).all()
+    # Every facet's counts in one query, run only if the sidebar is not cached
+    statement = facet_counts_statement(filters)
+    facets = FacetCounts(filters, lambda: db.session.execute(statement).all())
     
-    return render_template('books/index.html', 
+    return stream_template('books/index.html', 
                            books=books,
-                           genres=genres,
-                           current_genre=genre_id,
-                           availability=availability,
+                           facets=facets,
+                           filters=filters,
+                           facet_tags=FACET_TAGS,
+                           cache_tags=filters.cache_tags(),
                            sort_by=sort_by)
 
 @books_bp.route('/books/<int:id>')
 def show(id):
     """Display details for a specific book"""
-    book = Book.query.get_or_404(id)
+    book = Book.query.options(selectinload(Book.genres)).get_or_404(id)
     # Check if user has this book on loan
     user_has_book = False
     if current_user.is_authenticated:
@@ -64,7 +77,12 @@ def show(id):
         ).first()
         user_has_book = loan is not None
     
-    return render_template('books/show.html', book=book, user_has_book=user_has_book)
+    # The patron's place in the queue comes from the cached queue, not the holds table
+    hold = None
+    if current_user.is_authenticated and not user_has_book:
+        hold = holds.hold_status(holds.book_queue(book.id), current_user.id)
+    
+    return render_template('books/show.html', book=book, user_has_book=user_has_book, hold=hold)
 
 @books_bp.route('/books/new', methods=['GET', 'POST'])
 @login_required
@@ -89,13 +107,13 @@ def new():
             available_copies=form.total_copies.data
         )
         
-        # Handle cover image upload
+        # Stage the cover under its content hash; thumbnails are rendered after commit
         if form.cover_image.data:
-            filename = secure_filename(form.cover_image.data.filename)
-            # Create unique filename
-            filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            form.cover_image.data.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-            book.cover_image = filename
+            try:
+                book.cover_image = stage_upload(form.cover_image.data, current_app.config['UPLOAD_FOLDER'])
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return render_template('books/new.html', form=form)
         
         # Add selected genres
         for genre_id in form.genres.data:
@@ -104,13 +122,49 @@ def new():
                 book.genres.append(genre)
         
         db.session.add(book)
+        
+        # Keep the dashboard counters in step
+        adjust_genre_counts(added=[genre.id for genre in book.genres])
+        adjust_stats(total_books=1)
+        
         db.session.commit()
+        covers.submit(book.id, book.cover_image)
+        
+        # Drop cached listings the new book now belongs to
+        tags = [BOOKS_TAG, AVAILABILITY_TAG] + [genre_tag(genre.id) for genre in book.genres]
+        if book.genres:
+            tags.append(GENRES_TAG)
+        cache.invalidate(*tags)
         
         flash('Book added successfully!', 'success')
         return redirect(url_for('books.show', id=book.id))
     
     return render_template('books/new.html', form=form)
 
+@books_bp.route('/books/import', methods=['GET', 'POST'])
+@login_required
+def bulk_import():
+    """Bulk-load books from an uploaded catalog file (admin only)"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access this page.', 'danger')
+        return redirect(url_for('books.index'))
+    
+    form = BookImportForm()
+    result = None
+    
+    if form.validate_on_submit():
+        upload = form.file.data
+        format = form.format.data or detect_format(upload.filename)
+        if format is None:
+            flash('Could not tell the file format from its name, please pick one.', 'danger')
+            return render_template('books/import.html', form=form, result=None)
+        
+        # The upload is read straight from its spooled temp file, chunk by chunk
+        result = import_books(upload.stream, format, create_genres=form.create_genres.data)
+        flash(f'Import finished: {result.summary()}.', 'success' if result.imported else 'warning')
+    
+    return render_template('books/import.html', form=form, result=result)
+
 @books_bp.route('/books/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit(id):
@@ -124,6 +178,22 @@ def edit(id):
     form.genres.choices = [(g.id, g.name) for g in Genre.query.order_by(Genre.name)]
     
     if form.validate_on_submit():
+        was_on_loan = book_on_loan(book)
+        was_available = book.is_available()
+        old_genres = {genre.id for genre in book.genres}
+        old_sort_keys = (book.title, book.author)
+        old_facets = (book.publisher, book.publication_year)
+        
+        # Copies change with relative UPDATEs, so a concurrent checkout's
+        # take_copy is never overwritten; added copies go to the hold queue first
+        delta = form.total_copies.data - book.total_copies
+        promoted = 0
+        if delta and not Book.change_total_copies(book.id, delta):
+            flash('Cannot reduce total copies below the number currently on loan.', 'danger')
+        elif delta > 0:
+            promoted = holds.add_copies(book.id, delta, current_app.config['HOLD_PICKUP_DAYS'])
+        db.session.refresh(book, ['total_copies', 'available_copies'])
+        
         book.title = form.title.data
         book.author = form.author.data
         book.isbn = form.isbn.data
@@ -131,31 +201,17 @@ def edit(id):
         book.publication_year = form.publication_year.data
         book.description = form.description.data
         
-        # Update copies (handle potential conflicts with loans)
-        new_total = form.total_copies.data
-        current_on_loan = book.total_copies - book.available_copies
-        
-        if new_total < current_on_loan:
-            flash('Cannot reduce total copies below the number currently on loan.', 'danger')
-        else:
-            book.total_copies = new_total
-            book.available_copies = new_total - current_on_loan
-        
-        # Handle cover image upload
+        # Stage the new cover under its content hash; thumbnails are rendered after commit
         if form.cover_image.data:
-            filename = secure_filename(form.cover_image.data.filename)
-            # Create unique filename
-            filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            form.cover_image.data.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-            
-            # Remove old image if it's not the default
-            if book.cover_image != 'default_cover.jpg':
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], book.cover_image))
-                except:
-                    pass
-                    
-            book.cover_image = filename
+            try:
+                cover = stage_upload(form.cover_image.data, current_app.config['UPLOAD_FOLDER'])
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), 'danger')
+                return render_template('books/edit.html', form=form, book=book)
+            if cover != book.cover_image:
+                release_cover(book.cover_image, current_app.config['UPLOAD_FOLDER'])
+                book.cover_image = cover
         
         # Update genres
         book.genres = []
@@ -164,7 +220,29 @@ def edit(id):
             if genre:
                 book.genres.append(genre)
         
+        # Keep the dashboard counters in step
+        new_genres = {genre.id for genre in book.genres}
+        adjust_genre_counts(added=new_genres - old_genres, removed=old_genres - new_genres)
+        adjust_stats(books_on_loan=book_on_loan(book) - was_on_loan)
+        
         db.session.commit()
+        covers.submit(book.id, book.cover_image)
+        
+        # Drop only the cached pages this edit can affect
+        tags = {book_tag(book.id)}
+        if (book.title, book.author) != old_sort_keys:
+            tags.update([BOOKS_TAG, AVAILABILITY_TAG] + [genre_tag(genre_id) for genre_id in new_genres])
+        if new_genres != old_genres:
+            tags.add(GENRES_TAG)
+            tags.update(genre_tag(genre_id) for genre_id in new_genres ^ old_genres)
+        if book.is_available() != was_available:
+            tags.add(AVAILABILITY_TAG)
+        if (book.publisher, book.publication_year) != old_facets:
+            tags.add(FACETS_TAG)
+        cache.invalidate(*tags)
+        if promoted:
+            holds.invalidate_holds(book.id)
+        
         flash('Book updated successfully!', 'success')
         return redirect(url_for('books.show', id=book.id))
     
@@ -188,15 +266,22 @@ def delete(id):
         flash('Cannot delete book while copies are on loan.', 'danger')
         return redirect(url_for('books.show', id=book.id))
     
-    # Remove cover image if it's not the default
-    if book.cover_image != 'default_cover.jpg':
-        try:
-            os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], book.cover_image))
-        except:
-            pass
+    # Remove the cover file unless other books can share it
+    release_cover(book.cover_image, current_app.config['UPLOAD_FOLDER'])
     
+    genre_ids = [genre.id for genre in book.genres]
+    Hold.query.filter_by(book_id=book.id).delete()
     db.session.delete(book)
+    
+    # Keep the dashboard counters in step
+    adjust_genre_counts(removed=genre_ids)
+    adjust_stats(total_books=-1)
+    
     db.session.commit()
+    cache.invalidate(book_tag(id), BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG,
+                     *[genre_tag(genre_id) for genre_id in genre_ids])
+    
+    holds.invalidate_holds(id)
     
     flash('Book deleted successfully!', 'success')
     return redirect(url_for('books.index'))
@@ -207,55 +292,93 @@ def checkout(id):
     """Check out a book"""
     book = Book.query.get_or_404(id)
     
-    # Check if book is available
-    if not book.is_available():
-        flash('This book is not available for checkout.', 'danger')
+    # The same path as a self-service batch of one: holds, stats and caches included
+    try:
+        result = checkout_books(current_user.id, [book.id])[0]
+    except CirculationError as e:
+        # Not busy means a concurrent request from the same user won the
+        # unique index on active loans
+        flash(str(e) if e.busy else 'You already have this book checked out.', 'warning')
         return redirect(url_for('books.show', id=book.id))
     
-    # Check if user already has this book
-    existing_loan = Loan.query.filter_by(
-        user_id=current_user.id,
-        book_id=book.id,
-        returned=False
-    ).first()
-    
-    if existing_loan:
+    if result['status'] == 'already_borrowed':
         flash('You already have this book checked out.', 'warning')
         return redirect(url_for('books.show', id=book.id))
+    if result['status'] != 'checked_out':
+        flash('This book is not available for checkout. You can place a hold instead.', 'danger')
+        return redirect(url_for('books.show', id=book.id))
     
-    # Create new loan
-    loan = Loan(user_id=current_user.id, book_id=book.id)
-    
-    # Update book availability
-    book.reduce_available_copies()
-    
-    db.session.add(loan)
-    db.session.commit()
-    
-    flash(f'You have checked out "{book.title}". It is due back on {loan.due_date.strftime("%B %d, %Y")}.', 'success')
+    flash(f'You have checked out "{book.title}". It is due back on {result["due_date"].strftime("%B %d, %Y")}.', 'success')
     return redirect(url_for('auth.profile'))
 
 @books_bp.route('/books/<int:id>/return', methods=['POST'])
 @login_required
 def return_book(id):
     """Return a book"""
-    loan = Loan.query.filter_by(
-        user_id=current_user.id,
-        book_id=id,
-        returned=False
-    ).first_or_404()
-    
     book = Book.query.get_or_404(id)
     
-    # Mark as returned and update book availability
-    loan.return_book()
-    book.increase_available_copies()
+    try:
+        result = return_books(current_user.id, [book.id])[0]
+    except CirculationError as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('auth.profile'))
     
-    db.session.commit()
+    # The loan is closed with a conditional UPDATE, so a double-submitted
+    # return lands here rather than adding a copy twice
+    if result['status'] != 'returned':
+        flash('This book has already been returned.', 'info')
+        return redirect(url_for('auth.profile'))
     
     flash(f'You have returned "{book.title}".', 'success')
     return redirect(url_for('auth.profile'))
 
+@books_bp.route('/books/<int:id>/hold', methods=['POST'])
+@login_required
+def hold(id):
+    """Join the hold queue for a book with no copy free"""
+    book = Book.query.get_or_404(id)
+    
+    try:
+        holds.place_hold(current_user.id, book.id)
+        db.session.commit()
+    except holds.HoldError as e:
+        db.session.rollback()
+        flash(str(e), 'warning')
+        return redirect(url_for('books.show', id=book.id))
+    except OperationalError:
+        db.session.rollback()
+        flash('The library is busy right now, please try again in a moment.', 'warning')
+        return redirect(url_for('books.show', id=book.id))
+    
+    holds.invalidate_holds(book.id)
+    status = holds.hold_status(holds.book_queue(book.id), current_user.id)
+    flash(f'You are number {status["position"]} in line for "{book.title}". '
+          f'We will email you when a copy is ready.', 'success')
+    return redirect(url_for('books.show', id=book.id))
+
+@books_bp.route('/books/<int:id>/hold/cancel', methods=['POST'])
+@login_required
+def cancel_hold(id):
+    """Leave the hold queue for a book"""
+    book = Book.query.get_or_404(id)
+    
+    try:
+        previous = holds.cancel_hold(current_user.id, book.id, current_app.config['HOLD_PICKUP_DAYS'])
+        db.session.commit()
+    except OperationalError:
+        db.session.rollback()
+        flash('The library is busy right now, please try again in a moment.', 'warning')
+        return redirect(url_for('books.show', id=book.id))
+    
+    if previous is None:
+        flash('You have no hold on this book.', 'info')
+        return redirect(url_for('books.show', id=book.id))
+    
+    # A copy set aside for this patron went to the next one or back on the shelf
+    holds.invalidate_holds(book.id, shelved=[book.id] if previous == READY else [])
+    flash(f'Your hold on "{book.title}" has been cancelled.', 'success')
+    return redirect(url_for('books.show', id=book.id))
+
 @books_bp.route('/books/<int:id>/renew', methods=['POST'])
 @login_required
 def renew(id):
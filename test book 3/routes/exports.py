@@ -0,0 +1,33 @@
+from flask import Blueprint, Response, redirect, url_for, flash, request, abort, stream_with_context
+from flask_login import login_required, current_user
+from services.export import DATASETS, FORMATS, check_format, export_rows, export_watermark, parse_watermark
+from datetime import datetime
+
+exports_bp = Blueprint('exports', __name__)
+
+@exports_bp.route('/export/<dataset>.<format>')
+@login_required
+def export(dataset, format):
+    """Stream a full or incremental export of books, loans or users (admin only)"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access this page.', 'danger')
+        return redirect(url_for('main.index'))
+    
+    if dataset not in DATASETS or format not in FORMATS:
+        abort(404)
+    try:
+        check_format(format)
+        since = parse_watermark(request.args.get('since'))
+    except ValueError as e:
+        abort(400, description=str(e))
+    
+    # Pin the upper bound now; pass it back as ?since= on the next sync
+    until = export_watermark(dataset, since)
+    
+    filename = f"{dataset}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{format}"
+    response = Response(stream_with_context(export_rows(dataset, format, since=since, until=until)),
+                        mimetype=FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if until is not None:
+        response.headers['X-Export-Watermark'] = until.isoformat()
+    return response
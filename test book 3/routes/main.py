@@ -1,64 +1,81 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, current_app, jsonify, url_for
 from flask_login import current_user
+from sqlalchemy.orm import selectinload
 from models.book import Book, Genre
-from models.loan import Loan
-from sqlalchemy import func
-import datetime
+from app import cache
+from services.cache import BOOKS_TAG
+from services.search import search_books, suggest_books
+from services.streaming import stream_template
+from services.stats import get_library_stats, get_popular_genres
+from services.rollups import trending_books
 
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/')
 def index():
     """Home page showing dashboard with stats and recently added books"""
-    # Recently added books
-    recent_books = Book.query.order_by(Book.added_date.desc()).limit(8).all()
+    # Recently added books, left as a query so it only runs on a fragment cache miss
+    recent_books = Book.query.options(selectinload(Book.genres)).order_by(Book.added_date.desc()).limit(8)
     
     # Statistics for logged-in users
     user_stats = None
     if current_user.is_authenticated:
-        active_loans = Loan.query.filter_by(user_id=current_user.id, returned=False).all()
-        overdue_loans = [loan for loan in active_loans if loan.is_overdue()]
-        user_stats = {
-            'active_loans': len(active_loans),
-            'overdue_loans': len(overdue_loans)
-        }
+        user_stats = current_user.loan_stats(due_soon_days=current_app.config['NOTICE_DUE_SOON_DAYS'])
     
-    # General statistics
-    total_books = Book.query.count()
-    total_genres = Genre.query.count()
-    books_on_loan = Book.query.filter(Book.available_copies < Book.total_copies).count()
-    
-    # Popular genres
-    popular_genres = db.session.query(
-        Genre.name,
-        func.count(book_genre.c.book_id).label('book_count')
-    ).join(book_genre).group_by(Genre.name).order_by(
-        func.count(book_genre.c.book_id).desc()
-    ).limit(5).all()
+    # General statistics, read from the precomputed summary tables
+    stats = get_library_stats()
+    popular_genres = get_popular_genres(limit=5)
+    trending = trending_books(limit=4)
     
     return render_template('index.html', 
                            recent_books=recent_books,
                            user_stats=user_stats,
-                           total_books=total_books,
-                           total_genres=total_genres,
-                           books_on_loan=books_on_loan,
-                           popular_genres=popular_genres)
+                           total_books=stats.total_books,
+                           total_genres=stats.total_genres,
+                           books_on_loan=stats.books_on_loan,
+                           popular_genres=popular_genres,
+                           trending_books=trending)
 
 @main_bp.route('/search')
 def search():
-    """Search for books by title, author, or ISBN"""
+    """Search for books by title, author, ISBN, publisher, description or genre"""
     query = request.args.get('query', '')
+    mode = 'fuzzy' if request.args.get('mode') == 'fuzzy' else None
     if not query:
-        return render_template('search.html', books=[], query='')
+        return render_template('search.html', books=[], query='', mode=mode)
+    
+    # Ranked keyset page from the full-text index; rows are only fetched once
+    # the streamed template reaches the results, after the header is sent
+    per_page = current_app.config['BOOKS_PER_PAGE']
+    books = search_books(query,
+                         per_page=per_page,
+                         after=request.args.get('after'),
+                         before=request.args.get('before'),
+                         fuzzy=mode == 'fuzzy')
     
-    # Search in title, author, and ISBN
-    books = Book.query.filter(
-        (Book.title.ilike(f'%{query}%')) |
-        (Book.author.ilike(f'%{query}%')) |
-        (Book.isbn.ilike(f'%{query}%'))
-    ).all()
+    # Close spellings, only queried if the exact search comes back empty
+    close_matches = None
+    if not mode and not request.args.get('after') and not request.args.get('before'):
+        close_matches = search_books(query, per_page=per_page, fuzzy=True)
+    
+    return stream_template('search.html', books=books, query=query, mode=mode, close_matches=close_matches)
+
+@main_bp.route('/search/suggest')
+def suggest():
+    """Autocomplete for the search box: up to 8 books as JSON, from the trigram index"""
+    query = request.args.get('q', '')[:100]
+    key = f'suggest:{query.lower()}'
+    suggestions = cache.get(key)
+    if suggestions is None:
+        suggestions = suggest_books(query) if query.strip() else []
+        for suggestion in suggestions:
+            suggestion['url'] = url_for('books.show', id=suggestion['id'])
+        cache.set(key, suggestions, tags=[BOOKS_TAG], timeout=current_app.config['SUGGEST_CACHE_TIMEOUT'])
     
-    return render_template('search.html', books=books, query=query)
+    response = jsonify(query=query, suggestions=suggestions)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['SUGGEST_CACHE_TIMEOUT']
+    return response
 
 @main_bp.route('/about')
 def about():
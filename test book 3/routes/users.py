@@ -1,9 +1,18 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
-from flask_login import login_required, current_user
-from app import db
+from flask import (Blueprint, Response, render_template, redirect, url_for, flash, request, current_app,
+                   abort, stream_with_context)
+from flask_login import login_required, current_user, login_user
+from app import db, cache
 from models.user import User
-from models.loan import Loan
-from forms.user import UserEditForm, UserSearchForm
+from models.loan import Loan, LoanStats
+from models.hold import Hold
+from sqlalchemy.orm import joinedload
+from forms.user import UserEditForm, UserBulkForm
+from services import rollups, holds
+from services.cache import user_tag, USERS_TAG
+from services.export import FORMATS, check_format, export_rows
+from services.passwords import PasswordsBusy
+from services.pagination import keyset_paginate
+from services.user_directory import UserFilters, SORT_KEYS, directory_query, count_admin_changes, set_admin
 from datetime import datetime
 
 users_bp = Blueprint('users', __name__)
@@ -11,25 +20,95 @@ users_bp = Blueprint('users', __name__)
 @users_bp.route('/users')
 @login_required
 def index():
-    """List all users (admin only)"""
+    """The member directory (admin only): search, filters and sortable columns, a page at a time"""
     if not current_user.is_admin:
         flash('You do not have permission to access this page.', 'danger')
         return redirect(url_for('main.index'))
     
-    form = UserSearchForm()
-    query = request.args.get('query', '')
+    filters = UserFilters.from_args(request.args)
+    sort_by = request.args.get('sort', 'username')
+    if sort_by not in SORT_KEYS:
+        sort_by = 'username'
     
-    if query:
-        users = User.query.filter(
-            (User.username.ilike(f'%{query}%')) |
-            (User.email.ilike(f'%{query}%')) |
-            (User.first_name.ilike(f'%{query}%')) |
-            (User.last_name.ilike(f'%{query}%'))
-        ).order_by(User.username).all()
-    else:
-        users = User.query.order_by(User.username).all()
+    # Search goes through the member index, and pages seek past the last
+    # row's sort key, so deep pages cost the same as the first
+    query, columns, descending = directory_query(filters, sort_by)
+    users = keyset_paginate(query, columns, per_page=current_app.config['USERS_PER_PAGE'],
+                            after=request.args.get('after'), before=request.args.get('before'),
+                            descending=descending)
     
-    return render_template('users/index.html', users=users, form=form, query=query)
+    # Loan counts for the page in one grouped query
+    loan_stats = LoanStats.for_users([user.id for user in users],
+                                     due_soon_days=current_app.config['NOTICE_DUE_SOON_DAYS'])
+    
+    bulk_form = UserBulkForm(**filters.args())
+    
+    return render_template('users/index.html', users=users, loan_stats=loan_stats,
+                           filters=filters, sort_by=sort_by, formats=FORMATS, bulk_form=bulk_form)
+
+@users_bp.route('/users/export.<format>')
+@login_required
+def export(format):
+    """Stream the users the directory filters select (admin only)"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access this page.', 'danger')
+        return redirect(url_for('main.index'))
+    
+    if format not in FORMATS:
+        abort(404)
+    try:
+        check_format(format)
+    except ValueError as e:
+        abort(400, description=str(e))
+    
+    # The rows are read batch by batch while the response is sent
+    filters = UserFilters.from_args(request.args)
+    conditions = filters.conditions(db.engine)
+    filename = f"users-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{format}"
+    response = Response(stream_with_context(export_rows('users', format, conditions=conditions)),
+                        mimetype=FORMATS[format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@users_bp.route('/users/bulk', methods=['POST'])
+@login_required
+def bulk():
+    """Grant or revoke admin for every user the directory filters select (admin only)"""
+    if not current_user.is_admin:
+        flash('You do not have permission to change users.', 'danger')
+        return redirect(url_for('main.index'))
+    
+    # A FlaskForm, so the CSRF token is checked before anything is changed
+    form = UserBulkForm()
+    filters = UserFilters(query=form.query.data, role=form.role.data, loans=form.loans.data)
+    if not form.validate_on_submit():
+        flash(form.action.errors[0] if form.action.errors else 'Your session expired, please try again.', 'warning')
+        return redirect(url_for('users.index', **filters.args()))
+    # Never a change to every account at once
+    if not filters.active:
+        flash('Search or filter the directory first; bulk changes do not apply to all users.', 'warning')
+        return redirect(url_for('users.index'))
+    action = form.action.data
+    is_admin = action == 'grant_admin'
+    
+    # The first submit (or one whose selection has changed since) only shows
+    # how many users would change; your own account is left alone
+    count = count_admin_changes(filters, is_admin, keep=current_user.id)
+    if count == 0:
+        flash('No users to change.', 'info')
+        return redirect(url_for('users.index', **filters.args()))
+    if form.expected.data != str(count):
+        form.expected.data = str(count)
+        return render_template('users/bulk_confirm.html', form=form, filters=filters, count=count)
+    
+    # One UPDATE over the selection
+    changed = set_admin(filters, is_admin, keep=current_user.id)
+    db.session.commit()
+    cache.invalidate(USERS_TAG)
+    
+    verb = 'granted to' if is_admin else 'revoked from'
+    flash(f'Admin access {verb} {changed} user{"" if changed == 1 else "s"}.', 'success')
+    return redirect(url_for('users.index', **filters.args()))
 
 @users_bp.route('/users/<int:id>')
 @login_required
@@ -66,6 +145,14 @@ def edit(id):
         del form.is_admin
     
     if form.validate_on_submit():
+        # Change password if provided; hashed first, so a busy hasher leaves the user untouched
+        if form.password.data:
+            try:
+                user.set_password(form.password.data)
+            except PasswordsBusy as e:
+                flash(str(e), 'warning')
+                return render_template('users/edit.html', form=form, user=user)
+        
         user.first_name = form.first_name.data
         user.last_name = form.last_name.data
         user.email = form.email.data
@@ -76,14 +163,14 @@ def edit(id):
         if current_user.is_admin and hasattr(form, 'is_admin'):
             user.is_admin = form.is_admin.data
         
-        # Change password if provided
-        if form.password.data:
-            user.set_password(form.password.data)
-        
         db.session.commit()
+        cache.invalidate(user_tag(user.id))
         flash('User information updated successfully.', 'success')
         
         if current_user.id == user.id:
+            # A new password ends the user's other sessions; keep this one
+            if form.password.data:
+                login_user(user)
             return redirect(url_for('auth.profile'))
         else:
             return redirect(url_for('users.show', id=user.id))
@@ -106,14 +193,19 @@ def delete(id):
         return redirect(url_for('users.index'))
     
     # Check for active loans
-    active_loans = user.get_active_loans()
-    if active_loans:
+    if user.has_active_loans():
         flash('Cannot delete user with active loans. Please return all books first.', 'danger')
         return redirect(url_for('users.show', id=user.id))
     
+    # Copies set aside for the user's holds go to the next patron in line
+    held_books = holds.cancel_user_holds(user.id, current_app.config['HOLD_PICKUP_DAYS'])
+    Hold.query.filter_by(user_id=user.id).delete()
+    
     # Delete the user
     db.session.delete(user)
     db.session.commit()
+    cache.invalidate(user_tag(id))
+    holds.invalidate_holds(*held_books, shelved=held_books)
     
     flash('User deleted successfully.', 'success')
     return redirect(url_for('users.index'))
@@ -127,26 +219,22 @@ def reports():
         return redirect(url_for('main.index'))
     
     # Overdue books report
-    overdue_loans = Loan.query.filter(
+    overdue_loans = Loan.query.options(
+        joinedload(Loan.book), joinedload(Loan.borrower)
+    ).filter(
         Loan.returned == False,
         Loan.due_date < datetime.utcnow()
     ).order_by(Loan.due_date).all()
     
-    # Most popular books report
-    popular_books = db.session.query(
-        Book, db.func.count(Loan.id).label('loan_count')
-    ).join(Loan).group_by(Book).order_by(
-        db.func.count(Loan.id).desc()
-    ).limit(10).all()
-    
-    # Active users report
-    active_users = db.session.query(
-        User, db.func.count(Loan.id).label('loan_count')
-    ).join(Loan).group_by(User).order_by(
-        db.func.count(Loan.id).desc()
-    ).limit(10).all()
+    # Popularity reports read the daily rollups, not the loan history
+    window = request.args.get('window', '30')
+    if window not in rollups.WINDOWS:
+        window = '30'
+    popular_books = rollups.popular_books(days=rollups.WINDOWS[window], limit=10).all()
+    active_users = rollups.active_users(days=rollups.WINDOWS[window], limit=10).all()
     
     return render_template('users/reports.html',
                            overdue_loans=overdue_loans,
                            popular_books=popular_books,
-                           active_users=active_users)
\ No newline at end of file
+                           active_users=active_users,
+                           window=window)
\ No newline at end of file
@@ -0,0 +1 @@
+# Application services shared by the blueprints and CLI commands
@@ -0,0 +1,164 @@
+from flask import request_started, _request_ctx_stack
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+from urllib.parse import quote
+import io
+import sys
+
+# Methods that can be answered by an async view; everything else (forms,
+# uploads, the JSON checkout) goes through the WSGI bridge
+ASYNC_METHODS = ('GET', 'HEAD')
+
+
+# Endpoint name -> coroutine, filled in by @async_view
+ASYNC_VIEWS = {}
+
+
+def async_view(endpoint):
+    """Register a coroutine to serve an endpoint when running under ASGI
+
+    The sync view stays in place for WSGI servers. The coroutine gets the
+    same URL arguments and runs inside a normal Flask request context, so
+    request, session, g, url_for and render_template all work; it should
+    read the database through async_db rather than db.session.
+    """
+    def register(view):
+        ASYNC_VIEWS[endpoint] = view
+        return view
+    return register
+
+
+async def run_in_thread(function, *args):
+    """Run sync code that uses db.session on a worker thread, inside the current contexts
+
+    The thread's scoped session is removed afterwards, so returned objects
+    are detached: only attributes that were already loaded can be read.
+    """
+    from asgiref.sync import sync_to_async
+    from app import db
+
+    def call():
+        try:
+            return function(*args)
+        finally:
+            db.session.remove()
+
+    return await sync_to_async(call, thread_sensitive=False)()
+
+
+def _environ(scope):
+    """A WSGI environ for a bodiless ASGI HTTP request"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': quote(scope.get('root_path', ''), safe='/'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(b''),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI application serving the Flask app
+
+    Requests for endpoints with an async_view run as coroutines on the
+    event loop and wait on the database without holding a thread. Every
+    other request is handed to the WSGI app on asgiref's thread pool, so
+    all blueprints keep working unchanged.
+    """
+
+    def __init__(self, app, async_db):
+        from asgiref.wsgi import WsgiToAsgi
+        self.app = app
+        self.async_db = async_db
+        self.wsgi = WsgiToAsgi(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ASYNC_METHODS:
+            environ = _environ(scope)
+            try:
+                endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+            except (HTTPException, RequestRedirect):
+                endpoint = None
+            view = ASYNC_VIEWS.get(endpoint)
+            if view is not None:
+                return await self._dispatch(environ, view, args, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.async_db.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _dispatch(self, environ, view, args, send):
+        """Flask's full_dispatch_request with the view awaited"""
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                app.try_trigger_before_first_request_functions()
+                try:
+                    request_started.send(app)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        await self._load_user()
+                        rv = await view(**args)
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            await self._send(response, environ, send)
+        finally:
+            if app.should_ignore_error(error):
+                error = None
+            ctx.auto_pop(error)
+
+    async def _load_user(self):
+        # Flask-Login's loader is synchronous; run it off the event loop so
+        # the user lookup does not stall other requests
+        if not hasattr(_request_ctx_stack.top, 'user'):
+            await run_in_thread(current_user._get_current_object)
+
+    @staticmethod
+    async def _send(response, environ, send):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.get_wsgi_headers(environ).items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        try:
+            body = b'' if environ['REQUEST_METHOD'] == 'HEAD' else b''.join(response.iter_encoded())
+        finally:
+            response.close()
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,213 @@
+from flask import abort, current_app, request
+from werkzeug.utils import safe_join, send_file
+import gzip
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text assets worth precompressing; images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.map', '.html'}
+COMPRESS_MIN_SIZE = 512
+
+# Uploads named after their content never change once written
+CONTENT_ADDRESSED_UPLOADS = ('covers/', 'originals/')
+
+# (Content-Encoding, file suffix, compressor), in order of preference
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+
+class Asset:
+    """One fingerprinted static file and its precompressed variants"""
+
+    def __init__(self, name, path, digest):
+        self.name = name
+        self.path = path
+        self.digest = digest
+        stem, extension = os.path.splitext(name)
+        self.fingerprinted = f'{stem}.{digest}{extension}'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.variants = {}
+
+    def __repr__(self):
+        return f'<Asset {self.fingerprinted}>'
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(handle, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+class StaticAssets:
+    """Serves /static with fingerprinted names, far-future caching and ETags
+
+    At startup every file in the static folder (uploads excepted) is hashed
+    into a manifest, and url_for('static', ...) rewrites names to include
+    the hash, e.g. css/styles.3f9a1c0b2d4e.css. Fingerprinted URLs and
+    content-addressed cover uploads are sent with Cache-Control: immutable;
+    anything else must revalidate against a strong ETag. Text assets get
+    gzip (and brotli, if the brotli package is installed) variants written
+    once to ASSETS_COMPRESSED_FOLDER, keyed by content hash, so a restart
+    reuses them. ASSETS_SENDFILE hands the file body to the front proxy.
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self._fingerprinted = {}
+        self._etags = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['assets'] = self
+        self.static_folder = app.static_folder
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        # Build output goes to the instance folder, not the source tree
+        self.compressed_folder = (app.config['ASSETS_COMPRESSED_FOLDER']
+                                  or os.path.join(app.instance_path, 'compressed'))
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self.sendfile = app.config['ASSETS_SENDFILE']
+        self.accel_prefix = app.config['ASSETS_ACCEL_PREFIX'].rstrip('/') + '/'
+        if self.sendfile not in ('', 'x-sendfile', 'x-accel-redirect'):
+            raise ValueError(f'Unknown ASSETS_SENDFILE {self.sendfile!r}')
+        # nginx can only be pointed at files under the static folder alias
+        static_root = os.path.abspath(self.static_folder)
+        self.compress = self.sendfile != 'x-accel-redirect' or os.path.commonpath(
+            [static_root, os.path.abspath(self.compressed_folder)]) == static_root
+
+        self.build()
+        app.url_defaults(self._fingerprint_url)
+        app.view_functions['static'] = self.serve
+
+    def build(self):
+        """Hash every static file and write any missing compressed variants
+
+        Returns the number of compressed files written.
+        """
+        skip = {os.path.abspath(self.upload_folder), os.path.abspath(self.compressed_folder)}
+        manifest, written = {}, 0
+        for root, directories, files in os.walk(self.static_folder):
+            directories[:] = sorted(d for d in directories
+                                    if os.path.abspath(os.path.join(root, d)) not in skip and not d.startswith('.'))
+            for filename in sorted(files):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                asset = Asset(name, path, hashlib.sha256(data).hexdigest()[:12])
+                written += self._compress(asset, data)
+                manifest[name] = asset
+
+        self.manifest = manifest
+        self._fingerprinted = {asset.fingerprinted: asset for asset in manifest.values()}
+        return written
+
+    def _compress(self, asset, data):
+        if not self.compress or os.path.splitext(asset.name)[1] not in COMPRESSIBLE or len(data) < COMPRESS_MIN_SIZE:
+            return 0
+        written = 0
+        for encoding, suffix, compress in ENCODINGS:
+            path = os.path.join(self.compressed_folder, asset.fingerprinted + suffix)
+            if not os.path.exists(path):
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                _write_atomic(path, compressed)
+                written += 1
+            asset.variants[encoding] = path
+        return written
+
+    def _fingerprint_url(self, endpoint, values):
+        if endpoint == 'static':
+            asset = self.manifest.get(values.get('filename'))
+            if asset is not None:
+                values['filename'] = asset.fingerprinted
+
+    def serve(self, filename):
+        """The static endpoint: manifest assets first, then uploads"""
+        asset = self._fingerprinted.get(filename)
+        if asset is not None:
+            return self._send(asset.path, asset.digest, asset.mimetype, True, asset.variants)
+
+        asset = self.manifest.get(filename)
+        if asset is not None:
+            # A pre-fingerprint URL, e.g. from a page cached before a deploy
+            return self._send(asset.path, asset.digest, asset.mimetype, False, asset.variants)
+
+        upload_prefix = os.path.relpath(self.upload_folder, self.static_folder).replace(os.sep, '/') + '/'
+        if not filename.startswith(upload_prefix):
+            abort(404)
+        name = filename[len(upload_prefix):]
+        path = safe_join(self.upload_folder, name)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if name.startswith(CONTENT_ADDRESSED_UPLOADS):
+            # The content hash is the file name
+            etag = os.path.splitext(os.path.basename(name))[0]
+            return self._send(path, etag, mimetype, True)
+        return self._send(path, self._content_etag(path), mimetype, False)
+
+    def _content_etag(self, path):
+        """Strong ETag of a file without a hashed name, cached until it changes"""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        etag = self._etags.get(key)
+        if etag is None:
+            with open(path, 'rb') as f:
+                etag = hashlib.sha256(f.read()).hexdigest()[:16]
+            with self._lock:
+                self._etags[key] = etag
+        return etag
+
+    def _send(self, path, etag, mimetype, immutable, variants=None):
+        encoding = None
+        if variants:
+            accepted = request.accept_encodings
+            encoding = next((e for e, suffix, compress in ENCODINGS if e in variants and accepted[e]), None)
+            if encoding is not None:
+                path = variants[encoding]
+                # Each representation needs its own strong validator
+                etag = f'{etag}-{encoding}'
+
+        if self.sendfile == 'x-accel-redirect':
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            if immutable:
+                self._cache_forever(response)
+            response = response.make_conditional(request.environ)
+        else:
+            response = send_file(path, request.environ, mimetype=mimetype, etag=etag,
+                                 max_age=self.max_age if immutable else None,
+                                 use_x_sendfile=self.sendfile == 'x-sendfile',
+                                 response_class=current_app.response_class)
+            if immutable:
+                self._cache_forever(response)
+
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if variants:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def _cache_forever(self, response):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.cache_control.immutable = True
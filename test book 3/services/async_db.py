@@ -0,0 +1,64 @@
+from sqlalchemy.engine.url import make_url
+from services.database import engine_options, install_sqlite_pragmas, is_sqlite
+
+# Async driver for each backend the sync app supports
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+
+
+def async_database_url(uri):
+    """The SQLALCHEMY_DATABASE_URI rewritten for the backend's asyncio driver"""
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No asyncio driver known for {backend!r}; set ASYNC_DATABASE_URL')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+class AsyncDatabase:
+    """SQLAlchemy asyncio engine for the views served natively under ASGI
+
+    The engine is only created on first use, so WSGI deployments never need
+    an async driver installed (aiosqlite for SQLite, asyncpg for PostgreSQL).
+    It gets the same pool sizes and SQLite PRAGMAs as the sync engine.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._engine = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['async_db'] = self
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            from sqlalchemy.ext.asyncio import create_async_engine
+            from sqlalchemy.pool import AsyncAdaptedQueuePool
+            config = self.app.config
+            url = config['ASYNC_DATABASE_URL'] or async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+            options = engine_options(config) if config.get('DATABASE_PROFILE', 'auto') == 'auto' else {}
+            if options.get('poolclass') is not None:
+                options['poolclass'] = AsyncAdaptedQueuePool
+            if is_sqlite(str(url)):
+                # aiosqlite runs each connection on its own thread anyway
+                options.get('connect_args', {}).pop('check_same_thread', None)
+            self._engine = create_async_engine(url, **options)
+            install_sqlite_pragmas(self.app, self._engine.sync_engine)
+        return self._engine
+
+    def session(self):
+        """A new AsyncSession; use it as ``async with async_db.session() as session``
+
+        Objects stay readable after the session closes, but relationships
+        must be loaded eagerly (selectinload) since nothing can lazy-load.
+        """
+        from sqlalchemy.ext.asyncio import AsyncSession
+        return AsyncSession(self.engine, expire_on_commit=False)
+
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = None
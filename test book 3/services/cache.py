@@ -0,0 +1,268 @@
+from flask import g
+from markupsafe import Markup
+from collections import OrderedDict
+from urllib.parse import urlencode
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+
+
+class NullBackend:
+    """Backend that stores nothing, used to switch caching off"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryBackend:
+    """Per-process LRU store with a time-to-live on every entry"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemBackend:
+    """Store shared by every worker on the host, one pickle file per key"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        # Write to a temporary file and rename it so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class Cache:
+    """Tagged cache for rendered fragments and computed values
+
+    Every entry remembers the version of each tag it was stored under.
+    Invalidating a tag gives it a fresh version, so all entries carrying it
+    miss on their next read while the rest of the cache is left alone. This
+    works the same way whether the backend is private to the process or
+    shared between workers.
+    """
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.default_timeout = 300
+        self.key_prefix = ''
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'memory')
+        if cache_type == 'memory':
+            self.backend = MemoryBackend(app.config.get('CACHE_MAX_ENTRIES', 1000))
+        elif cache_type == 'filesystem':
+            self.backend = FileSystemBackend(app.config['CACHE_DIR'])
+        elif cache_type == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE {cache_type!r}')
+        self.default_timeout = app.config.get('CACHE_DEFAULT_TIMEOUT', 300)
+        self.key_prefix = app.config.get('CACHE_KEY_PREFIX', 'library:')
+
+        app.extensions['cache'] = self
+        app.jinja_env.globals.update(cached_fragment=self.fragment, tag_fragment=self.tag_fragment)
+
+    def _tag_version(self, tag, create=False):
+        key = f'{self.key_prefix}tag:{tag}'
+        version = self.backend.get(key)
+        if version is None and create:
+            version = uuid.uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def _get_entry(self, key):
+        entry = self.backend.get(self.key_prefix + key)
+        if entry is None:
+            return None
+        value, tag_versions = entry
+        for tag, version in tag_versions.items():
+            if self._tag_version(tag) != version:
+                return None
+        return value, tag_versions.keys()
+
+    def get(self, key):
+        """Return the cached value, or None if missing, expired or invalidated"""
+        entry = self._get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value, tags=(), timeout=None):
+        """Store a value under the given tags"""
+        tag_versions = {tag: self._tag_version(tag, create=True) for tag in set(tags)}
+        timeout = self.default_timeout if timeout is None else timeout
+        self.backend.set(self.key_prefix + key, (value, tag_versions), timeout)
+
+    def delete(self, key):
+        self.backend.delete(self.key_prefix + key)
+
+    def invalidate(self, *tags):
+        """Expire every entry stored under any of the given tags"""
+        for tag in set(tags):
+            self.backend.set(f'{self.key_prefix}tag:{tag}', uuid.uuid4().hex)
+
+    def clear(self):
+        self.backend.clear()
+
+    def tag_fragment(self, *tags):
+        """Add tags to every fragment currently being rendered (template helper)"""
+        for collected in g.get('_fragment_tags', []):
+            collected.update(tags)
+        return ''
+
+    @staticmethod
+    def _fragment_key(name, key_args):
+        key = 'fragment:' + name
+        if key_args:
+            key += '?' + urlencode(sorted((k, '' if v is None else v) for k, v in key_args.items()))
+        return key
+
+    def pin_fragment(self, name, **key_args):
+        """Hold a cached fragment for the rest of the request, returning whether it was cached
+
+        A view that loads a fragment's data up front (the async views) calls
+        this first and skips the loading on a hit; the pinned copy is what the
+        template then renders, even if the entry expires in between.
+        """
+        key = self._fragment_key(name, key_args)
+        entry = self._get_entry(key)
+        if entry is not None:
+            g.setdefault('_pinned_fragments', {})[key] = entry
+        return entry is not None
+
+    def fragment(self, name, tags=(), timeout=None, caller=None, **key_args):
+        """Render a ``{% call cached_fragment(...) %}`` block through the cache
+
+        The key is built from the fragment name and its keyword arguments
+        (normally the route arguments). Tags given here and any added with
+        tag_fragment() while the block renders are stored with the entry.
+        """
+        key = self._fragment_key(name, key_args)
+        stack = g.setdefault('_fragment_tags', [])
+        entry = g.get('_pinned_fragments', {}).get(key) or self._get_entry(key)
+        if entry is not None:
+            html, collected = entry
+        else:
+            collected = set(tags)
+            stack.append(collected)
+            try:
+                html = str(caller())
+            finally:
+                stack.pop()
+            self.set(key, html, tags=collected, timeout=timeout)
+
+        # A nested fragment's tags also belong to the fragments enclosing it
+        for outer in stack:
+            outer.update(collected)
+        return Markup(html)
+
+
+# Tags for catalog listings: every unfiltered list, lists filtered on
+# availability, anything showing genre names or counts, and anything
+# filtered or counted by publisher or publication year
+BOOKS_TAG = 'books'
+AVAILABILITY_TAG = 'availability'
+GENRES_TAG = 'genres'
+FACETS_TAG = 'facets'
+
+
+def book_tag(book_id):
+    return f'book:{book_id}'
+
+
+def genre_tag(genre_id):
+    return f'genre:{genre_id}'
+
+
+def hold_tag(book_id):
+    return f'holds:{book_id}'
+
+
+# Tag on every logged-in user's cached fields, for changes made to many users at once
+USERS_TAG = 'users'
+
+
+def user_tag(user_id):
+    return f'user:{user_id}'
@@ -0,0 +1,141 @@
+from flask import current_app
+from app import db, cache
+from models.book import Book
+from models.loan import Loan
+from models.hold import Hold, READY
+from services.stats import adjust_stats
+from services.rollups import record_checkout
+from services.holds import claim_hold, release_copy, invalidate_holds
+from services.cache import book_tag, AVAILABILITY_TAG
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+# Most books one self-service request may check out or return
+MAX_BATCH = 50
+
+
+class CirculationError(Exception):
+    """A batch was rolled back as a whole; busy is True for lock contention"""
+
+    def __init__(self, message, busy=False):
+        super().__init__(message)
+        self.busy = busy
+
+
+def _batch_ids(book_ids):
+    book_ids = list(dict.fromkeys(book_ids))
+    if len(book_ids) > MAX_BATCH:
+        raise ValueError(f'At most {MAX_BATCH} books can be handled at once.')
+    return book_ids
+
+
+def _copy_counts(book_ids):
+    table = Book.__table__
+    return db.session.execute(
+        db.select([table.c.id, table.c.available_copies, table.c.total_copies])
+        .where(table.c.id.in_(book_ids))
+    ).fetchall()
+
+
+def checkout_books(user_id, book_ids):
+    """Check out several books for one user in a single transaction
+
+    Returns one result per book, in request order, whose status is
+    'checked_out' (with loan_id and due_date), 'not_found', 'unavailable'
+    or 'already_borrowed'; a book that cannot be lent does not stop the
+    others. Copies are taken with the same conditional UPDATE as the
+    checkout view. Raises CirculationError if the batch had to be rolled back.
+    """
+    book_ids = _batch_ids(book_ids)
+    known = {row.id for row in db.session.execute(
+        db.select([Book.__table__.c.id]).where(Book.__table__.c.id.in_(book_ids)))}
+    borrowed = {row.book_id for row in db.session.query(Loan.book_id).filter(
+        Loan.user_id == user_id, Loan.returned == False, Loan.book_id.in_(book_ids))}
+    held = {row.book_id for row in db.session.query(Hold.book_id).filter(
+        Hold.user_id == user_id, Hold.status == READY, Hold.book_id.in_(book_ids))}
+
+    results, loans, claimed = [], {}, set()
+    try:
+        for book_id in book_ids:
+            if book_id not in known:
+                results.append({'book_id': book_id, 'status': 'not_found'})
+                continue
+            if book_id in borrowed:
+                results.append({'book_id': book_id, 'status': 'already_borrowed'})
+                continue
+            # A ready hold's copy is already set aside for the user
+            if book_id in held and claim_hold(user_id, book_id):
+                claimed.add(book_id)
+            elif not Book.take_copy(book_id):
+                results.append({'book_id': book_id, 'status': 'unavailable'})
+                continue
+            loans[book_id] = Loan(user_id=user_id, book_id=book_id)
+            db.session.add(loans[book_id])
+            record_checkout(book_id, user_id)
+            results.append({'book_id': book_id, 'status': 'checked_out'})
+
+        emptied = False
+        taken = [book_id for book_id in loans if book_id not in claimed]
+        if loans:
+            db.session.flush()
+        if taken:
+            counts = _copy_counts(taken)
+            emptied = any(row.available_copies == 0 for row in counts)
+            adjust_stats(books_on_loan=sum(row.available_copies == row.total_copies - 1 for row in counts))
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent checkout by the same user won the unique active-loan index
+        db.session.rollback()
+        raise CirculationError('One of these books was checked out at the same time; nothing was checked out.')
+    except OperationalError:
+        db.session.rollback()
+        raise CirculationError('The library is busy right now, please try again in a moment.', busy=True)
+
+    if loans:
+        cache.invalidate(*[book_tag(book_id) for book_id in loans], *([AVAILABILITY_TAG] if emptied else []))
+    invalidate_holds(*claimed)
+    for result in results:
+        loan = loans.get(result['book_id'])
+        if loan is not None:
+            result.update(loan_id=loan.id, due_date=loan.due_date)
+    return results
+
+
+def return_books(user_id, book_ids):
+    """Return several of a user's books in a single transaction
+
+    Results are 'returned' or 'not_borrowed', in request order. Loans are
+    closed with conditional UPDATEs, so a repeated request returns nothing
+    twice. Raises CirculationError if the batch had to be rolled back.
+    """
+    book_ids = _batch_ids(book_ids)
+    active = {row.book_id: row.id for row in db.session.query(Loan.id, Loan.book_id).filter(
+        Loan.user_id == user_id, Loan.returned == False, Loan.book_id.in_(book_ids))}
+
+    pickup_days = current_app.config['HOLD_PICKUP_DAYS']
+    results, returned, promoted = [], [], []
+    try:
+        for book_id in book_ids:
+            if book_id in active and Loan.close(active[book_id]):
+                # The next patron waiting for the book gets the copy in this transaction
+                if release_copy(book_id, pickup_days) is None:
+                    returned.append(book_id)
+                else:
+                    promoted.append(book_id)
+                results.append({'book_id': book_id, 'status': 'returned', 'loan_id': active[book_id]})
+            else:
+                results.append({'book_id': book_id, 'status': 'not_borrowed'})
+
+        refilled = False
+        if returned:
+            counts = _copy_counts(returned)
+            refilled = any(row.available_copies == 1 for row in counts)
+            adjust_stats(books_on_loan=-sum(row.available_copies == row.total_copies for row in counts))
+        db.session.commit()
+    except OperationalError:
+        db.session.rollback()
+        raise CirculationError('The library is busy right now, please try again in a moment.', busy=True)
+
+    if returned:
+        cache.invalidate(*[book_tag(book_id) for book_id in returned], *([AVAILABILITY_TAG] if refilled else []))
+    invalidate_holds(*promoted)
+    return results
@@ -0,0 +1,306 @@
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps, features
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Widths (px) every cover is rendered at; cards use the two small ones,
+# the detail page the largest
+COVER_WIDTHS = (160, 320, 640)
+
+# Book.cover_image values: processed covers are 'covers/<content hash>',
+# uploads still waiting for the worker 'originals/<hash>.<ext>', anything
+# else a file name from before the pipeline existed
+PROCESSED_PREFIX = 'covers/'
+ORIGINALS_PREFIX = 'originals/'
+DEFAULT_COVER = 'default_cover.jpg'
+
+WEBP_SUPPORTED = features.check('webp')
+
+_FORMATS = [('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True})]
+if WEBP_SUPPORTED:
+    _FORMATS.append(('webp', 'WEBP', {'quality': 80, 'method': 4}))
+
+
+def content_key(data):
+    """Name for an image derived from its bytes, so identical uploads share files"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def is_processed(name):
+    return bool(name) and name.startswith(PROCESSED_PREFIX)
+
+
+def _covers_folder(upload_folder):
+    return os.path.join(upload_folder, PROCESSED_PREFIX.rstrip('/'))
+
+
+def _variant(key, width, extension):
+    return f'{key}-{width}.{extension}'
+
+
+def render_variants(data, upload_folder, key):
+    """Write every size and format of a cover, returning how many files were new
+
+    The image is re-encoded from pixels only, so EXIF (including GPS) and
+    other metadata are dropped; the orientation tag is applied first.
+    Existing variants are left alone, which makes re-running cheap.
+    """
+    folder = _covers_folder(upload_folder)
+    os.makedirs(folder, exist_ok=True)
+    wanted = [(width, extension, format, options) for width in COVER_WIDTHS
+              for extension, format, options in _FORMATS
+              if not os.path.exists(os.path.join(folder, _variant(key, width, extension)))]
+    if not wanted:
+        return 0
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white; JPEG has no alpha channel
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+
+        for width, extension, format, options in wanted:
+            resized = image.copy()
+            # Never upscale; keep the aspect ratio
+            resized.thumbnail((width, width * 4), Image.LANCZOS)
+            handle, temporary = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                resized.save(f, format, **options)
+            os.replace(temporary, os.path.join(folder, _variant(key, width, extension)))
+    return len(wanted)
+
+
+def stage_upload(file_storage, upload_folder):
+    """Save an uploaded cover under its content hash
+
+    Returns the Book.cover_image value to store right away: the processed
+    name if this exact image was processed before, otherwise the staged
+    original, which is shown until the worker has rendered the variants.
+    Raises ValueError if the file is not an image Pillow can read.
+    """
+    data = file_storage.read()
+    try:
+        Image.open(io.BytesIO(data)).verify()
+    except Exception as e:
+        raise ValueError('The cover is not a valid image file.') from e
+    key = content_key(data)
+    if os.path.exists(os.path.join(_covers_folder(upload_folder), _variant(key, COVER_WIDTHS[-1], 'jpg'))):
+        return PROCESSED_PREFIX + key
+
+    extension = os.path.splitext(file_storage.filename or '')[1].lower() or '.img'
+    name = f'{ORIGINALS_PREFIX}{key}{extension}'
+    path = os.path.join(upload_folder, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return name
+
+
+def release_cover(name, upload_folder):
+    """Remove a replaced cover's file if nothing else can be using it
+
+    Processed and staged covers are shared by every book with the same
+    image, so only one-off files from before the pipeline are deleted.
+    """
+    if not name or name == DEFAULT_COVER or name.startswith((PROCESSED_PREFIX, ORIGINALS_PREFIX)):
+        return
+    try:
+        os.remove(os.path.join(upload_folder, name))
+    except OSError:
+        pass
+
+
+def process_book_cover(book_id, staged, upload_folder):
+    """Render a staged cover and point the book at the variants
+
+    Runs on a worker thread inside an app context. The UPDATE only applies
+    if the book still has the staged cover, so a newer upload is never
+    overwritten by an older job.
+    """
+    from app import db, cache
+    from models.book import Book
+    from services.cache import book_tag
+
+    with open(os.path.join(upload_folder, staged), 'rb') as f:
+        data = f.read()
+    key = content_key(data)
+    render_variants(data, upload_folder, key)
+    processed = PROCESSED_PREFIX + key
+
+    updated = db.session.execute(
+        Book.__table__.update()
+        .where(Book.id == book_id, Book.cover_image == staged)
+        .values(cover_image=processed)
+    ).rowcount
+    db.session.commit()
+    if updated:
+        # Listing fragments carry the tag of every card they contain
+        cache.invalidate(book_tag(book_id))
+    return processed
+
+
+def _render_file(upload_folder, name):
+    # One backfill item: (name, processed name or None, error or None)
+    try:
+        with open(os.path.join(upload_folder, name), 'rb') as f:
+            data = f.read()
+        key = content_key(data)
+        render_variants(data, upload_folder, key)
+        return name, PROCESSED_PREFIX + key, None
+    except Exception as e:
+        return name, None, str(e) or type(e).__name__
+
+
+def backfill_covers(processor, upload_folder, chunk_size=200):
+    """Process every cover still stored as a single file, in parallel
+
+    Books are walked in id order one chunk at a time; each distinct file is
+    rendered once on the pool and all books using it are repointed with one
+    executemany. Returns (books updated, [(file, error)] for failures).
+    """
+    from app import db, cache
+    from models.book import Book
+    from services.cache import book_tag
+    from sqlalchemy import bindparam
+
+    table = Book.__table__
+    update = table.update().where(
+        table.c.id == bindparam('book_id'), table.c.cover_image == bindparam('old')
+    ).values(cover_image=bindparam('new'))
+    updated, failures = 0, []
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select([table.c.id, table.c.cover_image]).where(
+                table.c.id > last_id,
+                table.c.cover_image.isnot(None),
+                table.c.cover_image != DEFAULT_COVER,
+                ~table.c.cover_image.startswith(PROCESSED_PREFIX)
+            ).order_by(table.c.id).limit(chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        names = sorted({row.cover_image for row in rows})
+        results = {}
+        for name, processed, error in processor.map(lambda name: _render_file(upload_folder, name), names):
+            if error:
+                failures.append((name, error))
+            else:
+                results[name] = processed
+        changes = [{'book_id': row.id, 'old': row.cover_image, 'new': results[row.cover_image]}
+                   for row in rows if row.cover_image in results]
+        if changes:
+            updated += db.session.execute(update, changes).rowcount
+        db.session.commit()
+        cache.invalidate(*[book_tag(change['book_id']) for change in changes])
+    return updated, failures
+
+
+class CoverProcessor:
+    """Renders cover variants on a thread pool, off the request thread
+
+    Pillow releases the GIL while decoding, resizing and encoding, so a
+    small pool of threads keeps several covers in flight. With
+    COVER_WORKERS = 0 jobs run inline, which is handy for tests and scripts.
+    """
+
+    def __init__(self, app=None):
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['covers'] = self
+        app.jinja_env.globals.update(cover_url=cover_url, cover_srcset=cover_srcset,
+                                     cover_picture=cover_picture)
+
+    def _pool(self, app):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=app.config['COVER_WORKERS'],
+                                                thread_name_prefix='covers')
+        return self._executor
+
+    def submit(self, book_id, staged):
+        """Queue a staged cover for processing; returns a Future, or None when run inline or there is nothing to do"""
+        if not staged or not staged.startswith(ORIGINALS_PREFIX):
+            return None
+        app = current_app._get_current_object()
+        upload_folder = app.config['UPLOAD_FOLDER']
+
+        def job():
+            try:
+                return process_book_cover(book_id, staged, upload_folder)
+            except Exception:
+                # The staged original keeps being served; 'flask process-covers' retries it
+                logger.exception('Processing cover %s for book %s failed', staged, book_id)
+                return None
+
+        if app.config['COVER_WORKERS'] == 0:
+            # Inline, in the caller's app context and session
+            job()
+            return None
+
+        def threaded_job():
+            with app.app_context():
+                return job()
+
+        return self._pool(app).submit(threaded_job)
+
+    def map(self, function, items):
+        """Run a function over items on the pool (inline with no workers)"""
+        app = current_app._get_current_object()
+        if app.config['COVER_WORKERS'] == 0:
+            return map(function, items)
+        return self._pool(app).map(function, items)
+
+
+def cover_url(name, width=None, format='jpg'):
+    """URL of a cover at a given width (the largest by default)"""
+    if not name or name == DEFAULT_COVER:
+        return url_for('static', filename='img/default_cover.jpg')
+    if is_processed(name):
+        # The smallest rendered width that covers the request
+        width = next((w for w in COVER_WIDTHS if width is not None and w >= width), COVER_WIDTHS[-1])
+        return url_for('static', filename=f'uploads/{PROCESSED_PREFIX}{_variant(name[len(PROCESSED_PREFIX):], width, format)}')
+    return url_for('static', filename='uploads/' + name)
+
+
+def cover_srcset(name, format='jpg', max_width=None):
+    """srcset value listing every rendered width, or '' for unprocessed covers"""
+    if not is_processed(name):
+        return ''
+    key = name[len(PROCESSED_PREFIX):]
+    return ', '.join(
+        url_for('static', filename=f'uploads/{PROCESSED_PREFIX}{_variant(key, width, format)}') + f' {width}w'
+        for width in COVER_WIDTHS if max_width is None or width <= max_width
+    )
+
+
+def cover_picture(name, alt, sizes, css_class='', max_width=None, lazy=True):
+    """<picture> for a cover: WebP and JPEG srcsets where available, a plain <img> otherwise"""
+    attributes = f'alt="{escape(alt)}" class="{escape(css_class)}"' + (' loading="lazy"' if lazy else '')
+    if not is_processed(name):
+        return Markup(f'<img src="{escape(cover_url(name))}" {attributes}>')
+    sources = ''
+    if WEBP_SUPPORTED:
+        sources = f'<source type="image/webp" srcset="{escape(cover_srcset(name, "webp", max_width))}" sizes="{escape(sizes)}">'
+    return Markup(
+        f'<picture>{sources}'
+        f'<img src="{escape(cover_url(name, max_width))}" srcset="{escape(cover_srcset(name, "jpg", max_width))}" '
+        f'sizes="{escape(sizes)}" {attributes}></picture>'
+    )
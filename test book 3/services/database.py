@@ -0,0 +1,106 @@
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def _is_sqlite_memory(uri):
+    return make_url(uri).database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """Pool settings for the configured backend
+
+    SQLite gets a persistent pool so connections (and their page cache and
+    memory map) are reused instead of reopened on every checkout; WAL lets
+    the pooled readers run alongside the single writer. Other backends get a
+    client/server pool that pings and recycles its connections.
+    """
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if is_sqlite(uri):
+        if _is_sqlite_memory(uri):
+            return {}
+        return {
+            'poolclass': QueuePool,
+            'pool_size': config['DATABASE_POOL_SIZE'],
+            'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+            'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+            'connect_args': {
+                'check_same_thread': False,
+                'timeout': config['SQLITE_PRAGMAS'].get('busy_timeout', 5000) / 1000,
+            },
+        }
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def configure_database(app):
+    """Fill in SQLALCHEMY_ENGINE_OPTIONS for the database profile (before db.init_app)"""
+    if app.config.get('DATABASE_PROFILE', 'auto') != 'auto':
+        return
+    options = engine_options(app.config)
+    # Explicit settings from the config class win over the profile
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def install_sqlite_pragmas(app, engine):
+    """Run the configured PRAGMAs on every new SQLite connection"""
+    if app.config.get('DATABASE_PROFILE', 'auto') != 'auto' or engine.dialect.name != 'sqlite':
+        return
+    pragmas = app.config['SQLITE_PRAGMAS']
+    if _is_sqlite_memory(app.config['SQLALCHEMY_DATABASE_URI']):
+        # WAL and memory maps mean nothing for an in-memory database
+        pragmas = {name: value for name, value in pragmas.items()
+                   if name not in ('journal_mode', 'mmap_size')}
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+# The inspector skips expression indexes such as ix_user_name_sort, so
+# existing index names are read from the catalog where we can
+_INDEX_NAMES = {
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table",
+    'postgresql': 'SELECT indexname FROM pg_indexes WHERE tablename = :table AND schemaname = current_schema()',
+}
+
+
+def _index_names(connection, table_name):
+    sql = _INDEX_NAMES.get(connection.dialect.name)
+    if sql is None:
+        return {index['name'] for index in inspect(connection).get_indexes(table_name)}
+    return set(connection.execute(text(sql), {'table': table_name}).scalars())
+
+
+def upgrade_schema():
+    """Bring an existing database up to the models: create missing tables and indexes
+
+    db.create_all() only creates whole tables, so indexes added to a model
+    later are never built on a database that already has the table. Returns
+    the names of the indexes created. A unique index that existing rows
+    violate raises IntegrityError, and the index changes are rolled back.
+    """
+    from app import db
+    db.create_all()
+    created = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = _index_names(connection, table.name)
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing:
+                    index.create(connection)
+                    created.append(index.name)
+    return created
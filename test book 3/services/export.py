@@ -0,0 +1,246 @@
+from app import db
+from models.book import Book, Genre, book_genre
+from models.loan import Loan
+from models.user import User
+from sqlalchemy import func, or_, and_
+from datetime import datetime, timezone
+import csv
+import io
+import json
+
+# Rows fetched from the cursor (and written out) per batch
+EXPORT_CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+def _genre_names(dialect):
+    # A book's genres as one comma-separated string
+    if dialect == 'postgresql':
+        names = func.string_agg(Genre.name, ', ')
+    else:
+        names = func.group_concat(Genre.name, ', ')
+    return db.select([names]).select_from(
+        book_genre.join(Genre.__table__, Genre.id == book_genre.c.genre_id)
+    ).where(book_genre.c.book_id == Book.id).scalar_subquery()
+
+
+class Dataset:
+    """An exportable table: its columns and the timestamps that mark a row as changed"""
+
+    def __init__(self, name, columns, watermarks, select_from=None):
+        self.name = name
+        self.columns = columns
+        self.watermarks = watermarks
+        self.select_from = select_from
+
+    def statement(self, dialect, since=None, until=None, conditions=()):
+        """SELECT for the rows changed in (since, until] and matching conditions, oldest id first"""
+        columns = [column(dialect) if callable(column) else column for column in self.columns.values()]
+        statement = db.select([c.label(name) for name, c in zip(self.columns, columns)])
+        if self.select_from is not None:
+            statement = statement.select_from(self.select_from())
+        if since is not None or until is not None:
+            changed = []
+            for watermark in self.watermarks:
+                condition = [watermark.isnot(None)]
+                if since is not None:
+                    condition.append(watermark > since)
+                if until is not None:
+                    condition.append(watermark <= until)
+                changed.append(and_(*condition))
+            statement = statement.where(or_(*changed))
+        return statement.where(*conditions).order_by(list(self.columns.values())[0])
+
+    def high_watermark(self, connection):
+        """The newest change timestamp, or None for an empty table"""
+        values = connection.execute(db.select([func.max(watermark) for watermark in self.watermarks])).first()
+        values = [_as_datetime(value) for value in values if value is not None]
+        return max(values) if values else None
+
+
+DATASETS = {
+    'books': Dataset('books', {
+        'id': Book.id,
+        'title': Book.title,
+        'author': Book.author,
+        'isbn': Book.isbn,
+        'publisher': Book.publisher,
+        'publication_year': Book.publication_year,
+        'description': Book.description,
+        'genres': _genre_names,
+        'total_copies': Book.total_copies,
+        'available_copies': Book.available_copies,
+        'added_date': Book.added_date
+    }, watermarks=[Book.added_date]),
+    # Loans change twice: when they go out and when they come back
+    'loans': Dataset('loans', {
+        'id': Loan.id,
+        'user_id': Loan.user_id,
+        'username': User.username,
+        'book_id': Loan.book_id,
+        'isbn': Book.isbn,
+        'title': Book.title,
+        'checkout_date': Loan.checkout_date,
+        'due_date': Loan.due_date,
+        'return_date': Loan.return_date,
+        'returned': Loan.returned,
+        'renewed_count': Loan.renewed_count
+    }, watermarks=[Loan.checkout_date, Loan.return_date],
+       select_from=lambda: Loan.__table__.join(User.__table__, User.id == Loan.user_id)
+                                         .join(Book.__table__, Book.id == Loan.book_id)),
+    # Password hashes never leave the database
+    'users': Dataset('users', {
+        'id': User.id,
+        'username': User.username,
+        'email': User.email,
+        'first_name': User.first_name,
+        'last_name': User.last_name,
+        'is_admin': User.is_admin,
+        'created_at': User.created_at
+    }, watermarks=[User.created_at])
+}
+
+
+def _as_datetime(value):
+    # SQLite hands back aggregates over DateTime columns as plain strings
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def parse_watermark(value):
+    """Parse an ISO 8601 timestamp from a request or the command line
+
+    Raises ValueError for anything else.
+    """
+    if not value:
+        return None
+    value = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    # Stored timestamps are naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _csv_chunks(columns, types, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _jsonl_chunks(columns, types, batches):
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(columns, row)), default=_json_value) + '\n' for row in rows
+        ).encode('utf-8')
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_type(pyarrow, column_type):
+    if isinstance(column_type, db.Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, db.Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, db.DateTime):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+
+def _parquet_chunks(columns, types, batches):
+    # One row group per batch, streamed out as soon as it is written; the
+    # footer goes last, so only a finished download is a readable file
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([(name, _arrow_type(pyarrow, column_type))
+                             for name, column_type in zip(columns, types)])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        writer.write_table(pyarrow.Table.from_pydict({
+            name: [row[i] for row in rows] for i, name in enumerate(columns)
+        }, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': _csv_chunks, 'jsonl': _jsonl_chunks, 'parquet': _parquet_chunks}
+
+
+def check_format(format):
+    """Fail early (before any response is sent) on an unusable format"""
+    if format not in WRITERS:
+        raise ValueError(f'unknown export format {format!r}')
+    if format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ValueError('Parquet export needs the pyarrow package (requirements-optional.txt)')
+
+
+def export_watermark(dataset, since=None):
+    """Upper bound for an export: rows changed after it go in the next run"""
+    with db.engine.connect() as connection:
+        until = DATASETS[dataset].high_watermark(connection)
+    # Nothing new since the last run: keep the old watermark
+    if until is None or (since is not None and until < since):
+        return since
+    return until
+
+
+def export_rows(dataset, format, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE, conditions=()):
+    """Yield the encoded export of a dataset, batch by batch
+
+    Rows are read through a server-side cursor (where the driver supports
+    one) on a connection of its own, so the export holds one batch in
+    memory at a time however large the table is. ``conditions`` narrow it
+    to a filtered selection, such as the admin user directory's.
+    """
+    check_format(format)
+    export = DATASETS[dataset]
+    connection = db.engine.connect()
+    try:
+        statement = export.statement(connection.dialect.name, since=since, until=until, conditions=conditions)
+        result = connection.execution_options(stream_results=True).execute(statement)
+        batches = (list(map(tuple, rows)) for rows in result.partitions(chunk_size))
+        types = [column.type for column in statement.selected_columns]
+        yield from WRITERS[format](list(export.columns), types, batches)
+    finally:
+        connection.close()
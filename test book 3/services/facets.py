@@ -0,0 +1,184 @@
+from models.book import Book, Genre, book_genre
+from services.cache import genre_tag, BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG
+from sqlalchemy import String, case, cast, func, literal, select, union_all
+from urllib.parse import urlencode
+
+# Publication years are counted per decade
+DECADE = 10
+
+# Publishers listed by count before the rest are left out (selected ones always show)
+PUBLISHER_LIMIT = 15
+
+# Every facet a count can belong to, and the tags their counts depend on
+FACETS = ('genre', 'year', 'publisher', 'available')
+FACET_TAGS = [BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG]
+
+
+class BookFilters:
+    """The /books filters: any of several genres or publishers, a year range and availability"""
+
+    def __init__(self, genres=(), publishers=(), year_from=None, year_to=None, availability=None):
+        self.genres = sorted(set(genres))
+        self.publishers = sorted(set(publishers))
+        self.year_from = year_from
+        self.year_to = year_to
+        self.availability = availability if availability in ('yes', 'no') else None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(genres=[genre_id for genre_id in args.getlist('genre', type=int) if genre_id],
+                   publishers=[publisher for publisher in args.getlist('publisher') if publisher],
+                   year_from=args.get('year_from', None, type=int),
+                   year_to=args.get('year_to', None, type=int),
+                   availability=args.get('available'))
+
+    def conditions(self, exclude=None):
+        """WHERE clauses on the book table for every filter but the excluded facet's"""
+        table = Book.__table__
+        clauses = []
+        if self.genres and exclude != 'genre':
+            clauses.append(table.c.id.in_(
+                select(book_genre.c.book_id).where(book_genre.c.genre_id.in_(self.genres))))
+        if self.publishers and exclude != 'publisher':
+            clauses.append(table.c.publisher.in_(self.publishers))
+        if exclude != 'year':
+            if self.year_from is not None:
+                clauses.append(table.c.publication_year >= self.year_from)
+            if self.year_to is not None:
+                clauses.append(table.c.publication_year <= self.year_to)
+        if exclude != 'available':
+            if self.availability == 'yes':
+                clauses.append(table.c.available_copies > 0)
+            elif self.availability == 'no':
+                clauses.append(table.c.available_copies == 0)
+        return clauses
+
+    def args(self, **changes):
+        """Query-string arguments for url_for, with some filters replaced"""
+        args = {
+            'genre': self.genres,
+            'publisher': self.publishers,
+            'year_from': self.year_from,
+            'year_to': self.year_to,
+            'available': self.availability,
+        }
+        args.update(changes)
+        return {name: value for name, value in args.items() if value not in (None, '', [])}
+
+    def toggled(self, facet, value):
+        """Arguments with one genre or publisher added, or removed if already selected"""
+        selected = self.genres if facet == 'genre' else self.publishers
+        values = [item for item in selected if item != value] if value in selected else selected + [value]
+        return self.args(**{facet: values})
+
+    @property
+    def key(self):
+        """The filters as one canonical string, for fragment cache keys"""
+        return urlencode(self.args(), doseq=True)
+
+    @property
+    def active(self):
+        return bool(self.args())
+
+    def cache_tags(self):
+        """Tags for a listing under these filters, dropped when its membership can change"""
+        tags = [genre_tag(genre_id) for genre_id in self.genres] or [BOOKS_TAG]
+        if self.availability:
+            tags.append(AVAILABILITY_TAG)
+        if self.publishers or self.year_from is not None or self.year_to is not None:
+            tags.append(FACETS_TAG)
+        return tags
+
+
+def facet_counts_statement(filters):
+    """Counts for every facet value in one UNION ALL query
+
+    Each facet is counted under all the other filters but not its own, so
+    the alternatives to a selected genre or decade keep their counts.
+    Every genre is listed, with zero if none of the matching books has it.
+    """
+    table = Book.__table__
+
+    def labelled(facet, value, label, count):
+        return (literal(facet, String).label('facet'), cast(value, String).label('value'),
+                cast(label, String).label('label'), count.label('count'))
+
+    matching = select(table.c.id).where(*filters.conditions(exclude='genre')).subquery()
+    genres = select(*labelled('genre', Genre.id, Genre.name, func.count(matching.c.id))).select_from(
+        Genre.__table__
+        .outerjoin(book_genre, book_genre.c.genre_id == Genre.id)
+        .outerjoin(matching, matching.c.id == book_genre.c.book_id)
+    ).group_by(Genre.id, Genre.name)
+
+    decade = table.c.publication_year / DECADE * DECADE
+    years = select(*labelled('year', decade, decade, func.count())).where(
+        table.c.publication_year.isnot(None), *filters.conditions(exclude='year')
+    ).group_by(decade)
+
+    publishers = select(*labelled('publisher', table.c.publisher, table.c.publisher, func.count())).where(
+        table.c.publisher.isnot(None), table.c.publisher != '', *filters.conditions(exclude='publisher')
+    ).group_by(table.c.publisher)
+
+    available = case((table.c.available_copies > 0, 'yes'), else_='no')
+    availability = select(*labelled('available', available, available, func.count())).where(
+        *filters.conditions(exclude='available')
+    ).group_by(available)
+
+    return union_all(genres, years, publishers, availability)
+
+
+class FacetValue:
+    __slots__ = ('value', 'label', 'count', 'selected')
+
+    def __init__(self, value, label, count, selected):
+        self.value = value
+        self.label = label
+        self.count = count
+        self.selected = selected
+
+
+class FacetCounts:
+    """Facet values with their counts, grouped and ordered for the sidebar
+
+    rows are the result of facet_counts_statement, or a callable returning
+    it; the query then only runs if the sidebar is rendered rather than
+    served from the fragment cache.
+    """
+
+    def __init__(self, filters, rows):
+        self.filters = filters
+        self._rows = rows
+        self._grouped = None
+
+    def __getitem__(self, facet):
+        if self._grouped is None:
+            self._grouped = self._group(self._rows() if callable(self._rows) else self._rows)
+        return self._grouped[facet]
+
+    def _group(self, rows):
+        filters = self.filters
+        grouped = {facet: [] for facet in FACETS}
+        for facet, value, label, count in rows:
+            if facet == 'genre':
+                value = int(value)
+                selected = value in filters.genres
+            elif facet == 'year':
+                value = int(value)
+                selected = (filters.year_from, filters.year_to) == (value, value + DECADE - 1)
+                label = f'{value}s'
+            elif facet == 'publisher':
+                selected = value in filters.publishers
+            else:
+                selected = value == filters.availability
+            grouped[facet].append(FacetValue(value, label, count, selected))
+
+        grouped['genre'].sort(key=lambda item: item.label)
+        grouped['year'].sort(key=lambda item: item.value, reverse=True)
+        grouped['available'].sort(key=lambda item: item.value, reverse=True)
+        publishers = sorted(grouped['publisher'], key=lambda item: (-item.count, item.label))
+        grouped['publisher'] = [item for index, item in enumerate(publishers)
+                                if index < PUBLISHER_LIMIT or item.selected]
+        # A selected publisher nothing else matches still needs its checkbox
+        listed = {item.value for item in grouped['publisher']}
+        grouped['publisher'] += [FacetValue(name, name, 0, True) for name in filters.publishers if name not in listed]
+        return grouped
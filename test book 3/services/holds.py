@@ -0,0 +1,251 @@
+from app import db, cache
+from models.book import Book
+from models.hold import Hold, WAITING, READY, FULFILLED, CANCELLED, EXPIRED
+from models.loan import Loan
+from services.cache import hold_tag, book_tag, AVAILABILITY_TAG
+from services.stats import adjust_stats
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+
+ACTIVE = (WAITING, READY)
+
+# Ready holds expired per sweeper transaction
+EXPIRE_CHUNK_SIZE = 200
+
+
+class HoldError(Exception):
+    """A hold cannot be placed; the message is meant for the patron"""
+
+
+def _queue_key(book_id):
+    return f'holds:queue:{book_id}'
+
+
+def queue_statement(book_id):
+    """Active holds on a book in queue order"""
+    table = Hold.__table__
+    return select(table.c.user_id, table.c.status, table.c.expires_at).where(
+        table.c.book_id == book_id, table.c.status.in_(ACTIVE)
+    ).order_by(table.c.position)
+
+
+def store_queue(book_id, rows):
+    """Cache a book's queue, built from the rows of queue_statement"""
+    queue = {
+        'waiting': [row.user_id for row in rows if row.status == WAITING],
+        'ready': {row.user_id: row.expires_at for row in rows if row.status == READY},
+    }
+    cache.set(_queue_key(book_id), queue, tags=[hold_tag(book_id)])
+    return queue
+
+
+def cached_queue(book_id):
+    return cache.get(_queue_key(book_id))
+
+
+def book_queue(book_id):
+    """A book's queue as {'waiting': [user ids in order], 'ready': {user id: expires_at}}
+
+    Served from the cache until the queue changes, so patrons checking
+    their place do not touch the hold or book tables.
+    """
+    queue = cached_queue(book_id)
+    if queue is None:
+        queue = store_queue(book_id, db.session.execute(queue_statement(book_id)).all())
+    return queue
+
+
+def hold_status(queue, user_id):
+    """A patron's hold in a queue: status, position (1 = next), queue_length, expires_at; or None"""
+    waiting = queue['waiting']
+    if user_id in queue['ready']:
+        return {'status': READY, 'position': 0, 'queue_length': len(waiting),
+                'expires_at': queue['ready'][user_id]}
+    if user_id in waiting:
+        return {'status': WAITING, 'position': waiting.index(user_id) + 1, 'queue_length': len(waiting),
+                'expires_at': None}
+    return None
+
+
+def place_hold(user_id, book_id):
+    """Join the end of a book's queue; the caller commits
+
+    Raises HoldError if the patron already has the book or a hold on it,
+    or if a copy is free to check out instead.
+    """
+    book = Book.query.get(book_id)
+    if book is None:
+        raise HoldError('This book does not exist.')
+    if book.is_available() and not book_queue(book_id)['waiting']:
+        raise HoldError('A copy is available, you can check it out now.')
+    if Loan.query.filter_by(user_id=user_id, book_id=book_id, returned=False).first() is not None:
+        raise HoldError('You already have this book checked out.')
+    if Hold.query.filter(Hold.user_id == user_id, Hold.book_id == book_id, Hold.status.in_(ACTIVE)).first():
+        raise HoldError('You already have a hold on this book.')
+
+    # The unique (book, position) index turns a race for the same place into a retry
+    for attempt in range(3):
+        position = (db.session.query(func.max(Hold.position)).filter(Hold.book_id == book_id).scalar() or 0) + 1
+        try:
+            with db.session.begin_nested():
+                hold = Hold(user_id=user_id, book_id=book_id, position=position, status=WAITING)
+                db.session.add(hold)
+            return hold
+        except IntegrityError:
+            if Hold.query.filter(Hold.user_id == user_id, Hold.book_id == book_id,
+                                 Hold.status.in_(ACTIVE)).first():
+                raise HoldError('You already have a hold on this book.')
+    raise HoldError('The library is busy right now, please try again in a moment.')
+
+
+def release_copy(book_id, pickup_days, now=None):
+    """Hand a copy coming back to the next waiting hold, or return it to the shelf
+
+    Runs in the caller's transaction, so a return and the promotion it
+    causes commit together. Returns the promoted hold's id, or None if
+    nobody was waiting.
+    """
+    now = now or datetime.utcnow()
+    table = Hold.__table__
+    while True:
+        head = db.session.execute(
+            select(table.c.id).where(table.c.book_id == book_id, table.c.status == WAITING)
+            .order_by(table.c.position).limit(1)
+        ).first()
+        if head is None:
+            Book.put_back_copy(book_id)
+            return None
+        # Conditional, in case the hold was cancelled since it was read
+        promoted = db.session.execute(
+            table.update().where(table.c.id == head.id, table.c.status == WAITING)
+            .values(status=READY, ready_at=now, expires_at=now + timedelta(days=pickup_days))
+        ).rowcount
+        if promoted:
+            return head.id
+
+
+def add_copies(book_id, count, pickup_days, now=None):
+    """Put new copies into circulation, waiting holds first; returns the holds promoted
+
+    Runs in the caller's transaction, after total_copies was raised.
+    """
+    return sum(release_copy(book_id, pickup_days, now) is not None for _ in range(count))
+
+
+def _copy_counts(book_id):
+    books = Book.__table__
+    return db.session.execute(
+        select(books.c.available_copies, books.c.total_copies).where(books.c.id == book_id)).one()
+
+
+def _shelved(book_id):
+    """Keep the on-loan counter in step after a set-aside copy went back to the shelf"""
+    available, total = _copy_counts(book_id)
+    if available == total:
+        adjust_stats(books_on_loan=-1)
+
+
+def claim_hold(user_id, book_id):
+    """Turn the patron's ready hold into a checkout; True if they had one
+
+    The copy was set aside when the hold became ready, so the caller
+    creates the loan without taking another.
+    """
+    table = Hold.__table__
+    return db.session.execute(
+        table.update().where(table.c.user_id == user_id, table.c.book_id == book_id, table.c.status == READY)
+        .values(status=FULFILLED)
+    ).rowcount == 1
+
+
+def cancel_hold(user_id, book_id, pickup_days):
+    """Leave a book's queue; a copy set aside for the patron goes to the next one
+
+    Returns the status the hold had, or None if there was none. The caller commits.
+    """
+    hold = Hold.query.filter(Hold.user_id == user_id, Hold.book_id == book_id,
+                             Hold.status.in_(ACTIVE)).first()
+    if hold is None:
+        return None
+    previous = hold.status
+    table = Hold.__table__
+    cancelled = db.session.execute(
+        table.update().where(table.c.id == hold.id, table.c.status == previous).values(status=CANCELLED)
+    ).rowcount
+    if not cancelled:
+        return None
+    if previous == READY and release_copy(book_id, pickup_days) is None:
+        _shelved(book_id)
+    return previous
+
+
+def cancel_user_holds(user_id, pickup_days):
+    """Cancel all of a patron's holds (before deleting them); returns the book ids touched"""
+    book_ids = [book_id for book_id, in db.session.query(Hold.book_id).filter(
+        Hold.user_id == user_id, Hold.status.in_(ACTIVE))]
+    for book_id in book_ids:
+        cancel_hold(user_id, book_id, pickup_days)
+    return book_ids
+
+
+def invalidate_holds(*book_ids, shelved=()):
+    """Drop cached queues after a commit; shelved books also got a copy back"""
+    tags = [hold_tag(book_id) for book_id in book_ids]
+    tags += [book_tag(book_id) for book_id in shelved]
+    if shelved:
+        tags.append(AVAILABILITY_TAG)
+    if tags:
+        cache.invalidate(*tags)
+
+
+def expire_holds(config, now=None):
+    """Expire ready holds whose pickup window has passed and pass their copies on
+
+    Also promotes waiting holds on books that have a copy free (after
+    total_copies was raised, say). Returns (expired, promoted).
+    """
+    now = now or datetime.utcnow()
+    pickup_days = config['HOLD_PICKUP_DAYS']
+    table, books = Hold.__table__, Book.__table__
+    expired = promoted = 0
+
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.book_id).where(table.c.status == READY, table.c.expires_at < now)
+            .order_by(table.c.expires_at).limit(EXPIRE_CHUNK_SIZE)
+        ).all()
+        if not rows:
+            break
+        touched, shelved = set(), set()
+        for row in rows:
+            if db.session.execute(table.update().where(table.c.id == row.id, table.c.status == READY)
+                                  .values(status=EXPIRED)).rowcount:
+                expired += 1
+                touched.add(row.book_id)
+                if release_copy(row.book_id, pickup_days, now) is None:
+                    _shelved(row.book_id)
+                    shelved.add(row.book_id)
+                else:
+                    promoted += 1
+        db.session.commit()
+        invalidate_holds(*touched, shelved=shelved)
+
+    # Free copies with people still waiting for them
+    waiting_books = db.session.execute(
+        select(books.c.id).where(books.c.available_copies > 0, books.c.id.in_(
+            select(table.c.book_id).where(table.c.status == WAITING)))
+    ).scalars().all()
+    for book_id in waiting_books:
+        available, total = _copy_counts(book_id)
+        if available == total:
+            adjust_stats(books_on_loan=1)
+        while Book.take_copy(book_id):
+            if release_copy(book_id, pickup_days, now) is None:
+                # Nobody left in the queue; the copy goes back
+                _shelved(book_id)
+                break
+            promoted += 1
+        db.session.commit()
+        invalidate_holds(book_id, shelved=[book_id])
+    return expired, promoted
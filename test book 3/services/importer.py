@@ -0,0 +1,350 @@
+from app import db, cache
+from models.book import Book, Genre, book_genre
+from services.search import reindex_books
+from services.stats import adjust_stats, adjust_genre_counts
+from services.cache import genre_tag, BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG
+from sqlalchemy import bindparam, func
+import csv
+import io
+import json
+import os
+import re
+import time
+
+# Rows are validated, de-duplicated and written one chunk at a time (and one
+# transaction per chunk), so memory stays flat however large the file is.
+# Chunks also bound the IN lists, which must stay under SQLite's parameter limit.
+IMPORT_CHUNK_SIZE = 500
+
+# Only the first rejected rows are kept for the report; the rest are counted
+MAX_REJECTS_KEPT = 100
+
+FORMATS = ('csv', 'jsonl', 'marc')
+
+_EXTENSIONS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.json': 'jsonl',
+    '.mrc': 'marc',
+    '.marc': 'marc'
+}
+
+# Same rule as BookForm.validate_isbn
+_ISBN_RE = re.compile(r'^(\d{13}|\d{10}|[\d-]{17})$')
+
+_MAX_LENGTHS = {'title': 128, 'author': 128, 'isbn': 20, 'publisher': 128}
+_GENRE_MAX_LENGTH = 64
+_GENRE_SEPARATORS = re.compile(r'[|;]')
+
+# MARC 21 record structure (ISO 2709)
+_MARC_RECORD_END = b'\x1d'
+_MARC_FIELD_END = b'\x1e'
+_MARC_SUBFIELD = b'\x1f'
+
+
+class ImportResult:
+    """Counters, timing and the first few rejected rows of one import"""
+
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+        self.genres_created = 0
+        self.rejects = []
+        self.elapsed = 0.0
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if len(self.rejects) < MAX_REJECTS_KEPT:
+            self.rejects.append((line, reason))
+
+    @property
+    def rows_per_second(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (f'{self.imported} imported, {self.rejected} rejected of {self.read} rows '
+                f'in {self.elapsed:.1f}s ({self.rows_per_second:.0f} rows/s)')
+
+
+def detect_format(filename):
+    """Guess the import format from a file name, or None"""
+    return _EXTENSIONS.get(os.path.splitext(filename or '')[1].lower())
+
+
+def read_csv(stream):
+    """Yield (line, record) from a CSV file with a header row"""
+    reader = csv.DictReader(_text(stream))
+    for record in reader:
+        yield reader.line_num, {(key or '').strip().lower(): value for key, value in record.items()}
+
+
+def read_jsonl(stream):
+    """Yield (line, record) from a file holding one JSON object per line"""
+    for line, text in enumerate(_text(stream), start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            record = None
+        yield line, record if isinstance(record, dict) else None
+
+
+def read_marc(stream):
+    """Yield (record number, record) from a binary MARC 21 file
+
+    Only the fields a catalog entry needs are read: 020 ISBN, 100/110
+    author, 245 title, 260/264 publisher and year, 520 summary and 650/655
+    subjects (used as genres).
+    """
+    number = 0
+    while True:
+        length = stream.read(5)
+        if not length.strip():
+            return
+        number += 1
+        try:
+            data = length + stream.read(int(length) - 5)
+            yield number, _parse_marc(data)
+        except (ValueError, IndexError):
+            # The length prefix is all there is to resync on, so stop here
+            yield number, None
+            return
+
+
+def _text(stream):
+    # Uploads and files opened in binary mode are decoded as they are read
+    if isinstance(stream, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+
+def _parse_marc(data):
+    leader = data[:24].decode('ascii')
+    encoding = 'utf-8' if leader[9] == 'a' else 'latin-1'
+    base = int(leader[12:17])
+    directory = data[24:data.index(_MARC_FIELD_END)]
+
+    fields = {}
+    for start in range(0, len(directory) - 11, 12):
+        entry = directory[start:start + 12].decode('ascii')
+        tag, length, offset = entry[:3], int(entry[3:7]), int(entry[7:12])
+        body = data[base + offset:base + offset + length].rstrip(_MARC_FIELD_END + _MARC_RECORD_END)
+        if tag < '010':
+            continue
+        subfields = {}
+        # Skip the two indicators, then split into code + value pairs
+        for chunk in body[2:].split(_MARC_SUBFIELD)[1:]:
+            if chunk:
+                subfields.setdefault(chr(chunk[0]), []).append(chunk[1:].decode(encoding, 'replace'))
+        fields.setdefault(tag, []).append(subfields)
+
+    def first(tags, code):
+        for tag in tags:
+            for subfields in fields.get(tag, []):
+                if subfields.get(code):
+                    return subfields[code][0]
+        return None
+
+    def strip_punctuation(value):
+        # Cataloguing punctuation (' /', ' :', trailing '.' or ',') is not part of the value
+        return value.strip().rstrip(' /:;,.').strip() if value else value
+
+    isbn = first(['020'], 'a')
+    title = strip_punctuation(first(['245'], 'a'))
+    subtitle = strip_punctuation(first(['245'], 'b'))
+    year = re.search(r'\d{4}', first(['264', '260'], 'c') or '')
+    return {
+        'isbn': isbn.split()[0] if isbn else None,
+        'title': f'{title}: {subtitle}' if title and subtitle else title,
+        'author': strip_punctuation(first(['100', '110'], 'a')),
+        'publisher': strip_punctuation(first(['264', '260'], 'b')),
+        'publication_year': year.group() if year else None,
+        'description': first(['520'], 'a'),
+        'genres': [strip_punctuation(subfields['a'][0])
+                   for tag in ('650', '655') for subfields in fields.get(tag, []) if subfields.get('a')]
+    }
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'marc': read_marc}
+
+
+def clean_record(record):
+    """Validate one parsed record, returning (book row, genre names)
+
+    Raises ValueError with the reason when the record cannot be imported.
+    """
+    if record is None:
+        raise ValueError('malformed record')
+
+    def value(*keys):
+        for key in keys:
+            item = record.get(key)
+            if item is not None and str(item).strip():
+                return str(item).strip()
+        return None
+
+    row = {
+        'title': value('title'),
+        'author': value('author'),
+        'isbn': value('isbn'),
+        'publisher': value('publisher'),
+        'description': value('description')
+    }
+    for field in ('title', 'author', 'isbn'):
+        if not row[field]:
+            raise ValueError(f'missing {field}')
+    for field, limit in _MAX_LENGTHS.items():
+        if row[field] and len(row[field]) > limit:
+            raise ValueError(f'{field} longer than {limit} characters')
+    if not _ISBN_RE.match(row['isbn']):
+        raise ValueError(f'invalid ISBN {row["isbn"]!r}')
+
+    try:
+        year = value('publication_year', 'year')
+        row['publication_year'] = int(year) if year else None
+        copies = int(value('total_copies', 'copies') or 1)
+    except ValueError:
+        raise ValueError('publication year and copies must be whole numbers')
+    if row['publication_year'] is not None and not 1000 <= row['publication_year'] <= 3000:
+        raise ValueError('publication year out of range')
+    if copies < 1:
+        raise ValueError('at least one copy is required')
+    row['total_copies'] = row['available_copies'] = copies
+
+    genres = record.get('genres') or []
+    if isinstance(genres, str):
+        genres = _GENRE_SEPARATORS.split(genres)
+    names = []
+    for name in genres:
+        name = str(name).strip()
+        if not name:
+            continue
+        if len(name) > _GENRE_MAX_LENGTH:
+            raise ValueError(f'genre longer than {_GENRE_MAX_LENGTH} characters')
+        if name.lower() not in (known.lower() for known in names):
+            names.append(name)
+    return row, names
+
+
+def _resolve_genres(connection, names, genre_ids, create):
+    """Map lower-cased genre names to ids, creating missing genres in one batch"""
+    missing = {name.lower(): name for name in names if name.lower() not in genre_ids}
+    if not missing:
+        return 0
+    table = Genre.__table__
+    lookup = db.select([table.c.id, table.c.name]).where(
+        func.lower(table.c.name).in_(bindparam('names', expanding=True)))
+
+    for row in connection.execute(lookup, {'names': list(missing)}):
+        genre_ids[row.name.lower()] = row.id
+    new = [name for key, name in missing.items() if key not in genre_ids]
+    if not new or not create:
+        return 0
+
+    connection.execute(table.insert(), [{'name': name} for name in new])
+    for row in connection.execute(lookup, {'names': [name.lower() for name in new]}):
+        genre_ids[row.name.lower()] = row.id
+    return len(new)
+
+
+def _import_chunk(chunk, result, genre_ids, create_genres):
+    """Write one chunk of cleaned rows in the current transaction
+
+    Returns the ids of the genres that gained books.
+    """
+    connection = db.session.connection()
+    book_table = Book.__table__
+
+    # Drop ISBNs repeated within the chunk or already in the catalog
+    isbns = {}
+    for line, row, names in chunk:
+        if row['isbn'] in isbns:
+            result.reject(line, f'duplicate ISBN {row["isbn"]} in file')
+        else:
+            isbns[row['isbn']] = (line, row, names)
+    existing = db.select([book_table.c.isbn]).where(book_table.c.isbn.in_(bindparam('isbns', expanding=True)))
+    for (isbn,) in connection.execute(existing, {'isbns': list(isbns)}):
+        line = isbns.pop(isbn)[0]
+        result.reject(line, f'ISBN {isbn} already in the catalog')
+
+    genres_created = _resolve_genres(
+        connection, {name for _, _, names in isbns.values() for name in names}, genre_ids, create_genres)
+    result.genres_created += genres_created
+    rows = []
+    for isbn, (line, row, names) in list(isbns.items()):
+        unknown = [name for name in names if name.lower() not in genre_ids]
+        if unknown:
+            result.reject(line, f'unknown genre {unknown[0]!r}')
+            del isbns[isbn]
+        else:
+            rows.append(row)
+    if not rows:
+        return set()
+
+    # One executemany for the books, then their ids back by (unique) ISBN
+    connection.execute(book_table.insert(), rows)
+    book_ids = dict(connection.execute(
+        db.select([book_table.c.isbn, book_table.c.id]).where(book_table.c.isbn.in_(bindparam('isbns', expanding=True))),
+        {'isbns': list(isbns)}
+    ).fetchall())
+
+    links = [{'book_id': book_ids[isbn], 'genre_id': genre_ids[name.lower()]}
+             for isbn, (_, _, names) in isbns.items() for name in names]
+    if links:
+        connection.execute(book_genre.insert(), links)
+
+    # Core inserts bypass the session's flush hooks, so sync by hand
+    reindex_books(connection, book_ids.values())
+    adjust_genre_counts(added=[link['genre_id'] for link in links])
+    adjust_stats(total_books=len(rows), total_genres=genres_created)
+    result.imported += len(rows)
+    return {link['genre_id'] for link in links}
+
+
+def import_books(stream, format, chunk_size=IMPORT_CHUNK_SIZE, create_genres=True, progress=None):
+    """Stream books from a CSV, JSON Lines or MARC file into the catalog
+
+    Each chunk is committed on its own, so an interrupted import keeps the
+    chunks already written and can simply be re-run: books whose ISBN is
+    already in the catalog are rejected, not duplicated.
+    """
+    if format not in READERS:
+        raise ValueError(f'unknown import format {format!r}')
+    result = ImportResult()
+    started = time.perf_counter()
+    genre_ids = {}
+    touched_genres = set()
+    chunk = []
+
+    def flush():
+        try:
+            touched_genres.update(_import_chunk(chunk, result, genre_ids, create_genres))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        chunk.clear()
+        if progress:
+            progress(result)
+
+    for line, record in READERS[format](stream):
+        result.read += 1
+        try:
+            row, names = clean_record(record)
+        except ValueError as e:
+            result.reject(line, str(e))
+            continue
+        chunk.append((line, row, names))
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    if result.imported:
+        cache.invalidate(BOOKS_TAG, AVAILABILITY_TAG, GENRES_TAG, FACETS_TAG,
+                         *[genre_tag(genre_id) for genre_id in touched_genres])
+    result.elapsed = time.perf_counter() - started
+    return result
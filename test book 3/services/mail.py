@@ -0,0 +1,126 @@
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
+import logging
+import smtplib
+import time
+
+logger = logging.getLogger(__name__)
+
+# What SMTPMailer.send did with a message: accepted, refused for good (a bad
+# address or a 5xx reply), or given up on after transient errors
+SENT = 'sent'
+REJECTED = 'rejected'
+FAILED = 'failed'
+
+
+class MailerUnavailable(Exception):
+    """The server refuses all our mail: bad credentials or a refused sender"""
+
+
+def build_message(config, to_address, to_name, subject, body):
+    """Plain-text email from the library's default sender"""
+    message = EmailMessage()
+    message['From'] = config['MAIL_DEFAULT_SENDER']
+    message['To'] = formataddr((to_name, to_address)) if to_name else to_address
+    message['Subject'] = subject
+    message['Message-ID'] = make_msgid(domain=config['MAIL_DEFAULT_SENDER'].rpartition('@')[2] or None)
+    message.set_content(body)
+    return message
+
+
+class SMTPMailer:
+    """Sends messages over one reused SMTP connection
+
+    The connection is opened lazily, kept for up to
+    MAIL_MESSAGES_PER_CONNECTION messages and reopened after errors.
+    Transient failures (dropped connections, timeouts, 4xx replies) are
+    retried with exponential backoff; permanent ones (5xx, refused
+    recipients) are not.
+    """
+
+    def __init__(self, config, backoff=1.0):
+        self.host = config['MAIL_SERVER']
+        self.port = config['MAIL_PORT']
+        self.use_tls = config['MAIL_USE_TLS']
+        self.username = config['MAIL_USERNAME']
+        self.password = config['MAIL_PASSWORD']
+        self.timeout = config['MAIL_TIMEOUT']
+        self.per_connection = config['MAIL_MESSAGES_PER_CONNECTION']
+        self.max_retries = config['MAIL_MAX_RETRIES']
+        self.backoff = backoff
+        self._smtp = None
+        self._sent_on_connection = 0
+        self.connections = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self._smtp = smtp
+        self._sent_on_connection = 0
+        self.connections += 1
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def send(self, message):
+        """Send one message, returning SENT, REJECTED or FAILED
+
+        REJECTED is only a 5xx reply to the recipient or the message itself;
+        connection problems end in FAILED after the retries, and the same
+        message may go through on a later run. Raises MailerUnavailable if
+        the server refuses the login or the sender, which no retry fixes.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                if self._smtp is None or self._sent_on_connection >= self.per_connection:
+                    self.close()
+                    self._connect()
+                self._smtp.send_message(message)
+                self._sent_on_connection += 1
+                return SENT
+            except smtplib.SMTPRecipientsRefused as e:
+                # smtplib reports a 421 (closing the connection) the same way
+                if all(code >= 500 for code, error in e.recipients.values()):
+                    logger.warning('Recipient refused: %s', message['To'])
+                    return REJECTED
+                logger.info('Temporary recipient failure for %s, retrying', message['To'])
+                self.close()
+            except smtplib.SMTPAuthenticationError as e:
+                self.close()
+                raise MailerUnavailable(f'SMTP login refused: {e.smtp_code} {e.smtp_error}') from e
+            except smtplib.SMTPSenderRefused as e:
+                self.close()
+                if e.smtp_code >= 500:
+                    raise MailerUnavailable(f'Sender {e.sender} refused: {e.smtp_code} {e.smtp_error}') from e
+                logger.info('Temporary SMTP failure (%s), retrying', e.smtp_code)
+            except smtplib.SMTPDataError as e:
+                if e.smtp_code >= 500:
+                    logger.warning('Message to %s rejected: %s %s', message['To'], e.smtp_code, e.smtp_error)
+                    return REJECTED
+                logger.info('Temporary SMTP failure (%s), retrying', e.smtp_code)
+                # Start the next attempt from a clean transaction
+                self.close()
+            except (smtplib.SMTPException, OSError) as e:
+                # Refused or dropped connections, timeouts, HELO/STARTTLS errors
+                logger.info('SMTP connection problem (%s), retrying', e)
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+        logger.error('Giving up on message to %s after %d attempts', message['To'], self.max_retries + 1)
+        return FAILED
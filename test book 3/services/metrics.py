@@ -0,0 +1,206 @@
+from flask import Response, current_app, g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from services.profiling import request_query_count
+from time import perf_counter
+import threading
+
+# Histogram bucket bounds, Prometheus style (each bucket counts values <= bound)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+# How many of the slowest statements a slow-request log entry lists
+SLOW_LOG_STATEMENTS = 10
+
+
+class Histogram:
+    """Cumulative bucket counts plus the running sum and count"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class EndpointMetrics:
+    """Everything recorded for one endpoint"""
+
+    def __init__(self):
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the current request"""
+
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            _add_template_time(perf_counter() - start)
+
+    def generate(self, *args, **kwargs):
+        # Streamed templates are timed chunk by chunk, excluding time spent
+        # waiting on the client between chunks
+        chunks = super().generate(*args, **kwargs)
+        while True:
+            start = perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                _add_template_time(perf_counter() - start)
+                return
+            _add_template_time(perf_counter() - start)
+            yield chunk
+
+
+def _add_template_time(elapsed):
+    if has_request_context() and '_request_start' in g:
+        g._template_time = g.get('_template_time', 0.0) + elapsed
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and '_request_start' in g:
+        context._metrics_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None:
+        return
+    elapsed = perf_counter() - start
+    g._sql_time = g.get('_sql_time', 0.0) + elapsed
+    statements = g.get('_sql_statements')
+    if statements is not None:
+        statements.append((elapsed, statement))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Per-endpoint latency, SQL and template timings exposed at /metrics
+
+    Turned on with METRICS_ENABLED. Figures are kept per process, so under a
+    multi-worker server each worker reports its own share. With
+    SLOW_REQUEST_THRESHOLD set, requests slower than that many seconds are
+    logged together with their slowest SQL statements.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_threshold = 0
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        if not self.enabled:
+            return
+        self.slow_threshold = app.config.get('SLOW_REQUEST_THRESHOLD', 0)
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        app.jinja_env.template_class = TimedTemplate
+
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def _start_request(self):
+        g._request_start = perf_counter()
+        if self.slow_threshold:
+            g._sql_statements = []
+
+    def _record_status(self, response):
+        g._response_status = response.status_code
+        return response
+
+    def _finish_request(self, exc=None):
+        # Teardown runs after a streamed body is sent, so this covers all of it
+        start = g.pop('_request_start', None)
+        if start is None:
+            return
+        duration = perf_counter() - start
+        endpoint = request.endpoint or '<unmatched>'
+        status = g.get('_response_status', 500 if exc else 200)
+        statement_count = request_query_count()
+        sql_time = g.get('_sql_time', 0.0)
+        template_time = g.get('_template_time', 0.0)
+
+        with self._lock:
+            metrics = self._endpoints.setdefault(endpoint, EndpointMetrics())
+            key = (request.method, status)
+            metrics.responses[key] = metrics.responses.get(key, 0) + 1
+            metrics.latency.observe(duration)
+            metrics.statements.observe(statement_count)
+            metrics.sql_seconds += sql_time
+            metrics.template_seconds += template_time
+
+        if self.slow_threshold and duration >= self.slow_threshold:
+            slowest = sorted(g.get('_sql_statements', []), key=lambda s: s[0], reverse=True)
+            lines = [f'  {elapsed * 1000:8.2f} ms  {" ".join(statement.split())}'
+                     for elapsed, statement in slowest[:SLOW_LOG_STATEMENTS]]
+            current_app.logger.warning(
+                'Slow request %s %s (%s): %.3fs total, %d SQL statements in %.3fs, '
+                'templates %.3fs\n%s',
+                request.method, request.full_path, endpoint, duration,
+                statement_count, sql_time, template_time, '\n'.join(lines)
+            )
+
+    def export(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            snapshot = sorted(self._endpoints.items())
+            lines = []
+
+            lines.append('# HELP library_requests_total Requests handled, by endpoint, method and status')
+            lines.append('# TYPE library_requests_total counter')
+            for endpoint, metrics in snapshot:
+                for (method, status), count in sorted(metrics.responses.items()):
+                    lines.append(f'library_requests_total{{endpoint="{_escape_label(endpoint)}",'
+                                 f'method="{method}",status="{status}"}} {count}')
+
+            for name, help_text, attr in (
+                ('library_request_duration_seconds', 'Request latency', 'latency'),
+                ('library_request_sql_statements', 'SQL statements issued per request', 'statements'),
+            ):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for endpoint, metrics in snapshot:
+                    histogram = getattr(metrics, attr)
+                    label = f'endpoint="{_escape_label(endpoint)}"'
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{label}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{label}}} {histogram.count}')
+
+            for name, help_text, attr in (
+                ('library_sql_seconds_total', 'Time spent executing SQL', 'sql_seconds'),
+                ('library_template_seconds_total', 'Time spent rendering templates', 'template_seconds'),
+            ):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint, metrics in snapshot:
+                    lines.append(f'{name}{{endpoint="{_escape_label(endpoint)}"}} {getattr(metrics, attr)}')
+
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
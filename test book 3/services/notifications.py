@@ -0,0 +1,297 @@
+from app import db
+from models.book import Book
+from models.loan import Loan
+from models.user import User
+from models.notice import LoanNotice, Fine
+from models.hold import Hold, READY
+from services.holds import expire_holds
+from services.mail import SMTPMailer, MailerUnavailable, build_message, SENT, FAILED
+from sqlalchemy import and_, or_, bindparam
+from itertools import groupby
+from datetime import datetime, timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+DUE_SOON = 'due_soon'
+OVERDUE = 'overdue'
+
+# Overdue loans fetched per fine assessment chunk
+FINE_CHUNK_SIZE = 500
+
+# Sends in a row that may give up on transient errors before a run stops;
+# by then the mail server is down, not one recipient's address bad
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+def fine_for(days_overdue, config):
+    """Late fee in cents for a loan this many days overdue"""
+    return min(max(days_overdue, 0) * config['FINE_PER_DAY_CENTS'], config['FINE_MAX_CENTS'])
+
+
+def assess_fines(config, now=None):
+    """Bring the fine of every overdue active loan up to date
+
+    Overdue loans are read with one range scan on the active due-date
+    index and their fines written back with one executemany per chunk.
+    Returns the number of loans assessed.
+    """
+    now = now or datetime.utcnow()
+    loan_table, fine_table = Loan.__table__, Fine.__table__
+    update = fine_table.update().where(
+        fine_table.c.loan_id == bindparam('id'), fine_table.c.paid == False
+    ).values(days_overdue=bindparam('days'), amount_cents=bindparam('amount'), assessed_at=now)
+    assessed = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select([loan_table.c.id, loan_table.c.due_date, fine_table.c.loan_id.label('has_fine')])
+            .select_from(loan_table.outerjoin(fine_table, fine_table.c.loan_id == loan_table.c.id))
+            .where(loan_table.c.returned == False, loan_table.c.due_date < now, loan_table.c.id > last_id)
+            .order_by(loan_table.c.id)
+            .limit(FINE_CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        fines = [{'id': row.id, 'days': (now - row.due_date).days,
+                  'amount': fine_for((now - row.due_date).days, config)} for row in rows]
+        existing = [fine for fine, row in zip(fines, rows) if row.has_fine is not None]
+        new = [{'loan_id': fine['id'], 'days_overdue': fine['days'], 'amount_cents': fine['amount'],
+                'paid': False, 'assessed_at': now} for fine, row in zip(fines, rows) if row.has_fine is None]
+        if existing:
+            db.session.execute(update, existing)
+        if new:
+            db.session.execute(fine_table.insert(), new)
+        db.session.commit()
+        assessed += len(rows)
+    return assessed
+
+
+def _pending_notices(config, now):
+    """Query every active loan that is due soon or overdue and still owes a notice
+
+    Due-soon notices go out once; overdue reminders repeat every
+    NOTICE_REMINDER_DAYS. Rows come back grouped by user.
+    """
+    due_soon_until = now + timedelta(days=config['NOTICE_DUE_SOON_DAYS'])
+    remind_after = now - timedelta(days=config['NOTICE_REMINDER_DAYS'])
+
+    def notice_sent(kind, since=None):
+        conditions = [LoanNotice.loan_id == Loan.id, LoanNotice.kind == kind]
+        if since is not None:
+            conditions.append(LoanNotice.sent_at > since)
+        return db.session.query(LoanNotice.id).filter(*conditions).exists()
+
+    return db.session.query(
+        Loan.id, Loan.user_id, Loan.due_date,
+        User.email, User.first_name, User.username,
+        Book.title, Fine.amount_cents
+    ).join(User, User.id == Loan.user_id).join(Book, Book.id == Loan.book_id).outerjoin(
+        Fine, Fine.loan_id == Loan.id
+    ).filter(
+        Loan.returned == False,
+        Loan.due_date < due_soon_until,
+        or_(and_(Loan.due_date >= now, ~notice_sent(DUE_SOON)),
+            and_(Loan.due_date < now, ~notice_sent(OVERDUE, remind_after)))
+    ).order_by(Loan.user_id, Loan.due_date)
+
+
+def _batches(query, batch_size):
+    """Yield lists of rows covering whole users, seeking by user id
+
+    Each batch is fully read before its mail is sent, so no cursor stays
+    open while the worker writes its notice records.
+    """
+    last_user = 0
+    while True:
+        rows = query.filter(Loan.user_id > last_user).limit(batch_size).all()
+        if not rows:
+            return
+        if len(rows) == batch_size:
+            # The last user's loans may continue past the limit
+            partial = rows[-1].user_id
+            complete = [row for row in rows if row.user_id != partial]
+            rows = complete or query.filter(Loan.user_id == partial).all()
+        yield rows
+        last_user = rows[-1].user_id
+
+
+def _compose(config, loans, now):
+    first = loans[0]
+    overdue = [loan for loan in loans if loan.due_date < now]
+    due_soon = [loan for loan in loans if loan.due_date >= now]
+
+    lines = [f'Hello {first.first_name or first.username},', '']
+    if overdue:
+        lines.append('These books are overdue. Please return them as soon as you can:')
+        for loan in overdue:
+            fine = f' (fine so far: ${loan.amount_cents / 100:.2f})' if loan.amount_cents else ''
+            lines.append(f'  - {loan.title}, due {loan.due_date.strftime("%B %d, %Y")}{fine}')
+        lines.append('')
+    if due_soon:
+        lines.append('These books are due back soon:')
+        for loan in due_soon:
+            lines.append(f'  - {loan.title}, due {loan.due_date.strftime("%B %d, %Y")}')
+        lines.append('')
+    lines.append('Thank you,')
+    lines.append('The Library')
+
+    subject = 'Overdue library books' if overdue else 'Library books due soon'
+    return build_message(config, first.email, first.first_name, subject, '\n'.join(lines))
+
+
+def send_notices(config, now=None, mailer=None):
+    """Email every patron one digest of their due-soon and overdue loans
+
+    Returns (emails sent, emails failed). Notices are recorded batch by
+    batch as they are delivered, so an interrupted run never repeats them;
+    permanently refused ones are recorded too. The run stops after
+    MAX_CONSECUTIVE_FAILURES transient give-ups in a row, or at once if the
+    server refuses the login or sender.
+    """
+    now = now or datetime.utcnow()
+    sent = failed = failures = 0
+    stop = None
+    own_mailer = mailer is None
+    mailer = mailer or SMTPMailer(config)
+    try:
+        for rows in _batches(_pending_notices(config, now), config['MAIL_BATCH_SIZE']):
+            records = []
+            for user_id, loans in groupby(rows, key=lambda row: row.user_id):
+                loans = list(loans)
+                try:
+                    status = mailer.send(_compose(config, loans, now))
+                except MailerUnavailable as e:
+                    # Nothing more will go out; what this batch sent is still recorded
+                    failed += 1
+                    stop = str(e)
+                    break
+                if status == FAILED:
+                    failed += 1
+                    failures += 1
+                    if failures >= MAX_CONSECUTIVE_FAILURES:
+                        # The mail server is unreachable; the rest would fail the same way
+                        stop = f'{failures} notices in a row could not be delivered'
+                        break
+                    continue
+                failures = 0
+                if status == SENT:
+                    sent += 1
+                else:
+                    failed += 1
+                # A refused address is recorded as well, so it is not retried
+                # ahead of everyone else on every run
+                records.extend({'loan_id': loan.id, 'kind': OVERDUE if loan.due_date < now else DUE_SOON,
+                                'sent_at': now} for loan in loans)
+            if records:
+                db.session.execute(LoanNotice.__table__.insert(), records)
+            db.session.commit()
+            if stop:
+                logger.error('%s, stopping', stop)
+                break
+    finally:
+        if own_mailer:
+            mailer.close()
+    return sent, failed
+
+
+def _compose_hold(config, hold):
+    lines = [
+        f'Hello {hold.first_name or hold.username},',
+        '',
+        f'A copy of "{hold.title}" is waiting for you at the library. It is held in your name',
+        f'until {hold.expires_at.strftime("%B %d, %Y")}; after that it goes to the next person in line.',
+        '',
+        'Thank you,',
+        'The Library',
+    ]
+    return build_message(config, hold.email, hold.first_name, 'Your library hold is ready', '\n'.join(lines))
+
+
+def send_hold_notices(config, now=None, mailer=None):
+    """Email every patron whose hold has a copy waiting, once per hold
+
+    Returns (emails sent, emails failed). Ready holds not yet notified are
+    found through a partial index and marked as their mail goes out, or is
+    refused for good.
+    """
+    now = now or datetime.utcnow()
+    sent = failed = failures = 0
+    stop = None
+    own_mailer = mailer is None
+    mailer = mailer or SMTPMailer(config)
+    hold_table = Hold.__table__
+    last_id = 0
+    try:
+        while True:
+            rows = db.session.query(
+                Hold.id, Hold.expires_at, User.email, User.first_name, User.username, Book.title
+            ).join(User, User.id == Hold.user_id).join(Book, Book.id == Hold.book_id).filter(
+                Hold.status == READY, Hold.notified_at.is_(None), Hold.id > last_id
+            ).order_by(Hold.id).limit(config['MAIL_BATCH_SIZE']).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            delivered = []
+            for row in rows:
+                try:
+                    status = mailer.send(_compose_hold(config, row))
+                except MailerUnavailable as e:
+                    # Nothing more will go out; what this batch sent is still recorded
+                    failed += 1
+                    stop = str(e)
+                    break
+                if status == FAILED:
+                    failed += 1
+                    failures += 1
+                    if failures >= MAX_CONSECUTIVE_FAILURES:
+                        # The mail server is unreachable; the rest would fail the same way
+                        stop = f'{failures} hold notices in a row could not be delivered'
+                        break
+                    continue
+                failures = 0
+                if status == SENT:
+                    sent += 1
+                else:
+                    failed += 1
+                # A refused address is marked too, or it would head every batch
+                delivered.append({'hold_id': row.id})
+            if delivered:
+                # Only holds still ready; one may have been picked up or expired meanwhile
+                db.session.execute(
+                    hold_table.update().where(hold_table.c.id == bindparam('hold_id'),
+                                              hold_table.c.status == READY).values(notified_at=now),
+                    delivered)
+            db.session.commit()
+            if stop:
+                logger.error('%s, stopping', stop)
+                break
+    finally:
+        if own_mailer:
+            mailer.close()
+    return sent, failed
+
+
+def run_notifications(config, now=None, mailer=None):
+    """One pass of the worker: expire uncollected holds, reassess fines, then send notices"""
+    now = now or datetime.utcnow()
+    holds_expired, holds_promoted = expire_holds(config, now)
+    fines = assess_fines(config, now)
+    result = {'fines': fines, 'sent': 0, 'failed': 0,
+              'holds_expired': holds_expired, 'holds_promoted': holds_promoted}
+    if not config['MAIL_SERVER'] and mailer is None:
+        logger.warning('MAIL_SERVER is not set, skipping notices')
+        return result
+    own_mailer = mailer is None
+    mailer = mailer or SMTPMailer(config)
+    try:
+        sent, failed = send_notices(config, now, mailer)
+        hold_sent, hold_failed = send_hold_notices(config, now, mailer)
+    finally:
+        if own_mailer:
+            mailer.close()
+    result.update(sent=sent + hold_sent, failed=failed + hold_failed)
+    return result
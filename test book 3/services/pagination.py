@@ -0,0 +1,154 @@
+from sqlalchemy import tuple_
+from datetime import datetime
+import base64
+import binascii
+import json
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+
+def _decode_value(value):
+    if set(value) == {'dt'}:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(values):
+    """Pack the sort key of a row into an opaque, URL-safe token"""
+    raw = json.dumps(list(values), default=_encode_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+# Types a sort key value can decode to; anything else was not made by encode_cursor
+_KEY_TYPES = (str, int, float, datetime, type(None))
+
+
+def decode_cursor(token, width=None):
+    """Unpack a cursor token, returning None if it is missing or malformed
+
+    ``width`` is the number of sort key columns; a cursor of another length
+    is malformed too, as it would not fit the seek condition.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw, object_hook=_decode_value)
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or not all(isinstance(value, _KEY_TYPES) for value in values):
+        return None
+    if width is not None and len(values) != width:
+        return None
+    return values
+
+
+class KeysetPage:
+    """One page of results located by seeking past a cursor instead of OFFSET
+
+    ``fetch(values, backwards, limit)`` returns up to ``limit`` ``(key, item)``
+    pairs that sort strictly after ``values`` (or before them when walking
+    backwards). Rows are fetched lazily on first access, so a streamed
+    template can flush its header before the query runs. ``width`` is the
+    number of sort key columns; cursors that do not match are ignored.
+    """
+
+    def __init__(self, fetch, per_page, after=None, before=None, width=None):
+        self._fetch = fetch
+        self.per_page = per_page
+        self.after = decode_cursor(after, width)
+        self.before = decode_cursor(before, width) if self.after is None else None
+        self._rows = None
+        self._more = False
+
+    def _load(self):
+        if self._rows is None:
+            backwards = self.before is not None
+            cursor = self.before if backwards else self.after
+            self._store(self._fetch(cursor, backwards, self.per_page + 1), backwards)
+        return self._rows
+
+    def _store(self, rows, backwards):
+        self._more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        self._rows = rows[::-1] if backwards else rows
+
+    async def prefetch(self, fetch):
+        """Load the page now with a coroutine ``fetch``, for the async views"""
+        backwards = self.before is not None
+        cursor = self.before if backwards else self.after
+        self._store(await fetch(cursor, backwards, self.per_page + 1), backwards)
+        return self
+
+    @property
+    def items(self):
+        return [item for key, item in self._load()]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self._load())
+
+    @property
+    def has_next(self):
+        self._load()
+        return self.before is not None or self._more
+
+    @property
+    def has_prev(self):
+        self._load()
+        return self.after is not None or (self.before is not None and self._more)
+
+    @property
+    def next_cursor(self):
+        rows = self._load()
+        return encode_cursor(rows[-1][0]) if rows and self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        rows = self._load()
+        return encode_cursor(rows[0][0]) if rows and self.has_prev else None
+
+
+def _seek(query, columns, values, backwards, descending):
+    # Works on ORM queries and Core/2.0-style selects alike
+    seek_down = descending != backwards
+    if values is not None:
+        key = tuple_(*columns)
+        query = query.filter(key < tuple_(*values) if seek_down else key > tuple_(*values))
+        if len(columns) > 1:
+            # Implied by the row comparison, but SQLite only seeks an index on
+            # expression keys (coalesce(...)) through a plain bound like this
+            query = query.filter(columns[0] <= values[0] if seek_down else columns[0] >= values[0])
+    return query.order_by(*[column.desc() if seek_down else column.asc() for column in columns])
+
+
+def _keyed(items, columns):
+    return [([getattr(item, column.key) for column in columns], item) for item in items]
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None, descending=False):
+    """Paginate an ORM query by the given unique sort key (last column breaks ties)"""
+    def fetch(values, backwards, limit):
+        return _keyed(_seek(query, columns, values, backwards, descending).limit(limit), columns)
+
+    return KeysetPage(fetch, per_page, after=after, before=before, width=len(columns))
+
+
+async def keyset_paginate_async(session, statement, columns, per_page, after=None, before=None,
+                                descending=False, scalars=False):
+    """keyset_paginate for a select() run on an AsyncSession, loaded right away
+
+    Pass scalars=True when the statement selects a single ORM entity.
+    """
+    async def fetch(values, backwards, limit):
+        result = await session.execute(_seek(statement, columns, values, backwards, descending).limit(limit))
+        return _keyed(result.scalars().all() if scalars else result.all(), columns)
+
+    return await KeysetPage(None, per_page, after=after, before=before,
+                            width=len(columns)).prefetch(fetch)
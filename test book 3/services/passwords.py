@@ -0,0 +1,108 @@
+from flask import current_app
+from werkzeug.security import gen_salt, check_password_hash, generate_password_hash
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import threading
+
+# PASSWORD_HASH_METHOD values; hashes made with anything else (older
+# werkzeug defaults, benchmark fixtures) still verify and are upgraded
+METHODS = ('pbkdf2:sha256', 'scrypt')
+
+SALT_LENGTH = 16
+
+
+class PasswordsBusy(Exception):
+    """Every hashing worker is taken and the queue is full"""
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'),
+                          n=n, r=r, p=p, maxmem=132 * n * r * p).hex()
+
+
+def hash_password(password, method, iterations, scrypt_params):
+    """Hash in werkzeug's "<method>$<salt>$<hash>" format, scrypt laid out as werkzeug 2.3+ does"""
+    if method == 'pbkdf2:sha256':
+        return generate_password_hash(password, method=f'pbkdf2:sha256:{iterations}', salt_length=SALT_LENGTH)
+    if method == 'scrypt':
+        n, r, p = scrypt_params
+        salt = gen_salt(SALT_LENGTH)
+        return f'scrypt:{n}:{r}:{p}${salt}${_scrypt(password, salt, n, r, p)}'
+    raise ValueError(f'Unknown PASSWORD_HASH_METHOD {method!r}')
+
+
+def verify_password(stored, password):
+    if not stored:
+        return False
+    if stored.startswith('scrypt:'):
+        try:
+            method, salt, expected = stored.split('$', 2)
+            n, r, p = (int(value) for value in method.split(':')[1:])
+        except ValueError:
+            return False
+        return hmac.compare_digest(_scrypt(password, salt, n, r, p), expected)
+    return check_password_hash(stored, password)
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded pool of threads
+
+    hashlib releases the GIL while it runs PBKDF2 and scrypt, so the pool
+    really is PASSWORD_HASH_WORKERS cores of hashing and no more. Once
+    that many are busy and PASSWORD_HASH_QUEUE more are waiting, further
+    calls raise PasswordsBusy straight away instead of tying up a worker,
+    which keeps a login rush from starving the catalog pages.
+    """
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['PASSWORD_HASH_METHOD'] not in METHODS:
+            raise ValueError(f"Unknown PASSWORD_HASH_METHOD {app.config['PASSWORD_HASH_METHOD']!r}")
+        app.extensions['passwords'] = self
+
+    def _pool(self, config):
+        with self._lock:
+            if self._executor is None:
+                workers = config['PASSWORD_HASH_WORKERS']
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+                self._slots = threading.BoundedSemaphore(workers + config['PASSWORD_HASH_QUEUE'])
+        return self._executor
+
+    def _run(self, function, *args):
+        config = current_app.config
+        if config['PASSWORD_HASH_WORKERS'] == 0:
+            return function(*args)
+        executor = self._pool(config)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordsBusy('Too many sign-ins at once, please try again in a moment.')
+        try:
+            return executor.submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _settings(config):
+        return (config['PASSWORD_HASH_METHOD'], config['PASSWORD_PBKDF2_ITERATIONS'],
+                (config['PASSWORD_SCRYPT_N'], config['PASSWORD_SCRYPT_R'], config['PASSWORD_SCRYPT_P']))
+
+    def prefix(self):
+        """The method part of a hash made with the current settings"""
+        method, iterations, (n, r, p) = self._settings(current_app.config)
+        return f'pbkdf2:sha256:{iterations}' if method == 'pbkdf2:sha256' else f'scrypt:{n}:{r}:{p}'
+
+    def hash(self, password):
+        return self._run(hash_password, password, *self._settings(current_app.config))
+
+    def verify(self, stored, password):
+        return self._run(verify_password, stored, password)
+
+    def needs_rehash(self, stored):
+        """Whether a hash was made with another algorithm or cost than configured"""
+        return not stored or stored.split('$', 1)[0] != self.prefix()
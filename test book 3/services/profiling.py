@@ -0,0 +1,54 @@
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g._query_count = g.get('_query_count', 0) + 1
+
+
+def request_query_count():
+    """Number of statements the current request has issued so far"""
+    return g.get('_query_count', 0)
+
+
+class QueryCounter:
+    """Count the SQL statements each request issues and flag chatty endpoints
+
+    Requests that go over SQL_QUERY_WARN_THRESHOLD statements are logged as
+    warnings. In debug mode the running count is also sent in an
+    ``X-Query-Count`` header and is available to templates as query_count().
+    """
+
+    def __init__(self, app=None):
+        self.threshold = 20
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold = app.config.get('SQL_QUERY_WARN_THRESHOLD', 20)
+        if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+            event.listen(Engine, 'before_cursor_execute', _count_statement)
+
+        app.after_request(self._add_header)
+        app.teardown_request(self._report)
+        app.jinja_env.globals['query_count'] = self.count
+
+    def count(self):
+        return request_query_count()
+
+    def _add_header(self, response):
+        # Streamed bodies keep querying after this point, the log has the final total
+        if current_app.debug:
+            response.headers['X-Query-Count'] = str(self.count())
+        return response
+
+    def _report(self, exc=None):
+        # Teardown runs once a streamed body has been fully sent
+        count = self.count()
+        if count > self.threshold:
+            current_app.logger.warning('%s issued %d SQL statements (threshold %d)',
+                                       request.endpoint, count, self.threshold)
+        else:
+            current_app.logger.debug('%s issued %d SQL statements', request.endpoint, count)
@@ -0,0 +1,125 @@
+from app import db
+from models.book import Book
+from models.loan import Loan
+from models.user import User
+from models.stats import BookDailyLoans, UserDailyLoans
+from sqlalchemy import cast, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta
+
+# Report windows in days; None is all time
+WINDOWS = {'7': 7, '30': 30, '365': 365, 'all': None}
+
+_UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _dialect():
+    return db.session.connection().dialect.name
+
+
+def _upsert(table, keys, rows_or_select):
+    """INSERT rows (or a SELECT), adding loan_count onto rows that already exist"""
+    insert = _UPSERT_INSERTS[_dialect()](table)
+    if isinstance(rows_or_select, dict):
+        insert = insert.values(**rows_or_select)
+    else:
+        insert = insert.from_select(list(rows_or_select.selected_columns.keys()), rows_or_select)
+    return db.session.execute(insert.on_conflict_do_update(
+        index_elements=keys,
+        set_={'loan_count': table.c.loan_count + insert.excluded.loan_count}
+    ))
+
+
+def record_checkout(book_id, user_id, day=None):
+    """Count a checkout in today's rollup rows, inside the current transaction
+
+    A single upsert per table, so concurrent checkouts of the same book on
+    the same day add up instead of colliding on the primary key.
+    """
+    day = day or datetime.utcnow().date()
+    _upsert(BookDailyLoans.__table__, ['day', 'book_id'], {'day': day, 'book_id': book_id, 'loan_count': 1})
+    _upsert(UserDailyLoans.__table__, ['day', 'user_id'], {'day': day, 'user_id': user_id, 'loan_count': 1})
+
+
+def _month_start(column):
+    if _dialect() == 'postgresql':
+        return cast(func.date_trunc('month', column), db.Date)
+    return func.date(column, 'start of month')
+
+
+def rebuild_rollups(retention_days=None):
+    """Recompute both rollup tables from the loan history, fixing any drift"""
+    for model, key in ((BookDailyLoans, Loan.book_id), (UserDailyLoans, Loan.user_id)):
+        table = model.__table__
+        db.session.execute(table.delete())
+        day = func.date(Loan.checkout_date)
+        db.session.execute(table.insert().from_select(
+            ['day', key.key, 'loan_count'],
+            db.select([day, key, func.count(Loan.id)])
+            .where(Loan.checkout_date.isnot(None))
+            .group_by(day, key)
+        ))
+    if retention_days is not None:
+        compact_rollups(retention_days)
+
+
+def compact_rollups(retention_days):
+    """Fold daily rows older than the retention window into monthly rows
+
+    Whole months before the cutoff are summed into one row dated the first
+    of the month, so the all-time totals do not change. Keep the retention
+    above the longest dated window (365 days). Returns the rows removed.
+    """
+    cutoff = datetime.utcnow().date() - timedelta(days=retention_days)
+    boundary = cutoff.replace(day=1)
+    removed = 0
+    for model, key in ((BookDailyLoans, 'book_id'), (UserDailyLoans, 'user_id')):
+        table = model.__table__
+        month = _month_start(table.c.day)
+        old_days = (table.c.day < boundary, table.c.day != month)
+        _upsert(table, ['day', key], db.select([
+            month.label('day'), table.c[key], func.sum(table.c.loan_count).label('loan_count')
+        ]).where(*old_days).group_by(month, table.c[key]))
+        removed += db.session.execute(table.delete().where(*old_days)).rowcount
+    return removed
+
+
+def _since(days):
+    return None if days is None else datetime.utcnow().date() - timedelta(days=days - 1)
+
+
+def _totals(model, key, days, limit):
+    since = _since(days)
+    query = db.session.query(
+        getattr(model, key).label('id'), func.sum(model.loan_count).label('loan_count')
+    )
+    if since is not None:
+        query = query.filter(model.day >= since)
+    return query.group_by(getattr(model, key)).order_by(
+        func.sum(model.loan_count).desc(), getattr(model, key)
+    ).limit(limit).subquery()
+
+
+def popular_books(days=None, limit=10):
+    """Query (Book, loan_count) for the most borrowed books in the last `days` days
+
+    Reads only the small daily rollup table, never the loan history.
+    """
+    totals = _totals(BookDailyLoans, 'book_id', days, limit)
+    return db.session.query(Book, totals.c.loan_count).join(
+        totals, totals.c.id == Book.id
+    ).order_by(totals.c.loan_count.desc(), Book.id)
+
+
+def active_users(days=None, limit=10):
+    """Query (User, loan_count) for the most active borrowers in the last `days` days"""
+    totals = _totals(UserDailyLoans, 'user_id', days, limit)
+    return db.session.query(User, totals.c.loan_count).join(
+        totals, totals.c.id == User.id
+    ).order_by(totals.c.loan_count.desc(), User.id)
+
+
+def trending_books(limit=4):
+    """Query (Book, loan_count) for this week's most borrowed books"""
+    return popular_books(days=7, limit=limit).options(selectinload(Book.genres))
@@ -0,0 +1,296 @@
+from app import db
+from models.book import Book, Genre
+from services.pagination import KeysetPage
+from services.user_directory import create_user_search_index, rebuild_user_search_index
+from services.trigrams import (create_trigram_index, rebuild_trigram_index, reindex_trigrams,
+                               similar_words, similar_words_async, ranked_books_sql)
+from sqlalchemy import event, inspect, text, bindparam
+from sqlalchemy.orm import selectinload
+import re
+
+# Name of the full-text index table (an FTS5 virtual table on SQLite,
+# a tsvector table with a GIN index on PostgreSQL)
+SEARCH_TABLE = 'book_search'
+
+# Ids are reindexed in chunks to stay under SQLite's bound-parameter limit
+REINDEX_CHUNK_SIZE = 500
+
+# Ranked pages seek past a (score, book id) cursor
+RANK_KEY_WIDTH = 2
+
+# Column weights for bm25(), in the order the FTS5 columns are declared:
+# title, author, isbn, publisher, description, genres
+SQLITE_BM25_WEIGHTS = '10.0, 8.0, 8.0, 2.0, 1.0, 4.0'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_SQLITE_CREATE = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        title, author, isbn, publisher, description, genres,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )"""
+]
+
+_POSTGRES_CREATE = [
+    f"""CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+        book_id INTEGER PRIMARY KEY REFERENCES book (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )""",
+    f"""CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document
+        ON {SEARCH_TABLE} USING GIN (document)"""
+]
+
+_SQLITE_DELETE = f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN :ids'
+_SQLITE_INSERT = f"""
+    INSERT INTO {SEARCH_TABLE} (rowid, title, author, isbn, publisher, description, genres)
+    SELECT b.id, b.title, b.author, coalesce(b.isbn, ''), coalesce(b.publisher, ''),
+           coalesce(b.description, ''),
+           coalesce((SELECT group_concat(g.name, ' ')
+                     FROM book_genre bg JOIN genre g ON g.id = bg.genre_id
+                     WHERE bg.book_id = b.id), '')
+    FROM book b
+"""
+
+_POSTGRES_DELETE = f'DELETE FROM {SEARCH_TABLE} WHERE book_id IN :ids'
+_POSTGRES_INSERT = f"""
+    INSERT INTO {SEARCH_TABLE} (book_id, document)
+    SELECT b.id,
+           setweight(to_tsvector('simple', coalesce(b.title, '')), 'A') ||
+           setweight(to_tsvector('simple', coalesce(b.author, '')), 'A') ||
+           setweight(to_tsvector('simple', coalesce(b.isbn, '')), 'A') ||
+           setweight(to_tsvector('simple', coalesce((SELECT string_agg(g.name, ' ')
+                     FROM book_genre bg JOIN genre g ON g.id = bg.genre_id
+                     WHERE bg.book_id = b.id), '')), 'B') ||
+           setweight(to_tsvector('simple', coalesce(b.publisher, '')), 'C') ||
+           setweight(to_tsvector('simple', coalesce(b.description, '')), 'D')
+    FROM book b
+"""
+
+
+def _is_postgres(bind):
+    return bind.dialect.name == 'postgresql'
+
+
+def create_search_index():
+    """Create the search indexes that are missing and fill them from the book and user tables"""
+    with db.engine.begin() as connection:
+        created = create_user_search_index(connection)
+        created = create_trigram_index(connection) or created
+        if inspect(connection).has_table(SEARCH_TABLE):
+            return created
+        statements = _POSTGRES_CREATE if _is_postgres(connection) else _SQLITE_CREATE
+        for statement in statements:
+            connection.execute(text(statement))
+        _fill_search_table(connection)
+    return True
+
+
+def _fill_search_table(connection):
+    insert = _POSTGRES_INSERT if _is_postgres(connection) else _SQLITE_INSERT
+    connection.execute(text(f'DELETE FROM {SEARCH_TABLE}'))
+    connection.execute(text(insert))
+    return connection.execute(text(f'SELECT count(*) FROM {SEARCH_TABLE}')).scalar()
+
+
+def rebuild_search_index(connection=None):
+    """Reindex every book in both book indexes and every user, returning the number of indexed books"""
+    connection = connection or db.session.connection()
+    rebuild_trigram_index(connection)
+    rebuild_user_search_index(connection)
+    return _fill_search_table(connection)
+
+
+def reindex_books(connection, book_ids):
+    """Refresh the index rows for the given books (missing books are dropped)
+
+    The trigram index is refreshed too, so every writer that keeps the
+    full-text index in step keeps both.
+    """
+    book_ids = sorted(set(book_ids))
+    if _is_postgres(connection):
+        delete, insert = _POSTGRES_DELETE, _POSTGRES_INSERT
+    else:
+        delete, insert = _SQLITE_DELETE, _SQLITE_INSERT
+
+    delete = text(delete).bindparams(bindparam('ids', expanding=True))
+    insert = text(insert + ' WHERE b.id IN :ids').bindparams(bindparam('ids', expanding=True))
+    for start in range(0, len(book_ids), REINDEX_CHUNK_SIZE):
+        chunk = book_ids[start:start + REINDEX_CHUNK_SIZE]
+        connection.execute(delete, {'ids': chunk})
+        connection.execute(insert, {'ids': chunk})
+    reindex_trigrams(connection, book_ids)
+
+
+def search_terms(query):
+    """Split free text into lower-cased search terms"""
+    return [term.lower() for term in _TOKEN_RE.findall(query or '')]
+
+
+def _match_expression(terms, postgres):
+    # Every term must match, each as a prefix so partial words still hit
+    if postgres:
+        return ' & '.join(f'{term}:*' for term in terms)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _ranked_matches(postgres):
+    if postgres:
+        return f"""
+            SELECT s.book_id AS book_id, ts_rank(s.document, q.query) AS score
+            FROM {SEARCH_TABLE} s, to_tsquery('simple', :match) AS q(query)
+            WHERE s.document @@ q.query
+        """
+    # bm25() is lower-is-better, negate it so both backends sort descending
+    return f"""
+        SELECT rowid AS book_id, -bm25({SEARCH_TABLE}, {SQLITE_BM25_WEIGHTS}) AS score
+        FROM {SEARCH_TABLE}
+        WHERE {SEARCH_TABLE} MATCH :match
+    """
+
+
+def _load_books(book_ids):
+    return {book.id: book for book in Book.query.options(selectinload(Book.genres)).filter(Book.id.in_(book_ids))}
+
+
+def search_books(query, per_page=12, after=None, before=None, load=_load_books, fuzzy=False):
+    """Return a KeysetPage of books matching the query, best matches first
+
+    Pages seek past the (score, book id) of the previous page's boundary row,
+    so deep pages cost the same as the first one and no COUNT is issued.
+    ``load(book_ids)`` turns a page of ids into {id: item}; by default the
+    items are Book objects with their genres. With ``fuzzy`` the terms are
+    matched against title and author words through the trigram index, so
+    misspellings still find the book.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return KeysetPage(lambda values, backwards, limit: [], per_page)
+
+    def fetch(values, backwards, limit):
+        connection = db.session.connection()
+        if fuzzy:
+            matches = similar_words(connection, terms)
+            if not matches:
+                return []
+            sql, params = ranked_books_sql(matches)
+        else:
+            sql, params = _full_text_matches(terms, _is_postgres(connection))
+        rows = connection.execute(*_ranked_page(sql, params, values, backwards, limit)).fetchall()
+
+        # Load the page of books in one query, then restore the ranked order
+        book_ids = [row.book_id for row in rows]
+        books = load(book_ids) if book_ids else {}
+        return _in_rank_order(rows, books)
+
+    return KeysetPage(fetch, per_page, after=after, before=before, width=RANK_KEY_WIDTH)
+
+
+async def search_books_async(session, query, load, per_page=12, after=None, before=None, fuzzy=False):
+    """search_books on an AsyncSession, loaded right away; ``load`` is a coroutine"""
+    terms = search_terms(query)
+    if not terms:
+        return KeysetPage(lambda values, backwards, limit: [], per_page)
+
+    async def fetch(values, backwards, limit):
+        if fuzzy:
+            matches = await similar_words_async(session, terms)
+            if not matches:
+                return []
+            sql, params = ranked_books_sql(matches)
+        else:
+            sql, params = _full_text_matches(terms, _is_postgres(session.bind))
+        rows = (await session.execute(*_ranked_page(sql, params, values, backwards, limit))).all()
+        book_ids = [row.book_id for row in rows]
+        return _in_rank_order(rows, await load(book_ids) if book_ids else {})
+
+    return await KeysetPage(None, per_page, after=after, before=before,
+                            width=RANK_KEY_WIDTH).prefetch(fetch)
+
+
+def _full_text_matches(terms, postgres):
+    return _ranked_matches(postgres), {'match': _match_expression(terms, postgres)}
+
+
+def _ranked_page(matches_sql, params, values, backwards, limit):
+    """(statement, params) for one page of (book_id, score) rows past a cursor"""
+    sql = f'SELECT book_id, score FROM ({matches_sql}) AS matches'
+    params = dict(params, limit=limit)
+    if values is not None:
+        if backwards:
+            sql += ' WHERE score > :score OR (score = :score AND book_id < :book_id)'
+        else:
+            sql += ' WHERE score < :score OR (score = :score AND book_id > :book_id)'
+        params.update(score=values[0], book_id=values[1])
+    order = 'score ASC, book_id DESC' if backwards else 'score DESC, book_id ASC'
+    return text(f'{sql} ORDER BY {order} LIMIT :limit'), params
+
+
+def suggest_books(query, limit=8):
+    """Books for the search box's autocomplete, from the trigram index
+
+    The last word counts as a prefix unless the query ends in a space, so
+    suggestions follow the patron's typing; earlier words may be misspelt.
+    Returns dicts with id, title and author, best first.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    connection = db.session.connection()
+    matches = similar_words(connection, terms, prefix_last=not query[-1:].isspace())
+    if not matches:
+        return []
+    sql, params = ranked_books_sql(matches)
+    rows = connection.execute(text(
+        f'SELECT matches.book_id AS id, b.title AS title, b.author AS author '
+        f'FROM ({sql}) AS matches JOIN book b ON b.id = matches.book_id '
+        f'ORDER BY matches.score DESC, matches.book_id LIMIT :limit'
+    ), dict(params, limit=limit))
+    return [{'id': row.id, 'title': row.title, 'author': row.author} for row in rows]
+
+
+def _in_rank_order(rows, items):
+    return [([row.score, row.book_id], items[row.book_id]) for row in rows if row.book_id in items]
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_deleted_genres(session, flush_context, instances):
+    # Association rows for deleted genres are gone after the flush, so the
+    # affected books have to be looked up while they still exist
+    genre_ids = [obj.id for obj in session.deleted if isinstance(obj, Genre) and obj.id]
+    if genre_ids:
+        rows = session.connection().execute(
+            text('SELECT book_id FROM book_genre WHERE genre_id IN :ids')
+            .bindparams(bindparam('ids', expanding=True)),
+            {'ids': genre_ids}
+        )
+        session.info.setdefault('search_reindex', set()).update(row.book_id for row in rows)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_search_index(session, flush_context):
+    """Keep the full-text index in step with book and genre writes"""
+    book_ids = session.info.pop('search_reindex', set())
+    renamed_genres = []
+
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Book):
+            book_ids.add(obj.id)
+
+    for obj in session.dirty:
+        if isinstance(obj, Book) and session.is_modified(obj):
+            book_ids.add(obj.id)
+        elif isinstance(obj, Genre) and session.is_modified(obj, include_collections=False):
+            renamed_genres.append(obj.id)
+
+    connection = session.connection()
+    if renamed_genres:
+        rows = connection.execute(
+            text('SELECT book_id FROM book_genre WHERE genre_id IN :ids')
+            .bindparams(bindparam('ids', expanding=True)),
+            {'ids': renamed_genres}
+        )
+        book_ids.update(row.book_id for row in rows)
+
+    book_ids.discard(None)
+    if book_ids:
+        reindex_books(connection, book_ids)
@@ -0,0 +1,104 @@
+from app import db
+from models.book import Book, Genre, book_genre
+from models.stats import LibraryStats, GenreStats
+from sqlalchemy import func
+from datetime import datetime
+
+# The summary table holds exactly one row
+STATS_ID = 1
+
+
+def book_on_loan(book):
+    """Check if any copy of the book is currently checked out"""
+    return book.available_copies < book.total_copies
+
+
+def rebuild_stats():
+    """Recompute every counter from the base tables, fixing any drift"""
+    db.session.flush()
+    total_books = db.session.query(func.count(Book.id)).scalar()
+    total_genres = db.session.query(func.count(Genre.id)).scalar()
+    books_on_loan = db.session.query(func.count(Book.id)).filter(
+        Book.available_copies < Book.total_copies
+    ).scalar()
+
+    stats = LibraryStats.query.get(STATS_ID) or LibraryStats(id=STATS_ID)
+    stats.total_books = total_books
+    stats.total_genres = total_genres
+    stats.books_on_loan = books_on_loan
+    stats.updated_at = datetime.utcnow()
+    db.session.add(stats)
+
+    GenreStats.query.delete()
+    counts = db.session.query(
+        Genre.id, func.count(book_genre.c.book_id)
+    ).outerjoin(book_genre, book_genre.c.genre_id == Genre.id).group_by(Genre.id).all()
+    db.session.bulk_insert_mappings(GenreStats, [
+        {'genre_id': genre_id, 'book_count': count} for genre_id, count in counts
+    ])
+    db.session.flush()
+    return stats
+
+
+def adjust_stats(total_books=0, total_genres=0, books_on_loan=0):
+    """Apply counter deltas to the summary row inside the current transaction
+
+    The increments are done in SQL so concurrent writers never overwrite each
+    other's changes. If the summary row does not exist yet it is rebuilt from
+    the base tables instead, so call this after staging the change and after
+    adjust_genre_counts().
+    """
+    if not (total_books or total_genres or books_on_loan):
+        return
+    result = db.session.execute(
+        LibraryStats.__table__.update()
+        .where(LibraryStats.id == STATS_ID)
+        .values(total_books=LibraryStats.total_books + total_books,
+                total_genres=LibraryStats.total_genres + total_genres,
+                books_on_loan=LibraryStats.books_on_loan + books_on_loan,
+                updated_at=datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        rebuild_stats()
+
+
+def adjust_genre_counts(added=(), removed=()):
+    """Update per-genre book counts after books gain or lose genres"""
+    deltas = {}
+    for genre_id in added:
+        deltas[genre_id] = deltas.get(genre_id, 0) + 1
+    for genre_id in removed:
+        deltas[genre_id] = deltas.get(genre_id, 0) - 1
+
+    table = GenreStats.__table__
+    for genre_id, delta in deltas.items():
+        if delta == 0:
+            continue
+        result = db.session.execute(
+            table.update()
+            .where(table.c.genre_id == genre_id)
+            .values(book_count=table.c.book_count + delta)
+        )
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(genre_id=genre_id, book_count=max(delta, 0)))
+
+
+def get_library_stats():
+    """Return the summary row, building it on first use"""
+    stats = LibraryStats.query.get(STATS_ID)
+    if stats is None:
+        stats = rebuild_stats()
+        db.session.commit()
+    return stats
+
+
+def get_popular_genres(limit=5):
+    """Query (id, name, book_count) rows for the genres holding the most books
+
+    The query is returned unexecuted so a cached fragment can skip it.
+    """
+    return db.session.query(
+        Genre.id, Genre.name, GenreStats.book_count
+    ).join(GenreStats, GenreStats.genre_id == Genre.id).filter(
+        GenreStats.book_count > 0
+    ).order_by(GenreStats.book_count.desc()).limit(limit)
@@ -0,0 +1,17 @@
+from flask import Response, current_app, stream_with_context
+
+# Number of template chunks Jinja collects before each write to the client
+STREAM_BUFFER_SIZE = 5
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response instead of one big string
+
+    The page header goes out before the result loop pulls its rows from the
+    database, so the client starts rendering while the query is running.
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype='text/html')
@@ -0,0 +1,253 @@
+from sqlalchemy import inspect, text, bindparam
+import math
+import re
+import unicodedata
+
+# The typo-tolerant index: every distinct word of a title or author, the
+# trigrams of each word, and which books use the word where. Lookups go
+# gram -> similar words -> books, so a query costs a few index range scans
+# instead of an edit distance against every row.
+WORD_TABLE = 'book_word'
+GRAM_TABLE = 'word_trigram'
+
+# Fields the words come from, with the weight a match in each one gets
+FIELD_WEIGHTS = {'title': 1.0, 'author': 0.8}
+
+# Words longer than this are cut; shorter than MIN_WORD_LENGTH are skipped
+MAX_WORD_LENGTH = 64
+MIN_WORD_LENGTH = 2
+
+# Lowest trigram similarity (shared / union, as pg_trgm computes it) for a
+# word to count as a misspelling of a search term. Below pg_trgm's 0.3
+# because two swapped letters in a short word cost three trigrams:
+# "shdaow" and "shadow" score 0.27, "tolkein" and "tolkien" 0.33.
+SIMILARITY_THRESHOLD = 0.2
+
+# Lowest share of a typed prefix's trigrams a word must contain to complete it
+PREFIX_THRESHOLD = 0.6
+
+# Closest words kept per search term, and the most terms looked up per query
+WORDS_PER_TERM = 8
+MAX_TERMS = 6
+
+# Books are reindexed in chunks to stay under SQLite's bound-parameter limit
+REINDEX_CHUNK_SIZE = 500
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_CREATE = [
+    f"""CREATE TABLE IF NOT EXISTS {WORD_TABLE} (
+        word VARCHAR({MAX_WORD_LENGTH}) NOT NULL,
+        book_id INTEGER NOT NULL REFERENCES book (id) ON DELETE CASCADE,
+        field VARCHAR(8) NOT NULL,
+        PRIMARY KEY (word, book_id, field)
+    )""",
+    f'CREATE INDEX IF NOT EXISTS ix_{WORD_TABLE}_book_id ON {WORD_TABLE} (book_id)',
+    # gram_count is stored with each posting so candidates too long or too
+    # short to be similar are skipped inside the index range scan
+    f"""CREATE TABLE IF NOT EXISTS {GRAM_TABLE} (
+        gram VARCHAR(3) NOT NULL,
+        gram_count INTEGER NOT NULL,
+        word VARCHAR({MAX_WORD_LENGTH}) NOT NULL,
+        PRIMARY KEY (gram, gram_count, word)
+    )""",
+]
+
+
+def normalize(value):
+    """Lower-case and strip accents, so "Brontë" and "bronte" are the same word"""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def words(value):
+    return {word[:MAX_WORD_LENGTH] for word in _TOKEN_RE.findall(normalize(value))
+            if len(word) >= MIN_WORD_LENGTH}
+
+
+def word_grams(word):
+    """The word's trigrams, padded as pg_trgm does so its start counts for more"""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def prefix_grams(prefix):
+    """Trigrams of a word still being typed: no end padding, so any completion contains them all"""
+    padded = f'  {prefix}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def create_trigram_index(connection):
+    """Create the trigram tables if they are missing and fill them; True if created"""
+    if inspect(connection).has_table(WORD_TABLE):
+        return False
+    for statement in _CREATE:
+        connection.execute(text(statement))
+    rebuild_trigram_index(connection)
+    return True
+
+
+def rebuild_trigram_index(connection):
+    """Reindex every book's title and author words, returning the number of words"""
+    connection.execute(text(f'DELETE FROM {WORD_TABLE}'))
+    connection.execute(text(f'DELETE FROM {GRAM_TABLE}'))
+    last_id = 0
+    while True:
+        book_ids = connection.execute(
+            text('SELECT id FROM book WHERE id > :last_id ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': REINDEX_CHUNK_SIZE}
+        ).scalars().all()
+        if not book_ids:
+            break
+        _index_books(connection, book_ids)
+        last_id = book_ids[-1]
+    return connection.execute(text(f'SELECT count(DISTINCT word) FROM {WORD_TABLE}')).scalar()
+
+
+def reindex_trigrams(connection, book_ids):
+    """Refresh the words of the given books (missing books are dropped)
+
+    Words no book uses any more keep their trigrams until the next full
+    rebuild; they can still be found as candidates but match no book.
+    """
+    book_ids = sorted(set(book_ids))
+    delete = text(f'DELETE FROM {WORD_TABLE} WHERE book_id IN :ids').bindparams(
+        bindparam('ids', expanding=True))
+    for start in range(0, len(book_ids), REINDEX_CHUNK_SIZE):
+        chunk = book_ids[start:start + REINDEX_CHUNK_SIZE]
+        connection.execute(delete, {'ids': chunk})
+        _index_books(connection, chunk)
+
+
+def _index_books(connection, book_ids):
+    rows = connection.execute(
+        text('SELECT id, title, author FROM book WHERE id IN :ids').bindparams(bindparam('ids', expanding=True)),
+        {'ids': list(book_ids)}
+    )
+    postings = []
+    for row in rows:
+        for field in FIELD_WEIGHTS:
+            postings += [{'word': word, 'book_id': row.id, 'field': field} for word in words(getattr(row, field))]
+    if not postings:
+        return
+    connection.execute(text(f'INSERT INTO {WORD_TABLE} (word, book_id, field) VALUES (:word, :book_id, :field)'),
+                       postings)
+
+    # Trigrams only for words the index has not seen yet; another writer
+    # adding the same word at once is absorbed by ON CONFLICT
+    new_words = {posting['word'] for posting in postings}
+    known = text(f'SELECT DISTINCT word FROM {GRAM_TABLE} WHERE word IN :words').bindparams(
+        bindparam('words', expanding=True))
+    batch = sorted(new_words)
+    for start in range(0, len(batch), REINDEX_CHUNK_SIZE):
+        new_words -= set(connection.execute(known, {'words': batch[start:start + REINDEX_CHUNK_SIZE]}).scalars())
+    grams = []
+    for word in new_words:
+        word_set = word_grams(word)
+        grams += [{'gram': gram, 'gram_count': len(word_set), 'word': word} for gram in word_set]
+    if grams:
+        connection.execute(
+            text(f'INSERT INTO {GRAM_TABLE} (gram, gram_count, word) VALUES (:gram, :gram_count, :word) '
+                 'ON CONFLICT DO NOTHING'), grams)
+
+
+def similar_words_statement(term, prefix=False):
+    """(statement, params, grams) finding the index words close to a search term
+
+    A whole term is compared by similarity (shared grams over the union of
+    both sets); a prefix by how many of its grams a word contains. The
+    gram_count bounds follow from the threshold, so most unrelated words
+    are never read.
+    """
+    grams = prefix_grams(term) if prefix else word_grams(term)
+    count = len(grams)
+    if prefix:
+        low, high = math.ceil(count * PREFIX_THRESHOLD), MAX_WORD_LENGTH + 1
+        having = 'count(*) >= :min_shared'
+        params = {'min_shared': math.ceil(count * PREFIX_THRESHOLD)}
+    else:
+        low = math.ceil(count * SIMILARITY_THRESHOLD)
+        high = math.floor(count / SIMILARITY_THRESHOLD)
+        # shared / (count + gram_count - shared) >= threshold, without division
+        having = 'count(*) * :one_plus_t >= :threshold * (:count + gram_count)'
+        params = {'one_plus_t': 1 + SIMILARITY_THRESHOLD, 'threshold': SIMILARITY_THRESHOLD, 'count': count}
+    statement = text(f"""
+        SELECT word, gram_count, count(*) AS shared FROM {GRAM_TABLE}
+        WHERE gram IN :grams AND gram_count BETWEEN :low AND :high
+        GROUP BY word, gram_count
+        HAVING {having}
+    """).bindparams(bindparam('grams', expanding=True))
+    params.update(grams=sorted(grams), low=low, high=high)
+    return statement, params, grams
+
+
+def rank_words(rows, grams, prefix=False):
+    """The WORDS_PER_TERM closest words as (word, similarity), best first"""
+    count = len(grams)
+    scored = []
+    for row in rows:
+        if prefix:
+            similarity = row.shared / count
+        else:
+            similarity = row.shared / (count + row.gram_count - row.shared)
+        scored.append((round(similarity, 4), row.gram_count, row.word))
+    # Closest first, then the shortest completion
+    scored.sort(key=lambda item: (-item[0], item[1], item[2]))
+    return [(word, similarity) for similarity, gram_count, word in scored[:WORDS_PER_TERM]]
+
+
+def lookup_terms(terms, prefix_last=False):
+    """(term, prefix) pairs worth looking up: at most MAX_TERMS, long enough to have grams"""
+    terms = [normalize(term) for term in terms if len(term) >= MIN_WORD_LENGTH][:MAX_TERMS]
+    return [(term, prefix_last and index == len(terms) - 1) for index, term in enumerate(terms)]
+
+
+def similar_words(connection, terms, prefix_last=False):
+    """For each term, its closest index words; terms with no close word are left out"""
+    matches = []
+    for term, prefix in lookup_terms(terms, prefix_last):
+        statement, params, grams = similar_words_statement(term, prefix)
+        candidates = rank_words(connection.execute(statement, params), grams, prefix)
+        if candidates:
+            matches.append(candidates)
+    return matches
+
+
+async def similar_words_async(session, terms, prefix_last=False):
+    """similar_words on an AsyncSession"""
+    matches = []
+    for term, prefix in lookup_terms(terms, prefix_last):
+        statement, params, grams = similar_words_statement(term, prefix)
+        candidates = rank_words((await session.execute(statement, params)).all(), grams, prefix)
+        if candidates:
+            matches.append(candidates)
+    return matches
+
+
+def ranked_books_sql(matches):
+    """(sql, params) selecting book_id and score for books with a close word for every term
+
+    A term scores the best similarity among its words in the book, weighted
+    by field; a book scores the sum over terms.
+    """
+    weights = ' '.join(f"WHEN '{field}' THEN {weight}" for field, weight in FIELD_WEIGHTS.items())
+    selects, params = [], {}
+    for term_index, candidates in enumerate(matches):
+        for word_index, (word, similarity) in enumerate(candidates):
+            name = f'w{term_index}_{word_index}'
+            selects.append(f'SELECT {term_index} AS term, CAST(:{name} AS VARCHAR({MAX_WORD_LENGTH})) AS word, '
+                           f'CAST({similarity!r} AS DOUBLE PRECISION) AS similarity')
+            params[name] = word
+    params['term_count'] = len(matches)
+    sql = f"""
+        SELECT book_id, sum(score) AS score FROM (
+            SELECT w.book_id AS book_id, m.term AS term,
+                   max(m.similarity * CASE w.field {weights} ELSE 0 END) AS score
+            FROM ({' UNION ALL '.join(selects)}) AS m
+            JOIN {WORD_TABLE} w ON w.word = m.word
+            GROUP BY w.book_id, m.term
+        ) AS term_scores
+        GROUP BY book_id
+        HAVING count(*) = :term_count
+    """
+    return sql, params
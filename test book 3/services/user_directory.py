@@ -0,0 +1,204 @@
+from app import db
+from models.loan import Loan
+from models.user import User
+from sqlalchemy import event, exists, inspect, text, bindparam, func
+from datetime import datetime
+import re
+
+# Name of the member search index (an FTS5 virtual table on SQLite, a
+# tsvector table with a GIN index on PostgreSQL) over username, email and name
+USER_SEARCH_TABLE = 'user_search'
+
+# Ids are reindexed in chunks to stay under SQLite's bound-parameter limit
+REINDEX_CHUNK_SIZE = 500
+
+# Words are split on anything but letters and digits, in the index and the
+# query alike, so "smith" finds "jo.smith@example.org" and "j_smith"
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+# prefix='2 3' keeps extra index entries for two and three letter prefixes,
+# so short queries typed into the directory do not scan the whole term list
+_SQLITE_CREATE = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {USER_SEARCH_TABLE} USING fts5(
+        username, email, first_name, last_name,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )"""
+]
+
+_POSTGRES_CREATE = [
+    f"""CREATE TABLE IF NOT EXISTS {USER_SEARCH_TABLE} (
+        user_id INTEGER PRIMARY KEY REFERENCES "user" (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )""",
+    f"""CREATE INDEX IF NOT EXISTS ix_{USER_SEARCH_TABLE}_document
+        ON {USER_SEARCH_TABLE} USING GIN (document)"""
+]
+
+_SQLITE_DELETE = f'DELETE FROM {USER_SEARCH_TABLE} WHERE rowid IN :ids'
+_SQLITE_INSERT = f"""
+    INSERT INTO {USER_SEARCH_TABLE} (rowid, username, email, first_name, last_name)
+    SELECT u.id, u.username, u.email, coalesce(u.first_name, ''), coalesce(u.last_name, '')
+    FROM "user" u
+"""
+
+_POSTGRES_DELETE = f'DELETE FROM {USER_SEARCH_TABLE} WHERE user_id IN :ids'
+# The parser would keep an email address as one token, so split it up first
+_POSTGRES_INSERT = f"""
+    INSERT INTO {USER_SEARCH_TABLE} (user_id, document)
+    SELECT u.id, to_tsvector('simple', regexp_replace(
+               concat_ws(' ', u.username, u.email, u.first_name, u.last_name), '[^[:alnum:]]+', ' ', 'g'))
+    FROM "user" u
+"""
+
+# Keyset columns for each directory order (the last one is unique) and
+# whether it runs descending. Names are compared with NULL as '' so the
+# cursor never has to compare against a NULL.
+LAST_NAME_KEY = func.coalesce(User.last_name, '').label('last_name_key')
+FIRST_NAME_KEY = func.coalesce(User.first_name, '').label('first_name_key')
+SORT_KEYS = {
+    'username': ((User.username,), False),
+    'name': ((LAST_NAME_KEY, FIRST_NAME_KEY, User.id), False),
+    'email': ((User.email,), False),
+    'newest': ((User.id,), True),
+}
+
+# Columns of a directory row; loan counts are added per page
+DIRECTORY_COLUMNS = (User.id, User.username, User.email, User.first_name, User.last_name,
+                     User.is_admin, User.created_at)
+
+
+def _is_postgres(bind):
+    return bind.dialect.name == 'postgresql'
+
+
+def create_user_search_index(connection):
+    """Create the member search index if it is missing and fill it; True if created"""
+    if inspect(connection).has_table(USER_SEARCH_TABLE):
+        return False
+    statements = _POSTGRES_CREATE if _is_postgres(connection) else _SQLITE_CREATE
+    for statement in statements:
+        connection.execute(text(statement))
+    rebuild_user_search_index(connection)
+    return True
+
+
+def rebuild_user_search_index(connection):
+    """Reindex every user, returning the number of indexed rows"""
+    insert = _POSTGRES_INSERT if _is_postgres(connection) else _SQLITE_INSERT
+    connection.execute(text(f'DELETE FROM {USER_SEARCH_TABLE}'))
+    connection.execute(text(insert))
+    return connection.execute(text(f'SELECT count(*) FROM {USER_SEARCH_TABLE}')).scalar()
+
+
+def reindex_users(connection, user_ids):
+    """Refresh the index rows for the given users (missing users are dropped)"""
+    user_ids = sorted(set(user_ids))
+    if _is_postgres(connection):
+        delete, insert = _POSTGRES_DELETE, _POSTGRES_INSERT
+    else:
+        delete, insert = _SQLITE_DELETE, _SQLITE_INSERT
+
+    delete = text(delete).bindparams(bindparam('ids', expanding=True))
+    insert = text(insert + ' WHERE u.id IN :ids').bindparams(bindparam('ids', expanding=True))
+    for start in range(0, len(user_ids), REINDEX_CHUNK_SIZE):
+        chunk = user_ids[start:start + REINDEX_CHUNK_SIZE]
+        connection.execute(delete, {'ids': chunk})
+        connection.execute(insert, {'ids': chunk})
+
+
+def _matching_ids(terms, postgres):
+    """Ids of users with every term as a word prefix in any indexed field"""
+    if postgres:
+        return text(
+            f"SELECT user_id AS id FROM {USER_SEARCH_TABLE} WHERE document @@ to_tsquery('simple', :match)"
+        ).bindparams(match=' & '.join(f'{term}:*' for term in terms)).columns(id=db.Integer)
+    return text(
+        f'SELECT rowid AS id FROM {USER_SEARCH_TABLE} WHERE {USER_SEARCH_TABLE} MATCH :match'
+    ).bindparams(match=' '.join(f'"{term}"*' for term in terms)).columns(id=db.Integer)
+
+
+class UserFilters:
+    """The directory filters: a search over username, email and name, role and loan status"""
+
+    ROLES = ('admin', 'patron')
+    LOANS = ('active', 'overdue', 'none')
+
+    def __init__(self, query='', role=None, loans=None):
+        self.query = (query or '').strip()
+        self.role = role if role in self.ROLES else None
+        self.loans = loans if loans in self.LOANS else None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(query=args.get('query', ''), role=args.get('role'), loans=args.get('loans'))
+
+    @property
+    def terms(self):
+        return [term.lower() for term in _TOKEN_RE.findall(self.query)]
+
+    def conditions(self, bind, now=None):
+        """WHERE clauses on the user table, usable in a SELECT or an UPDATE"""
+        clauses = []
+        terms = self.terms
+        if terms:
+            clauses.append(User.id.in_(_matching_ids(terms, _is_postgres(bind))))
+        if self.role:
+            clauses.append(User.is_admin == (self.role == 'admin'))
+        if self.loans:
+            loan_conditions = [Loan.user_id == User.id, Loan.returned == False]
+            if self.loans == 'overdue':
+                loan_conditions.append(Loan.due_date < (now or datetime.utcnow()))
+            has_loans = exists().where(*loan_conditions)
+            clauses.append(~has_loans if self.loans == 'none' else has_loans)
+        return clauses
+
+    def args(self, **changes):
+        """Query-string arguments for url_for, with some filters replaced"""
+        args = {'query': self.query, 'role': self.role, 'loans': self.loans}
+        args.update(changes)
+        return {name: value for name, value in args.items() if value not in (None, '')}
+
+    @property
+    def active(self):
+        return bool(self.args())
+
+
+def directory_query(filters, sort_by):
+    """(query, keyset columns, descending) for one directory listing"""
+    columns, descending = SORT_KEYS[sort_by]
+    extra = [column for column in columns if not any(column is c for c in DIRECTORY_COLUMNS)]
+    query = db.session.query(*DIRECTORY_COLUMNS, *extra)
+    return query.filter(*filters.conditions(db.engine)), columns, descending
+
+
+def _admin_changes(filters, is_admin, keep):
+    conditions = [*filters.conditions(db.engine), User.is_admin != is_admin]
+    if keep is not None:
+        conditions.append(User.id != keep)
+    return conditions
+
+
+def count_admin_changes(filters, is_admin, keep=None):
+    """How many users set_admin would change, for the confirmation step"""
+    return db.session.query(func.count(User.id)).filter(*_admin_changes(filters, is_admin, keep)).scalar()
+
+
+def set_admin(filters, is_admin, keep=None):
+    """Grant or revoke admin for every user the filters select, in one UPDATE
+
+    ``keep`` is a user id left untouched (the admin doing it). Returns the
+    number of users changed; the caller commits.
+    """
+    statement = User.__table__.update().where(*_admin_changes(filters, is_admin, keep))
+    return db.session.execute(statement.values(is_admin=is_admin)).rowcount
+
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_user_search_index(session, flush_context):
+    """Keep the member search index in step with user writes"""
+    user_ids = {obj.id for obj in session.new | session.deleted if isinstance(obj, User)}
+    user_ids.update(obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj))
+    user_ids.discard(None)
+    if user_ids:
+        reindex_users(session.connection(), user_ids)
@@ -31,6 +31,8 @@ document.addEventListener('DOMContentLoaded', function() {
     const searchForm = document.querySelector('.search-form');
     if (searchForm) {
         const searchInput = searchForm.querySelector('input[type="search"]');
+        // The clear button and suggestions sit over the search box itself
+        const searchBox = searchForm.querySelector('.search-box') || searchForm;
         const clearButton = document.createElement('button');
         clearButton.type = 'button';
         clearButton.className = 'btn btn-sm position-absolute end-0 top-50 translate-middle-y text-muted d-none';
@@ -42,7 +44,7 @@ document.addEventListener('DOMContentLoaded', function() {
             this.classList.add('d-none');
         });
         
-        searchForm.appendChild(clearButton);
+        searchBox.appendChild(clearButton);
         
         searchInput.addEventListener('input', function() {
             if (this.value.length > 0) {
@@ -54,14 +56,89 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Trigger input event to initialize clear button visibility
         searchInput.dispatchEvent(new Event('input'));
+
+        // Autocomplete from the trigram index, a short pause after typing stops
+        const suggestUrl = searchInput.dataset.suggestUrl;
+        if (suggestUrl) {
+            const suggestList = document.createElement('div');
+            suggestList.className = 'list-group search-suggestions d-none';
+            suggestList.setAttribute('role', 'listbox');
+            searchBox.appendChild(suggestList);
+
+            let suggestTimer = null;
+            let suggestRequest = 0;
+            const hideSuggestions = () => suggestList.classList.add('d-none');
+
+            searchInput.addEventListener('input', function() {
+                clearTimeout(suggestTimer);
+                const query = this.value;
+                if (query.trim().length < 2) {
+                    hideSuggestions();
+                    return;
+                }
+                suggestTimer = setTimeout(function() {
+                    const requestId = ++suggestRequest;
+                    fetch(suggestUrl + '?q=' + encodeURIComponent(query))
+                        .then(response => response.ok ? response.json() : {suggestions: []})
+                        .then(data => {
+                            // A slower, older request must not replace newer suggestions
+                            if (requestId !== suggestRequest) return;
+                            suggestList.innerHTML = '';
+                            data.suggestions.forEach(book => {
+                                const item = document.createElement('a');
+                                item.className = 'list-group-item list-group-item-action';
+                                item.href = book.url;
+                                item.setAttribute('role', 'option');
+                                const title = document.createElement('span');
+                                title.textContent = book.title;
+                                const author = document.createElement('small');
+                                author.className = 'text-muted ms-2';
+                                author.textContent = book.author;
+                                item.append(title, author);
+                                suggestList.appendChild(item);
+                            });
+                            suggestList.classList.toggle('d-none', data.suggestions.length === 0);
+                        })
+                        .catch(hideSuggestions);
+                }, 150);
+            });
+
+            searchInput.addEventListener('keydown', function(e) {
+                if (e.key === 'Escape') hideSuggestions();
+                if (e.key === 'ArrowDown' && suggestList.firstChild) {
+                    e.preventDefault();
+                    suggestList.firstChild.focus();
+                }
+            });
+            suggestList.addEventListener('keydown', function(e) {
+                const current = document.activeElement;
+                if (e.key === 'ArrowDown' && current.nextSibling) {
+                    e.preventDefault();
+                    current.nextSibling.focus();
+                } else if (e.key === 'ArrowUp') {
+                    e.preventDefault();
+                    (current.previousSibling || searchInput).focus();
+                } else if (e.key === 'Escape') {
+                    hideSuggestions();
+                    searchInput.focus();
+                }
+            });
+            document.addEventListener('click', function(e) {
+                if (!searchForm.contains(e.target)) hideSuggestions();
+            });
+        }
     }
 
     // Handle book filter form
     const filterForm = document.getElementById('bookFilterForm');
     if (filterForm) {
-        const filterSelects = filterForm.querySelectorAll('select');
-        filterSelects.forEach(select => {
-            select.addEventListener('change', function() {
+        const filterInputs = filterForm.querySelectorAll('select, input');
+        filterInputs.forEach(input => {
+            input.addEventListener('change', function() {
+                // Leave unset filters out of the URL
+                filterForm.querySelectorAll('input').forEach(field => {
+                    if (!field.value) field.disabled = true;
+                });
                 filterForm.submit();
             });
         });